@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import os
 import sys
 import datetime
 import transaction
@@ -12,7 +13,16 @@ from fabric.contrib.console import confirm
 from price_watch.models import (ProductCategory, StorageManager,
                                 ProductPackage, PriceReport, Category,
                                 PackageLookupError, Product, Merchant,
-                                CategoryLookupError)
+                                CategoryLookupError, ReportRegistry,
+                                Reporter, Page)
+from price_watch.data_map import (get_data_map, DataMap, DATA_MAP_PATH,
+                                  configure_classification_cache,
+                                  build_snapshot, get_snapshot_path)
+from price_watch.archive import (configure_archive, get_archive,
+                                 get_report_row, ARCHIVE_AGE,
+                                 ARCHIVE_CHUNK_SIZE, ARCHIVE_FIELDS)
+from price_watch.history import EPOCH, STATISTICS_FIELDS
+from price_watch.dogpile import CACHE_GENERATION
 
 APP_NAME = 'food-price.net'
 env.hosts = ['ubuntu@alpha.korinets.name']
@@ -23,9 +33,24 @@ logging.basicConfig(filename='debug.log', level=logging.DEBUG)
 
 
 def get_storage(path_='storage/storage.fs'):
+    configure_classification_cache(
+        path=os.path.join(os.path.dirname(path_), 'classification.cache'))
+    configure_archive(os.path.join(os.path.dirname(path_), 'archive.npza'))
     return StorageManager(path_)
 
 
+def rebuild_histories(keeper, category_key=None):
+    """Rebuild price histories of all or one product category"""
+    if category_key:
+        categories = [ProductCategory.fetch(category_key, keeper)]
+    else:
+        categories = ProductCategory.fetch_all(keeper)
+    for category in categories:
+        category.rebuild_history()
+        print(green(u'Rebuilt `{}` history: {} reports'.format(
+            category, len(category.history))))
+
+
 def get_datetimes(days):
     """Return list with days back range"""
 
@@ -65,8 +90,10 @@ def fix_normalized_price():
                 print(yellow(u'Fixing normal price {}-->{}'.format(
                       old_norm_price, new_norm_price)))
                 report.normalized_price_value = new_norm_price
+                report.product.update_report(report)
         except PackageLookupError, e:
             print(e.message)
+    rebuild_histories(keeper)
     transaction.commit()
     keeper.close()
 
@@ -88,9 +115,47 @@ def set_package_ratio():
         except PackageLookupError, e:
             logging.debug(e.message.encode('utf-8'))
             print(yellow(e.message))
+    rebuild_histories(keeper)
     transaction.commit()
 
 
+@task
+def check_data_map():
+    """Display packages that can't be converted to categories' normal ones"""
+    data_map = get_data_map()
+    for title in sorted(data_map.unconvertible):
+        units = ', '.join(sorted(data_map.unconvertible[title]))
+        print(yellow(u'{} ({}): no conversion from {}'.format(
+            title, data_map.category(title).normal_package, units)))
+
+
+@task
+def build_data_map():
+    """Compile the data map and save its snapshot"""
+    print(green('Snapshot saved to {}'.format(build_snapshot())))
+
+
+@task
+def benchmark_data_map(times=10):
+    """Compare data map loading from YAML and from the snapshot"""
+    with open(DATA_MAP_PATH, 'rb') as map_file:
+        content = map_file.read()
+    data_map = DataMap.from_yaml(content)
+    snapshot_path = get_snapshot_path(DATA_MAP_PATH)
+    data_map.save_snapshot(snapshot_path)
+    times = int(times)
+    start = datetime.datetime.now()
+    for count in range(times):
+        DataMap.from_yaml(content)
+    yaml_time = (datetime.datetime.now() - start).total_seconds() / times
+    start = datetime.datetime.now()
+    for count in range(times):
+        DataMap.load_snapshot(snapshot_path, data_map.version)
+    snapshot_time = (datetime.datetime.now() - start).total_seconds() / times
+    print('YAML: {:.4f}s, snapshot: {:.4f}s'.format(yaml_time,
+                                                     snapshot_time))
+
+
 @task
 def display_report(report_key):
     """Display a report by key"""
@@ -140,23 +205,30 @@ def display_category(category_key):
 
 
 @task
-def stats(category_key, days=2):
-    """Show daily statistics for a category"""
+def stats(category_key, days=2, resolution='day', location=None):
+    """Show daily (weekly, monthly) statistics for a category"""
     from prettytable import PrettyTable
-    table = PrettyTable(['date/time', 'report #', 'product #', 'median', 'min',
+    table = PrettyTable(['date', 'report #', 'product #', 'median', 'min',
                          'max'])
     table.align = 'l'
-    dates = get_datetimes(days)
+    start = datetime.date.today() - datetime.timedelta(days=int(days) - 1)
     keeper = StorageManager(FileStorage('storage.fs'))
     category = ProductCategory.fetch(category_key, keeper)
-    print(table)
-    for date in dates:
+    for date, rollup in reversed(category.get_rollups(resolution, start,
+                                                      location=location)):
+        rollup = rollup or dict()
         table.add_row([str(date),
-                       len(category.get_reports(date)),
-                       len(category.products),
-                       category.get_price(date),
-                       category.get_price(cheap=True),
-                       max(category.get_prices(date))])
+                       rollup.get('reports', 0),
+                       rollup.get('products', 0),
+                       rollup.get('median'),
+                       rollup.get('min'),
+                       rollup.get('max')])
+    print(table)
+    statistics = category.get_price_statistics(location=location) or dict()
+    table = PrettyTable(STATISTICS_FIELDS)
+    table.align = 'l'
+    table.add_row([statistics.get(field) for field in STATISTICS_FIELDS])
+    print(table)
 
 
 @task
@@ -167,7 +239,14 @@ def recreate():
 
     reports = PriceReport.fetch_all(keeper)
     print(cyan('Recreating storage from {} reports...'.format(len(reports))))
+    classifications = Product.get_classifications(
+        [report.product.title for report in reports])
     for report in reports:
+        classification = classifications[report.product.title]
+        if not classification[0]:
+            print(yellow(u'Dropping `{}`: '
+                         u'no category...'.format(report.product)))
+            continue
         try:
             PriceReport.assemble(storage_manager=new_keeper,
                                  uuid=report.uuid,
@@ -176,7 +255,8 @@ def recreate():
                                  merchant_title=report.merchant.title,
                                  reporter_name=report.reporter.name,
                                  url=report.url,
-                                 date_time=report.date_time)
+                                 date_time=report.date_time,
+                                 classification=classification)
         except CategoryLookupError:
             print(yellow(u'Dropping `{}`: '
                          u'no category...'.format(report.product)))
@@ -201,8 +281,13 @@ def cleanup(entity_class_name=None):
         entity_class = globals()[entity_class_name_]
         instances = entity_class.fetch_all(keeper, objects_only=False)
 
-        for key in instances.keys():
-            instance = instances[key]
+        for key in list(instances.keys()):
+            instance = instances.get(key)
+            if instance is None:
+                print(yellow(u'Removing `{}` without '
+                             u'a report record...'.format(key)))
+                keeper.delete_key(entity_class.namespace, key)
+                continue
             if entity_class is ProductCategory:
 
                 if not hasattr(instance, 'category') or not instance.category:
@@ -218,7 +303,7 @@ def cleanup(entity_class_name=None):
                         print(yellow(u'Removed '
                                      u'`{}` from `{}`...'.format(product,
                                                                  instance)))
-                    if len(product.reports) == 0:
+                    if len(product.get_report_book()) == 0:
                         instance.remove_product(product)
                         print(yellow(u'Removed stale '
                                      u'`{}` from `{}`...'.format(product,
@@ -235,17 +320,11 @@ def cleanup(entity_class_name=None):
 
             if entity_class is Product:
 
-                if type(instance.reports) is not list:
-                    print(yellow(u'Fixing product report '
-                                 u'list for `{}`...'.format(instance)))
-                    instance.reports = list(instance.reports.values())
-
-                if type(instance.merchants) is not list:
-                    print(yellow(u'Fixing product merchant '
-                                 u'list for `{}`...'.format(instance)))
-                    instance.merchants = list(instance.merchants.values())
+                if instance.migrate_containers():
+                    print(yellow(u'Migrated reports and merchant '
+                                 u'list of `{}`...'.format(instance)))
 
-                if len(instance.reports) == 0:
+                if len(instance.get_report_book()) == 0:
                     print(yellow(u'Removing stale `{}`...'.format(instance)))
                     instance.delete_from(keeper)
 
@@ -264,16 +343,23 @@ def cleanup(entity_class_name=None):
                     instance.delete_from(keeper)
 
                 # check key
+                if instance.key != instance._format_key():
+                    instance.reset_key()
                 if key != instance.key:
                     print(yellow(u'Fixing key for `{}`...'.format(key)))
                     keeper.register(instance)
                     keeper.delete_key(instance.namespace, key)
+                    if instance.category is not None:
+                        instance.category._get_container(
+                            'products').rekey(key, instance)
+                    for merchant in instance.merchants:
+                        merchant._get_container('products').rekey(
+                            key, instance)
 
             if entity_class is Merchant:
-                if type(instance.products) is not list:
-                    instance.products = list(instance.products.values())
+                instance.migrate_containers()
                 for product in instance.products:
-                    if len(product.reports) == 0:
+                    if len(product.get_report_book()) == 0:
                         print(yellow(u'Deleting `{}` '
                                      u'from `{}`...'.format(product,
                                                             instance)))
@@ -313,14 +399,415 @@ def cleanup(entity_class_name=None):
                                 instance.product, old_norm_price,
                                 correct_norm_price)))
                         instance.normalized_price_value = correct_norm_price
+                        instance.product.update_report(instance)
 
     keeper = get_storage()
     for entity_class_name in entity_list:
         cycle(entity_class_name, keeper)
+    rebuild_histories(keeper)
+    transaction.commit()
+    keeper.close()
+
+
+@task
+def rebuild_history(category_key=None):
+    """Rebuild price histories from the stored reports"""
+    keeper = get_storage()
+    rebuild_histories(keeper, category_key)
+    transaction.commit()
+    keeper.close()
+
+
+@task
+def index_reports(batch=1000):
+    """
+    Group the report books of the stored products by merchants, the books
+    grouped already are skipped. Batches are committed separately.
+    """
+    keeper = get_storage()
+    count = 0
+    for product in Product.fetch_all(keeper):
+        if product.get_report_book().records is None:
+            continue
+        product.index_reports()
+        count += 1
+        if count % int(batch) == 0:
+            transaction.commit()
+            print(green('Indexed reports of {} products...'.format(count)))
+    transaction.commit()
+    print(green('Indexed reports of {} products'.format(count)))
+    keeper.close()
+
+
+@task
+def index_locations():
+    """Rebuild the location indexes of all the stored categories"""
+    keeper = get_storage()
+    categories = ProductCategory.fetch_all(keeper)
+    for category in categories:
+        category.index_locations()
     transaction.commit()
+    print(green('Indexed locations of {} categories'.format(len(categories))))
     keeper.close()
 
 
+@task
+def update_rollups(category_key=None):
+    """
+    Persist the rollups of all the completed days, weeks and months of all
+    or one product category, the categories are committed separately
+    """
+    keeper = get_storage()
+    if category_key:
+        categories = [ProductCategory.fetch(category_key, keeper)]
+    else:
+        categories = ProductCategory.fetch_all(keeper)
+    for category in categories:
+        history = category.get_history()
+        history.update_rollups(catch_up=None)
+        transaction.commit()
+        print(green(u'Updated `{}` rollups through {}'.format(
+            category, history.get_rollups_through())))
+    keeper.close()
+
+
+@task
+def migrate_containers(batch=1000):
+    """
+    Migrate the product, merchant and category lists to BTree containers,
+    the report objects to the product report books grouped by merchants and
+    the report registry entries to its shards, store the keys of the
+    entities, create the cache generation counter. Batches are committed
+    separately, so the application may keep running.
+    """
+    keeper = get_storage()
+    keeper.get_counter(CACHE_GENERATION)
+    transaction.commit()
+    reports = keeper[PriceReport.namespace]
+    if type(reports) is not ReportRegistry:
+        registry = ReportRegistry()
+        for count, (key, report) in enumerate(reports.items(), 1):
+            registry[key] = report
+            if count % int(batch) == 0:
+                transaction.savepoint(optimistic=True)
+        keeper._root[PriceReport.namespace] = registry
+        transaction.commit()
+        print(green('Registered {} reports'.format(len(registry))))
+    else:
+        moved = reports.migrate()
+        transaction.commit()
+        print(green('Moved {} reports to the registry shards'.format(moved)))
+    count = 0
+    for entity_class in (ProductCategory, Merchant, Product, Category,
+                         ProductPackage, Reporter, Page):
+        if entity_class.namespace not in keeper._root:
+            continue
+        for instance in entity_class.fetch_all(keeper):
+            if instance.migrate_containers():
+                count += 1
+                if count % int(batch) == 0:
+                    transaction.commit()
+                    print(green('Migrated {} instances...'.format(count)))
+    transaction.commit()
+    print(green('Migrated {} instances'.format(count)))
+    keeper.close()
+
+
+@task
+def benchmark_writes(reports=1000, product_title=u'Молоко Farmers Milk 1L'):
+    """
+    Report storage bytes and objects written per ingested report of a single
+    product, committed one by one
+    """
+    from tempfile import mkdtemp
+    from shutil import rmtree
+
+    reports = int(reports)
+    tenth = max(reports // 10, 1)
+    now = datetime.datetime.now()
+    directory = mkdtemp()
+    path = os.path.join(directory, 'benchmark.fs')
+    keeper = StorageManager(path)
+    sizes = list()
+    try:
+        objects = len(keeper._zodb_storage)
+        for count in range(reports):
+            size = os.path.getsize(path)
+            PriceReport.assemble(
+                keeper, price_value=50 + count % 10,
+                product_title=product_title,
+                merchant_title=u'Merchant {}'.format(count % 5),
+                reporter_name=u'Benchmark', url=None,
+                date_time=now - datetime.timedelta(minutes=reports - count))
+            transaction.commit()
+            sizes.append(os.path.getsize(path) - size)
+        objects = len(keeper._zodb_storage) - objects
+    finally:
+        keeper.close()
+        rmtree(directory)
+    print('{} bytes/report, first {}: {}, last {}: {}, '
+          '{:.3f} objects/report'.format(
+              sum(sizes) // reports, tenth, sum(sizes[:tenth]) // tenth,
+              tenth, sum(sizes[-tenth:]) // tenth, float(objects) / reports))
+
+
+@task
+def stress_ingest(threads=4, reports=100, products=3, warm=False):
+    """
+    Ingest reports of a few products of one category from parallel
+    connections, each report committed separately, report the retry rate
+    and the conflicting classes. The merchants of the threads are new to
+    the category unless `warm`, then they report each product once before.
+    """
+    import threading
+    from collections import Counter
+    from tempfile import mkdtemp
+    from shutil import rmtree
+    from ZODB.POSException import ConflictError
+
+    threads, reports, products = int(threads), int(reports), int(products)
+    titles = [u'Молоко Stress Milk {} 1L'.format(count)
+              for count in range(products)]
+    directory = mkdtemp()
+    keeper = StorageManager(os.path.join(directory, 'stress.fs'))
+    merchants = range(threads) if warm in (True, 'yes') else [0]
+    for title in titles:
+        for number in merchants:
+            PriceReport.assemble(keeper, price_value=50, product_title=title,
+                                 merchant_title=u'Stress {}'.format(number),
+                                 reporter_name=u'Stress', url=None)
+    transaction.commit()
+    retries = list()
+    conflicts = Counter()
+
+    def ingest(number):
+        manager = transaction.TransactionManager()
+        connection = keeper._db.open(manager)
+        thread_keeper = StorageManager(connection=connection)
+        count = 0
+        for index in range(reports):
+            while True:
+                manager.begin()
+                PriceReport.assemble(
+                    thread_keeper, price_value=50 + index % 10,
+                    product_title=titles[index % products],
+                    merchant_title=u'Stress {}'.format(number),
+                    reporter_name=u'Stress', url=None)
+                try:
+                    manager.commit()
+                    break
+                except ConflictError as e:
+                    manager.abort()
+                    count += 1
+                    conflicts[u'{} {}'.format(type(e).__name__,
+                                              e.get_class_name())] += 1
+        retries.append(count)
+        connection.close()
+
+    start = datetime.datetime.now()
+    workers = [threading.Thread(target=ingest, args=(number,))
+               for number in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = (datetime.datetime.now() - start).total_seconds()
+    transaction.begin()
+    count = len(ProductCategory.fetch('milk', keeper).get_history())
+    keeper.close()
+    rmtree(directory)
+    total = threads * reports
+    print('{} reports in {:.1f}s, {} stored, {} retries ({:.1%})'.format(
+        total, seconds, count - products * len(merchants), sum(retries),
+        float(sum(retries)) / total))
+    for conflict, count in conflicts.most_common():
+        print('  {}: {}'.format(conflict, count))
+
+
+def start_zeo(path, address):
+    """Start ZEO server process for the storage, return it when listening"""
+    import socket
+    import subprocess
+    import time
+
+    runzeo = os.path.join(os.path.dirname(sys.executable), 'runzeo')
+    server = subprocess.Popen([runzeo, '-a', address, '-f', path])
+    host, port = address.rsplit(':', 1)
+    for attempt in range(100):
+        try:
+            socket.create_connection((host, int(port))).close()
+            return server
+        except socket.error:
+            time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError('ZEO server at {} did not start'.format(address))
+
+
+@task
+def serve_zeo(path='storage/storage.fs', address='127.0.0.1:8100'):
+    """
+    Serve the storage with ZEO, so several application processes (with
+    `zodbconn.uri = zeo://<address>`) may share it
+    """
+    print(cyan('Serving {} at {}...'.format(path, address)))
+    local('{} -a {} -f {}'.format(
+        os.path.join(os.path.dirname(sys.executable), 'runzeo'), address,
+        path))
+
+
+@task
+def serve_workers(workers=4, config='production-workers.ini',
+                  path='../storage/food-price.net/storage.fs',
+                  address='127.0.0.1:8100', port=5001):
+    """
+    Serve the storage with ZEO at the `address` of the config and run
+    `workers` application processes sharing it on the ports from `port` on
+    """
+    import subprocess
+
+    server = start_zeo(path, address)
+    pserve = os.path.join(os.path.dirname(sys.executable), 'pserve')
+    processes = list()
+    try:
+        for number in range(int(workers)):
+            processes.append(subprocess.Popen(
+                [pserve, config, 'http_port={}'.format(int(port) + number)]))
+        print(cyan('Serving {} workers on ports {}-{}...'.format(
+            len(processes), port, int(port) + len(processes) - 1)))
+        for process in processes:
+            process.wait()
+    finally:
+        for process in processes + [server]:
+            if process.poll() is None:
+                process.terminate()
+                process.wait()
+
+
+def run_worker(address, seconds, write_ratio, results):
+    """Read category prices and ingest reports over ZEO for `seconds`"""
+    from ZODB.POSException import ConflictError
+
+    keeper = StorageManager(address=address)
+    reads = writes = retries = 0
+    end = datetime.datetime.now() + datetime.timedelta(seconds=seconds)
+    while datetime.datetime.now() < end:
+        if writes < (reads + writes) * write_ratio:
+            PriceReport.assemble(
+                keeper, price_value=50 + writes % 10,
+                product_title=u'Молоко Farmers Milk 1L',
+                merchant_title=u'Worker {}'.format(os.getpid()),
+                reporter_name=u'Benchmark', url=None)
+            try:
+                transaction.commit()
+                writes += 1
+            except ConflictError:
+                transaction.abort()
+                retries += 1
+        else:
+            milk = ProductCategory.fetch('milk', keeper)
+            milk.get_price()
+            milk.get_daily()
+            transaction.abort()
+            reads += 1
+    keeper.close()
+    results.put((reads, writes, retries))
+
+
+@task
+def benchmark_workers(workers='1,2,4', seconds=10, write_ratio=0.1):
+    """
+    Report read and ingestion throughput of worker processes sharing a
+    fixture storage over a local ZEO server against the worker count
+    """
+    import multiprocessing
+    from tempfile import mkdtemp
+    from shutil import rmtree
+
+    directory = mkdtemp()
+    path = os.path.join(directory, 'benchmark.fs')
+    keeper = StorageManager(path)
+    keeper.load_fixtures(os.path.join(os.path.dirname(__file__),
+                                      'price_watch', 'tests',
+                                      'fixtures.json'))
+    transaction.commit()
+    keeper.close()
+    address = '127.0.0.1:8101'
+    server = start_zeo(path, address)
+    try:
+        for count in [int(count) for count in workers.split(',')]:
+            results = multiprocessing.Queue()
+            processes = [multiprocessing.Process(
+                target=run_worker,
+                args=(address, int(seconds), float(write_ratio), results))
+                for number in range(count)]
+            for process in processes:
+                process.start()
+            totals = [sum(values) for values in
+                      zip(*[results.get() for process in processes])]
+            for process in processes:
+                process.join()
+            reads, writes, retries = totals
+            print('{} workers: {:.1f} reads/s, {:.1f} reports/s, '
+                  '{} retries'.format(count, float(reads) / int(seconds),
+                                      float(writes) / int(seconds),
+                                      retries))
+    finally:
+        server.terminate()
+        server.wait()
+        rmtree(directory)
+
+
+@task
+def archive(days=ARCHIVE_AGE.days, pack='yes'):
+    """Move the reports older than `days` to the archive, pack the storage"""
+    keeper = get_storage()
+    report_archive = get_archive()
+    before = datetime.datetime.now() - datetime.timedelta(days=int(days))
+    print(cyan('Archiving reports before {}...'.format(before)))
+    count = 0
+    rows = list()
+    for product in Product.fetch_all(keeper):
+        rows.extend(product.archive_reports(keeper, before))
+        if len(rows) >= ARCHIVE_CHUNK_SIZE:
+            # the chunk is on disk before the reports are deleted for good
+            report_archive.append(rows)
+            transaction.commit()
+            count += len(rows)
+            rows = list()
+    report_archive.append(rows)
+    transaction.commit()
+    count += len(rows)
+    print(green('Archived {} reports, {} in the archive'.format(
+        count, len(report_archive))))
+    if pack in (True, 'yes'):
+        print(cyan('Packing storage...'))
+        keeper.pack()
+    keeper.close()
+
+
+@task
+def export_reports(path='reports.csv', days=None):
+    """Export the stored and the archived reports (of the last `days`)"""
+    import csv
+    keeper = get_storage()
+    start = None
+    if days:
+        start = datetime.datetime.now() - datetime.timedelta(days=int(days))
+    rows = [get_report_row(report) for report in PriceReport.fetch_all(keeper)
+            if start is None or report.date_time >= start]
+    columns = get_archive().read(start)
+    rows.extend(zip(*[columns[field] for field in ARCHIVE_FIELDS]))
+    rows.sort(key=lambda row: row[0])
+    with open(path, 'wb') as csv_file:
+        writer = csv.writer(csv_file)
+        writer.writerow(('date_time',) + ARCHIVE_FIELDS[1:])
+        for row in rows:
+            date_time = EPOCH + datetime.timedelta(microseconds=int(row[0]))
+            writer.writerow([date_time] + [unicode(value).encode('utf-8')
+                                           for value in row[1:]])
+    print(green('Exported {} reports to {}'.format(len(rows), path)))
+    keeper.close()
+
 
 @task
 def download():
@@ -352,6 +839,7 @@ def prepare():
     res = local('git status', capture=True)
     if 'nothing to commit, working directory clean' in res:
         local('git describe --tags > VERSION.txt')
+        build_data_map()
         local('~/env2/bin/python setup.py sdist --formats=gztar',
               capture=False)
     else:
@@ -1,20 +1,32 @@
 from pkg_resources import get_distribution
 from pyramid.config import Configurator
 from pyramid_zodbconn import get_connection
+from pyramid_dogpile_cache import get_region
 from price_watch.models import StorageManager
+from price_watch.dogpile import sync_region
+from price_watch.data_map import (configure_classification_cache,
+                                  CLASSIFICATION_CACHE_SIZE)
+from price_watch.archive import configure_archive
 
 __version__ = get_distribution('price_watch').version
 
 
 def root_factory(request):
     conn = get_connection(request)
-    return StorageManager(connection=conn)
+    keeper = StorageManager(connection=conn)
+    # the storage may be shared with other processes over ZEO
+    sync_region(get_region('general'), keeper)
+    return keeper
 
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
     """
     settings['version'] = __version__
+    configure_classification_cache(
+        settings.get('classification_cache.size', CLASSIFICATION_CACHE_SIZE),
+        settings.get('classification_cache.path'))
+    configure_archive(settings.get('archive.path'))
     config = Configurator(root_factory=root_factory, settings=settings)
     config.add_static_view('static', 'static', cache_max_age=3600)
     config.scan()
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import uuid
+import struct
+import datetime
+import numpy
+
+from price_watch.history import EPOCH, to_timestamp
+
+# report columns stored in the archive
+ARCHIVE_FIELDS = ('time', 'price', 'normalized_price', 'product', 'merchant',
+                  'reporter', 'url', 'uuid', 'sku')
+ARCHIVE_DTYPES = {
+    'time': numpy.int64,
+    'price': numpy.float64,
+    'normalized_price': numpy.float64,
+    'product': numpy.unicode_,
+    'merchant': numpy.unicode_,
+    'reporter': numpy.unicode_,
+    'url': numpy.unicode_,
+    'uuid': numpy.string_,
+    'sku': numpy.unicode_,
+}
+# reports older than that are moved to the archive by default
+ARCHIVE_AGE = datetime.timedelta(days=365)
+# reports per archive chunk
+ARCHIVE_CHUNK_SIZE = 10000
+MAGIC = 'PWA1'
+# magic, payload length, first and last report timestamps, row count
+HEADER = struct.Struct('<4sQqqQ')
+
+_archive = dict()
+
+
+class ArchiveError(Exception):
+    """Raised on a damaged archive file"""
+
+
+def get_report_row(report):
+    """Return archive row tuple (in `ARCHIVE_FIELDS` order) of the report"""
+    normalized_price = report.normalized_price_value
+    return (to_timestamp(report.date_time),
+            report.price_value,
+            numpy.nan if normalized_price is None else normalized_price,
+            report.product.key,
+            report.merchant.key,
+            report.reporter.key,
+            report.url or u'',
+            str(report.uuid),
+            getattr(report, 'sku', None) or u'')
+
+
+def get_empty_columns():
+    """Return dict of empty archive columns"""
+    return dict((field, numpy.empty(0, dtype=ARCHIVE_DTYPES[field]))
+                for field in ARCHIVE_FIELDS)
+
+
+class ArchivedReport(object):
+    """
+    Read-only price report restored from the archive. The product, merchant
+    and reporter are represented by their keys, `merchant` is set by the
+    caller to the merchant instance if known.
+    """
+
+    def __init__(self, time, price, normalized_price, product, merchant,
+                 reporter, url, uuid_, sku):
+        self.date_time = EPOCH + datetime.timedelta(microseconds=int(time))
+        self.price_value = float(price)
+        self.normalized_price_value = (None if numpy.isnan(normalized_price)
+                                       else float(normalized_price))
+        self.product_key = unicode(product)
+        self.merchant_key = unicode(merchant)
+        self.merchant = None
+        self.reporter_key = unicode(reporter)
+        self.url = unicode(url) or None
+        self.uuid = uuid.UUID(str(uuid_))
+        self.sku = unicode(sku) or None
+
+    @property
+    def key(self):
+        return str(self.uuid)
+
+    def __repr__(self):
+        return u'{}-{}-{}-{}'.format(self.price_value, self.product_key,
+                                     self.merchant_key, self.reporter_key)
+
+
+class ReportArchive(object):
+    """
+    Append-only file of the archived price reports. Reports are stored in
+    chunks of compressed NPZ columns, each preceded by a header with the
+    payload length, the report time range and the row count, so the range
+    queries skip the chunks without decompressing them.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._headers = None
+
+    def __len__(self):
+        return sum(header[4] for header in self.get_headers())
+
+    def get_headers(self):
+        """
+        Return list of `(offset, length, start, end, rows)` of the chunks.
+        An incomplete chunk at the end (interrupted append) is ignored.
+        """
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            return list()
+        if self._headers is not None and self._headers[0] == size:
+            return self._headers[1]
+        headers = list()
+        offset = 0
+        with open(self.path, 'rb') as archive_file:
+            while offset + HEADER.size <= size:
+                archive_file.seek(offset)
+                magic, length, start, end, rows = HEADER.unpack(
+                    archive_file.read(HEADER.size))
+                if magic != MAGIC:
+                    raise ArchiveError(
+                        'Bad chunk at {} of {}'.format(offset, self.path))
+                if offset + HEADER.size + length > size:
+                    break
+                headers.append((offset + HEADER.size, length, start, end,
+                                rows))
+                offset += HEADER.size + length
+        self._headers = size, headers
+        return headers
+
+    def append(self, rows):
+        """
+        Append chunk of rows (tuples in `ARCHIVE_FIELDS` order). The data is
+        synced to disk before return, so the archived reports can be safely
+        deleted from the storage afterwards.
+        """
+        if not rows:
+            return
+        columns = dict()
+        for field, values in zip(ARCHIVE_FIELDS, zip(*rows)):
+            columns[field] = numpy.array(values, dtype=ARCHIVE_DTYPES[field])
+        payload = io.BytesIO()
+        numpy.savez_compressed(payload, **columns)
+        payload = payload.getvalue()
+        headers = self.get_headers()
+        end = headers[-1][0] + headers[-1][1] if headers else 0
+        with open(self.path, 'ab') as archive_file:
+            # drop the incomplete chunk of an interrupted append
+            archive_file.truncate(end)
+            archive_file.write(HEADER.pack(
+                MAGIC, len(payload), int(columns['time'].min()),
+                int(columns['time'].max()), len(rows)))
+            archive_file.write(payload)
+            archive_file.flush()
+            os.fsync(archive_file.fileno())
+        self._headers = None
+
+    def read(self, start=None, end=None, product_keys=None):
+        """
+        Return dict of the archived report columns within the time range
+        (datetimes, inclusive, open if None), only of the `product_keys` if
+        provided, ordered by time
+        """
+        start = None if start is None else to_timestamp(start)
+        end = None if end is None else to_timestamp(end)
+        headers = [header for header in self.get_headers()
+                   if (start is None or header[3] >= start) and
+                   (end is None or header[2] <= end)]
+        if not headers:
+            return get_empty_columns()
+        chunks = list()
+        with open(self.path, 'rb') as archive_file:
+            for offset, length, first, last, rows in headers:
+                archive_file.seek(offset)
+                data = numpy.load(io.BytesIO(archive_file.read(length)))
+                columns = dict((field, data[field])
+                               for field in ARCHIVE_FIELDS)
+                mask = numpy.ones(len(columns['time']), dtype=bool)
+                if start is not None:
+                    mask &= columns['time'] >= start
+                if end is not None:
+                    mask &= columns['time'] <= end
+                if product_keys is not None:
+                    mask &= numpy.in1d(columns['product'],
+                                       numpy.array(list(product_keys),
+                                                   dtype=numpy.unicode_))
+                chunks.append(dict((field, column[mask])
+                                   for field, column in columns.items()))
+        columns = dict((field, numpy.concatenate([chunk[field]
+                                                  for chunk in chunks]))
+                       for field in ARCHIVE_FIELDS)
+        # a chunk is appended again if the storage commit failed after it
+        unique = numpy.unique(columns['uuid'], return_index=True)[1]
+        order = unique[numpy.argsort(columns['time'][unique],
+                                     kind='mergesort')]
+        return dict((field, column[order])
+                    for field, column in columns.items())
+
+    def get_reports(self, start=None, end=None, product_keys=None):
+        """Return list of `ArchivedReport` ordered by time"""
+        columns = self.read(start, end, product_keys)
+        return [ArchivedReport(*row) for row in
+                zip(*[columns[field] for field in ARCHIVE_FIELDS])]
+
+
+def configure_archive(path=None):
+    """Set up process-wide `ReportArchive`, no archive if `path` is None"""
+    archive = ReportArchive(path) if path else None
+    _archive['archive'] = archive
+    return archive
+
+
+def get_archive():
+    """Return process-wide `ReportArchive` or None if not configured"""
+    return _archive.get('archive')
@@ -0,0 +1,656 @@
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import time
+import atexit
+import tempfile
+import hashlib
+import logging
+import threading
+import cPickle as pickle
+import yaml
+
+from collections import OrderedDict
+
+from price_watch.exceptions import PackageRatioError
+
+DATA_MAP_PATH = os.path.join(os.path.dirname(__file__), 'data_map.yaml')
+
+# compiled `DataMap` snapshot format, bump on incompatible changes
+SNAPSHOT_FORMAT = 2
+
+# seconds between `data_map.yaml` modification checks
+CHECK_INTERVAL = 1
+
+# category attributes resolved from the nearest ancestor if not set
+INHERITED_ATTRIBUTES = ('primary_color', 'background_color')
+
+# package synonym must be preceded by one of these
+LOOK_BEHIND_PATTERNS = (
+    u'(?<!(\d(\.|,|х|x|\*|\-))|'
+    u'(\d{2})|(\+\s)|(\s\+)|(\d\+)|'
+    u'(\.|,|х|x|\*|\s)\d)',
+    u'(?<=фасов(\.))',
+    u'(?<=№\d(\.|,))',
+    u'(?<=№\d{2}(\.|,))',
+    u'(?<=№\d{3}(\.|,))',
+)
+LOOK_BEHIND = u'(?:{})'.format(u'|'.join(LOOK_BEHIND_PATTERNS))
+
+# default number of titles kept by `ClassificationCache`
+CLASSIFICATION_CACHE_SIZE = 10000
+CLASSIFICATION_CACHE_FORMAT = 1
+
+_registry = dict()
+_registry_lock = threading.Lock()
+_classification_cache = dict()
+
+log = logging.getLogger(__name__)
+
+
+def to_float(value):
+    """Return float from a `data_map.yaml` scalar or None if not set"""
+    if value is None:
+        return None
+    return float(value)
+
+
+def split_phrases(value):
+    """Split comma separated `data_map.yaml` phrase list"""
+    if not value:
+        return list()
+    return value.split(', ')
+
+
+def traverse(target, category_node, return_parent=False):
+    """
+    Recursively look for appropriate category from the tree in
+    `data_map.yaml`
+    """
+    try:
+        subcategories = category_node['sub']
+        if target in subcategories:
+            if return_parent:
+                return category_node
+            else:
+                return subcategories[target]
+        for key in subcategories:
+            match = traverse(target, subcategories[key],
+                             return_parent=return_parent)
+            if match:
+                return match
+    except (KeyError, TypeError):
+        pass
+    return None
+
+
+class Automaton(object):
+    """
+    Aho-Corasick automaton reporting which of the given phrases occur in a
+    string (as substrings) in a single pass over it
+    """
+
+    def __init__(self, phrases):
+        self.phrases = list(phrases)
+        self.goto = [dict()]
+        self.fail = [0]
+        self.output = [list()]
+        for index, phrase in enumerate(self.phrases):
+            state = 0
+            for char in phrase:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto[state][char] = next_state
+                    self.goto.append(dict())
+                    self.fail.append(0)
+                    self.output.append(list())
+                state = next_state
+            self.output[state].append(index)
+        queue = list(self.goto[0].values())
+        while queue:
+            state = queue.pop(0)
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state].extend(
+                    self.output[self.fail[next_state]])
+        self.output = [tuple(output) for output in self.output]
+
+    def find(self, string):
+        """Return set of indexes of the phrases found in the string"""
+        goto, fail, output = self.goto, self.fail, self.output
+        found = set()
+        state = 0
+        for char in string:
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                found.update(output[state])
+        return found
+
+
+class KeywordClassifier(object):
+    """
+    Compiled category keyword lookup. Returns the same category as
+    recursive `keyword_lookup` would: the first category in depth-first
+    order having all words of any of its keywords and none of the words of
+    its stopwords in the string.
+    """
+
+    def __init__(self, tree):
+        self.titles = list()
+        self.keywords = list()
+        self.stopwords = list()
+        parts = dict()
+
+        def part_id(part):
+            if part not in parts:
+                parts[part] = len(parts)
+            return parts[part]
+
+        def collect(node):
+            if 'keyword' in node:
+                self.titles.append(node.get('title'))
+                self.keywords.append(
+                    [frozenset(part_id(part) for part in phrase.split(' '))
+                     for phrase in split_phrases(node['keyword'])])
+                self.stopwords.append(frozenset(
+                    part_id(part) for phrase in split_phrases(
+                        node.get('stopword')) for part in phrase.split(' ')))
+            subcategories = node.get('sub') or dict()
+            for key in subcategories:
+                if subcategories[key]:
+                    collect(subcategories[key])
+
+        collect(tree)
+        self.automaton = Automaton(sorted(parts, key=parts.get))
+        # the empty string is always "in" a string
+        self.always_found = frozenset([parts['']]) if '' in parts else None
+        self.candidates = dict()
+        for rank, phrases in enumerate(self.keywords):
+            for phrase in phrases:
+                for part in phrase:
+                    self.candidates.setdefault(part, set()).add(rank)
+
+    def classify(self, title):
+        """Return category title for the product title or None"""
+        found = self.automaton.find(title.lower())
+        if self.always_found:
+            found.update(self.always_found)
+        ranks = set()
+        for part in found:
+            ranks.update(self.candidates.get(part, ()))
+        for rank in sorted(ranks):
+            if self.stopwords[rank] & found:
+                continue
+            for phrase in self.keywords[rank]:
+                if phrase <= found:
+                    return self.titles[rank]
+        return None
+
+    def classify_many(self, titles):
+        """Return list of category titles for the product titles"""
+        results = dict()
+        for title in titles:
+            if title not in results:
+                results[title] = self.classify(title)
+        return [results[title] for title in titles]
+
+
+def compute_ratio(package, category):
+    """
+    Return ratio of the package amount to the category's normal package
+    amount, converting units with the category `density` if needed. Raise
+    `PackageRatioError` if units can't be converted.
+    """
+    norm_amount, norm_unit = category.normal_package.split(' ')
+    pack_amount = package.amount
+    if norm_unit != package.unit:
+        if category.density is None:
+            raise PackageRatioError(package.title, category.title)
+        if package.unit == 'kg' and norm_unit == 'l':
+            m3 = pack_amount / category.density  # pack_amount is weight
+            pack_amount = m3 * 1000
+        elif package.unit == 'l' and norm_unit == 'kg':
+            pack_amount = category.density * pack_amount  # it is volume
+        else:
+            raise PackageRatioError(package.title, category.title)
+    return pack_amount / float(norm_amount)
+
+
+class PackageMatcher(object):
+    """
+    Compiled package lookup. Returns the same package as trying every
+    synonym of every package with every `LOOK_BEHIND_PATTERNS` would: the
+    first package in `data_map.yaml` order having a synonym in the title
+    and none of its `unlike` strings.
+    """
+
+    def __init__(self, packages):
+        self.titles = list(packages)
+        self.unlike = [packages[title].unlike for title in self.titles]
+        self.synonyms = list()
+        self.package_synonyms = list()
+        synonym_ids = dict()
+        for title in self.titles:
+            ids = list()
+            for synonym in packages[title].synonyms:
+                if synonym not in synonym_ids:
+                    synonym_ids[synonym] = len(self.synonyms)
+                    self.synonyms.append(synonym)
+                ids.append(synonym_ids[synonym])
+            self.package_synonyms.append(ids)
+        self.synonym_packages = [list() for synonym in self.synonyms]
+        for rank, ids in enumerate(self.package_synonyms):
+            for synonym_id in ids:
+                self.synonym_packages[synonym_id].append(rank)
+        self.automaton = Automaton(self.synonyms)
+        self._patterns = dict()
+
+    def __getstate__(self):
+        """Compiled patterns are not pickled, they are compiled on demand"""
+        state = self.__dict__.copy()
+        state['_patterns'] = dict()
+        return state
+
+    def pattern(self, synonym_id):
+        """Return compiled look-behind pattern for the synonym"""
+        try:
+            return self._patterns[synonym_id]
+        except KeyError:
+            pattern = re.compile(
+                LOOK_BEHIND + re.escape(self.synonyms[synonym_id]))
+            self._patterns[synonym_id] = pattern
+            return pattern
+
+    def resolve(self, title):
+        """Return package title for the product title or None"""
+        found = self.automaton.find(title)
+        ranks = set()
+        for synonym_id in found:
+            ranks.update(self.synonym_packages[synonym_id])
+        for rank in sorted(ranks):
+            if any(unlike in title for unlike in self.unlike[rank]):
+                continue
+            for synonym_id in self.package_synonyms[rank]:
+                if synonym_id in found and \
+                        self.pattern(synonym_id).search(title):
+                    return self.titles[rank]
+        return None
+
+    def resolve_packages(self, titles):
+        """Return list of package titles for the product titles"""
+        results = dict()
+        for title in titles:
+            if title not in results:
+                results[title] = self.resolve(title)
+        return [results[title] for title in titles]
+
+
+class PackageRecord(object):
+    """Compiled `ProductPackage` entry of `data_map.yaml`"""
+
+    def __init__(self, title, node):
+        self.title = title
+        self.node = node
+        amount, self.unit = title.split(' ')
+        self.amount = float(amount)
+        self.synonyms = node.get('synonyms', list())
+        self.unlike = node.get('unlike', list())
+
+    def get(self, attribute, default=None):
+        """Return raw attribute value as parsed from YAML"""
+        return self.node.get(attribute, default)
+
+
+class CategoryRecord(object):
+    """Compiled `ProductCategory` node of `data_map.yaml`"""
+
+    def __init__(self, title, node, parent=None):
+        self.title = title
+        self.node = node
+        self.parent = parent
+        self.parent_title = parent.get('title') if parent else None
+        self.ancestors = tuple()
+        if parent is not None:
+            self.ancestors = (parent,) + parent.ancestors
+        self.inherited = dict()
+        for attribute in INHERITED_ATTRIBUTES:
+            for record in (self,) + self.ancestors:
+                if attribute in record.node:
+                    self.inherited[attribute] = record.node[attribute]
+                    break
+        self.keywords = split_phrases(node.get('keyword'))
+        self.stopwords = split_phrases(node.get('stopword'))
+        self.normal_package = node.get('normal_package')
+        self.density = to_float(node.get('density'))
+        self.min_package_ratio = to_float(node.get('min_package_ratio'))
+        self.priority = to_float(node.get('priority'))
+
+    def get(self, attribute, default=None, inherit=False):
+        """
+        Return raw attribute value as parsed from YAML. With `inherit` the
+        `INHERITED_ATTRIBUTES` are taken from the nearest ancestor defining
+        them.
+        """
+        if inherit and attribute in self.inherited:
+            return self.inherited[attribute]
+        return self.node.get(attribute, default)
+
+
+class DataMap(object):
+    """
+    Compiled `data_map.yaml`. Parsed once per process and shared by all the
+    models, see `get_data_map`. Category records and package ratios are
+    resolved on the first lookup and memoized.
+    """
+
+    def __init__(self, raw, version=None):
+        self.raw = raw
+        self.version = version
+        self.mtime = None
+        self.checked = 0
+        self.tree = raw['ProductCategory']
+        self.packages = OrderedDict()
+        for title in raw['ProductPackage']:
+            self.packages[title] = PackageRecord(
+                title, raw['ProductPackage'][title])
+        self.root = CategoryRecord(self.tree.get('title'), self.tree)
+        self.nodes = dict()
+        self._index_categories(self.tree)
+        self.categories = dict()
+        self.ratios = dict()
+        self._unconvertible = None
+        self.classifier = KeywordClassifier(self.tree)
+        self.package_matcher = PackageMatcher(self.packages)
+
+    @classmethod
+    def from_yaml(cls, content, version=None):
+        """Compile from `data_map.yaml` contents"""
+        version = version or hashlib.md5(content).hexdigest()
+        return cls(yaml.safe_load(content), version)
+
+    def save_snapshot(self, path):
+        """
+        Save pickled snapshot of the compiled map. The header with the
+        format and the data map version is pickled separately so it can be
+        checked without loading the whole snapshot.
+        """
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as snapshot_file:
+            pickle.dump({'format': SNAPSHOT_FORMAT, 'version': self.version},
+                        snapshot_file, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(self, snapshot_file, pickle.HIGHEST_PROTOCOL)
+        os.rename(temp_path, path)
+
+    @classmethod
+    def load_snapshot(cls, path, version):
+        """
+        Return `DataMap` loaded from the snapshot or None if there is no
+        snapshot for the `version` in current format
+        """
+        try:
+            with open(path, 'rb') as snapshot_file:
+                header = pickle.load(snapshot_file)
+                if header != {'format': SNAPSHOT_FORMAT, 'version': version}:
+                    return None
+                return pickle.load(snapshot_file)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def __getitem__(self, node):
+        """Return raw top level node (`ProductPackage`, `ProductCategory`)"""
+        return self.raw[node]
+
+    def package(self, title):
+        """Return `PackageRecord` for the package title or None"""
+        return self.packages.get(title)
+
+    def _index_categories(self, parent, parent_title=None):
+        """
+        Flatten the category tree into `nodes` (title to node and parent
+        title, None for the root). Titles are registered in the same order
+        `traverse` finds them: all direct subcategories first, then their
+        subtrees.
+        """
+        subcategories = parent.get('sub') or dict()
+        children = list()
+        for title in subcategories:
+            node = subcategories[title]
+            if node:
+                self.nodes.setdefault(title, (node, parent_title))
+                children.append((title, node))
+        for title, node in children:
+            self._index_categories(node, title)
+
+    def category(self, title):
+        """Return `CategoryRecord` for the category title or None"""
+        record = self.categories.get(title)
+        if record is None and title in self.nodes:
+            node, parent_title = self.nodes[title]
+            if parent_title is None:
+                parent = self.root
+            else:
+                parent = self.category(parent_title)
+            record = self.categories.setdefault(
+                title, CategoryRecord(title, node, parent))
+        return record
+
+    def _get_ratio(self, package_title, category_title):
+        """
+        Return the package ratio for the category, None if it can't be
+        converted, `KeyError` if the package, the category or its normal
+        package is unknown
+        """
+        key = package_title, category_title
+        try:
+            return self.ratios[key]
+        except KeyError:
+            package = self.package(package_title)
+            category = self.category(category_title)
+            if package is None or category is None or \
+                    not category.normal_package:
+                raise
+            try:
+                ratio = compute_ratio(package, category)
+            except PackageRatioError:
+                ratio = None
+            return self.ratios.setdefault(key, ratio)
+
+    @property
+    def unconvertible(self):
+        """
+        Dict of category titles to the units of their packages that can't
+        be converted to the normal one, computed (and logged) on the first
+        access
+        """
+        if self._unconvertible is None:
+            unconvertible = dict()
+            for title in self.nodes:
+                for package_title in self.packages:
+                    try:
+                        ratio = self._get_ratio(package_title, title)
+                    except KeyError:
+                        break
+                    if ratio is None:
+                        unconvertible.setdefault(title, set()).add(
+                            self.packages[package_title].unit)
+            for title in sorted(unconvertible):
+                log.debug(u'Category "%s" packages in %s can not be '
+                          u'converted',
+                          title, ', '.join(sorted(unconvertible[title])))
+            self._unconvertible = unconvertible
+        return self._unconvertible
+
+    def package_ratio(self, package_title, category_title):
+        """
+        Return package ratio for the category or None if the package or
+        category is unknown. Raise `PackageRatioError` if the package can't
+        be converted.
+        """
+        try:
+            ratio = self._get_ratio(package_title, category_title)
+        except KeyError:
+            return None
+        if ratio is None:
+            raise PackageRatioError(package_title, category_title)
+        return ratio
+
+    def parent(self, title):
+        """Return parent `CategoryRecord` for the category title or None"""
+        record = self.category(title)
+        return record.parent if record else None
+
+    def ancestors(self, title):
+        """Return ancestor records of the category, closest first"""
+        record = self.category(title)
+        return record.ancestors if record else tuple()
+
+
+def get_snapshot_path(path):
+    """Return snapshot path for the `data_map.yaml` path"""
+    return os.path.splitext(path)[0] + '.snapshot'
+
+
+def build_snapshot(path=DATA_MAP_PATH):
+    """Compile `data_map.yaml` and save its snapshot. Return the snapshot path"""
+    with open(path, 'rb') as map_file:
+        data_map = DataMap.from_yaml(map_file.read())
+    snapshot_path = get_snapshot_path(path)
+    data_map.save_snapshot(snapshot_path)
+    return snapshot_path
+
+
+def get_data_map(path=DATA_MAP_PATH):
+    """
+    Return process-wide compiled `DataMap`. The file is checked for
+    modification at most once per `CHECK_INTERVAL` and reloaded only if its
+    contents have changed, from the snapshot if it is up to date.
+    """
+    data_map = _registry.get(path)
+    now = time.time()
+    if data_map is not None and now - data_map.checked < CHECK_INTERVAL:
+        return data_map
+    with _registry_lock:
+        data_map = _registry.get(path)
+        mtime = os.path.getmtime(path)
+        if data_map is None or data_map.mtime != mtime:
+            with open(path, 'rb') as map_file:
+                content = map_file.read()
+            version = hashlib.md5(content).hexdigest()
+            if data_map is None or data_map.version != version:
+                data_map = DataMap.load_snapshot(get_snapshot_path(path),
+                                                 version)
+                if data_map is None:
+                    data_map = DataMap.from_yaml(content, version)
+            data_map.mtime = mtime
+        data_map.checked = now
+        _registry[path] = data_map
+    return data_map
+
+
+class ClassificationCache(object):
+    """
+    Bounded LRU cache of product title classifications (category key,
+    package key, package ratio) keyed by the title and `DataMap.version`, so
+    entries of a changed `data_map.yaml` are never returned. Optionally
+    persisted to `path` between restarts.
+    """
+
+    def __init__(self, size=CLASSIFICATION_CACHE_SIZE, path=None):
+        self.size = size
+        self.path = path
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if path:
+            self.load()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, title, version):
+        """Return cached classification or None"""
+        key = (title, version)
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                return None
+            self._entries[key] = value
+            return value
+
+    def set(self, title, version, value):
+        """Store classification evicting the least recently used ones"""
+        key = (title, version)
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def load(self):
+        """
+        Load entries saved to `path` if there are any. A missing or corrupt
+        file leaves the cache empty.
+        """
+        try:
+            with open(self.path, 'rb') as cache_file:
+                saved = pickle.load(cache_file)
+            if saved.get('format') != CLASSIFICATION_CACHE_FORMAT:
+                return
+            entries = list(saved['entries'])
+        except Exception:
+            return
+        for key, value in entries:
+            self.set(key[0], key[1], value)
+
+    def save(self, version=None):
+        """
+        Save entries to `path`, only those of the data map `version` if
+        given
+        """
+        with self._lock:
+            entries = [(key, value) for key, value in self._entries.items()
+                       if version is None or key[1] == version]
+        # a temporary file of its own, as the workers sharing `path` save
+        # on exit at the same time
+        handle, temp_path = tempfile.mkstemp(
+            dir=os.path.dirname(os.path.abspath(self.path)),
+            prefix=os.path.basename(self.path) + '.')
+        try:
+            with os.fdopen(handle, 'wb') as cache_file:
+                pickle.dump({'format': CLASSIFICATION_CACHE_FORMAT,
+                             'entries': entries}, cache_file, 2)
+            os.rename(temp_path, self.path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+
+def configure_classification_cache(size=CLASSIFICATION_CACHE_SIZE, path=None):
+    """
+    Set up process-wide `ClassificationCache`. With `path` it is loaded from
+    disk and saved back (current data map entries only) on exit.
+    """
+    cache = _classification_cache.get('cache')
+    if cache is not None and (cache.size, cache.path) == (int(size), path):
+        return cache
+    cache = ClassificationCache(int(size), path)
+    _classification_cache['cache'] = cache
+    if path:
+        atexit.register(lambda: cache.save(get_data_map().version))
+    return cache
+
+
+def get_classification_cache():
+    """Return process-wide `ClassificationCache`"""
+    try:
+        return _classification_cache['cache']
+    except KeyError:
+        return configure_classification_cache()
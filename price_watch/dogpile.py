@@ -1,17 +1,23 @@
-import threading
+import weakref
+
+# root counter bumped on the cache invalidation in any of the processes
+CACHE_GENERATION = 'cache_generation'
+
+_generations = weakref.WeakKeyDictionary()
 
 
 def creation_runner(cache, somekey, creator, mutex):
-    """Used by dogpile.core:Lock when appropriate"""
-    def runner():
-        try:
-            value = creator()
-            cache.set(somekey, value)
-        finally:
-            mutex.release()
- 
-    thread = threading.Thread(target=runner)
-    thread.start()
+    """
+    Used by dogpile.core:Lock when appropriate. The creator reads the
+    storage through the connection of the request, which is closed once the
+    request is served, so the value is created in the requesting thread
+    while the concurrent requests are served the stale one.
+    """
+    try:
+        value = creator()
+        cache.set(somekey, value)
+    finally:
+        mutex.release()
 
 
 def unicode_key_generator(namespace, fn, **kwargs):
@@ -31,4 +37,28 @@ def unicode_key_generator(namespace, fn, **kwargs):
                              '_'.join(str(a) for a in clean_args))
         return key
 
-    return generate_key
\ No newline at end of file
+    return generate_key
+
+
+def invalidate_region(region, storage_manager):
+    """
+    Soft invalidate the region in this process and the other processes
+    sharing the storage (on their next `sync_region`)
+    """
+    counter = storage_manager.get_counter(CACHE_GENERATION)
+    counter.change(1)
+    _generations[region] = counter()
+    region.invalidate(hard=False)
+
+
+def sync_region(region, storage_manager):
+    """
+    Soft invalidate the region if it was invalidated by another process
+    since the last sync. Reads the counter only, so it may run on each
+    request.
+    """
+    generation = storage_manager.get_counter_value(CACHE_GENERATION)
+    last_generation = _generations.get(region)
+    _generations[region] = generation
+    if last_generation is not None and last_generation != generation:
+        region.invalidate(hard=False)
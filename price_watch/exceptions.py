@@ -5,4 +5,17 @@ class MultidictError(Exception):
     """
     def __init__(self):
         message = u'Bad multidict: value counts not equal'
-        Exception.__init__(self, message)
\ No newline at end of file
+        Exception.__init__(self, message)
+
+
+class PackageRatioError(TypeError):
+    """
+    Raised when a package amount can't be converted to the category's normal
+    package units (e.g. no `density` for the category in `data_map.yaml`)
+    """
+    def __init__(self, package_title, category_title):
+        message = u'Package "{}" can not be converted to normal package ' \
+                  u'of category "{}"'.format(package_title, category_title)
+        TypeError.__init__(self, message)
+        self.package_title = package_title
+        self.category_title = category_title
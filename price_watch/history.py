@@ -0,0 +1,1731 @@
+# -*- coding: utf-8 -*-
+
+import bisect
+import datetime
+import heapq
+import numpy
+import os
+import zlib
+
+from persistent import Persistent
+from BTrees import OOBTree
+from BTrees.Length import Length
+from ZODB.POSException import ConflictError
+
+# rows per persistent chunk, only the last chunk is rewritten on append, so
+# a report writes at most this many rows however long the history is
+CHUNK_SIZE = 256
+CHUNK_COLUMNS = ('times', 'prices', 'products', 'merchants')
+EPOCH = datetime.datetime(1970, 1, 1)
+DAY = 86400 * 10 ** 6
+# chunks are partitioned by the week of the report time
+WEEK = 7 * DAY
+# max number of cached column ranges
+COLUMNS_CACHE_SIZE = 16
+DAILY_FIELDS = ('median', 'min', 'max', 'reports', 'products')
+PRODUCT_ROLLUP_FIELDS = ('median', 'min', 'max')
+STATISTICS_FIELDS = ('count', 'min', 'p10', 'p25', 'median', 'p75', 'p90',
+                     'max', 'iqr')
+# rollup resolutions with their approximate length in days
+RESOLUTIONS = (('day', 1), ('week', 7), ('month', 30.44))
+# the finest resolution giving not more points is chosen for a range
+MAX_POINTS = 100
+# values per block of `OrderStatistic`
+ORDER_STATISTIC_LOAD = 256
+# id-indexed tables of products and merchants kept in `HistoryTables`
+HISTORY_TABLES = ('products', 'product_ids', 'product_ratios',
+                  'product_active', 'product_first', 'merchant_ids',
+                  'merchant_locations')
+# product and merchant ids are int32, a pair of them is packed in an int64
+MAX_ID = 0x7fffffff
+PAIR_FACTOR = 1 << 32
+# max number of completed days a write persists the rollups of, the rest
+# are caught up by the following writes
+CATCH_UP_DAYS = 366
+
+
+def to_timestamp(date_time):
+    """Return naive `date_time` as integer microseconds since the epoch"""
+    delta = date_time - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+def to_microseconds(delta):
+    """Return `timedelta` as integer microseconds"""
+    return (delta.days * 86400 + delta.seconds) * 10 ** 6 + delta.microseconds
+
+
+def get_day(time):
+    """Return the day ordinal of the timestamp"""
+    return EPOCH.toordinal() + int(time // DAY)
+
+
+def get_day_end(day):
+    """Return the last moment of the day given as ordinal"""
+    return datetime.datetime.combine(
+        datetime.date.fromordinal(day + 1),
+        datetime.time()) - datetime.timedelta.resolution
+
+
+def get_period(day, resolution):
+    """Return the first day ordinal of the day's week or month"""
+    if resolution == 'week':
+        return day - datetime.date.fromordinal(day).weekday()
+    if resolution == 'month':
+        return datetime.date.fromordinal(day).replace(day=1).toordinal()
+    return day
+
+
+def get_period_end(period, resolution):
+    """Return the last day ordinal of the period"""
+    if resolution == 'week':
+        return period + 6
+    if resolution == 'month':
+        date = datetime.date.fromordinal(period)
+        if date.month == 12:
+            return date.replace(year=date.year + 1, month=1).toordinal() - 1
+        return date.replace(month=date.month + 1).toordinal() - 1
+    return period
+
+
+def get_periods(first_day, last_day, resolution):
+    """Return list of the periods covering the day ordinals range"""
+    periods = list()
+    period = get_period(first_day, resolution)
+    while period <= last_day:
+        periods.append(period)
+        period = get_period_end(period, resolution) + 1
+    return periods
+
+
+def get_runs(days):
+    """Return list of the runs of consecutive days of the sorted ordinals"""
+    runs = list()
+    for day in days:
+        if runs and runs[-1][-1] == day - 1:
+            runs[-1].append(day)
+        else:
+            runs.append([day])
+    return runs
+
+
+def get_resolution(days):
+    """Return the finest resolution for the range of `days` to chart"""
+    for resolution, length in RESOLUTIONS:
+        if days / length <= MAX_POINTS:
+            return resolution
+    return RESOLUTIONS[-1][0]
+
+
+def aggregate_daily(entries):
+    """
+    Return rollup tuple of daily ones: median of the medians, min and max,
+    total report count and max product count (None if no entries)
+    """
+    if not entries:
+        return None
+    priced = [entry for entry in entries if entry[0] is not None]
+    aggregates = (None, None, None)
+    if priced:
+        aggregates = (round(numpy.median([entry[0] for entry in priced]), 2),
+                      min(entry[1] for entry in priced),
+                      max(entry[2] for entry in priced))
+    return aggregates + (sum(entry[3] for entry in entries),
+                         max(entry[4] for entry in entries))
+
+
+def new_version():
+    """
+    Return a unique token for chunk versions and keys, so the states of
+    aborted or concurrent changes of a chunk never share a version and the
+    chunks started concurrently never share a key
+    """
+    return os.urandom(8)
+
+
+def get_table_id(key):
+    """Return the preferred product or merchant id by its key"""
+    return zlib.crc32(u'{}'.format(key).encode('utf-8')) & MAX_ID
+
+
+def _same(value, other):
+    """
+    Compare the values of the conflicting states, the persistent references
+    to different objects can't be compared
+    """
+    try:
+        return value == other
+    except ValueError:
+        return False
+
+
+def merge_tables(old, committed, new):
+    """
+    Return dict merging the changes of the `committed` and `new` states of
+    the `old` dict, raise `ConflictError` if an entry is changed differently
+    """
+    missing = object()
+    merged = dict(committed)
+    for key in set(old) | set(new):
+        value = new.get(key, missing)
+        original = old.get(key, missing)
+        if _same(value, original):
+            continue
+        current = committed.get(key, missing)
+        if _same(value, current):
+            continue
+        if not _same(current, original):
+            raise ConflictError
+        if value is missing:
+            del merged[key]
+        else:
+            merged[key] = value
+    return merged
+
+
+def _append(array, value):
+    """Return `array` with `value` appended keeping the dtype"""
+    return numpy.concatenate((array, numpy.array([value], dtype=array.dtype)))
+
+
+def group_medians(groups, values):
+    """
+    Return unique `groups` and medians of their `values` (the same way
+    `numpy.median` computes them)
+    """
+    return group_rollups(groups, values)[:2]
+
+
+def group_rollups(groups, values):
+    """
+    Return unique `groups` and medians (as `group_medians`), minimums and
+    maximums of their `values`
+    """
+    order = numpy.lexsort((values, groups))
+    groups = groups[order]
+    values = values[order]
+    if not len(groups):
+        return groups, values, values, values
+    starts = numpy.flatnonzero(numpy.concatenate(
+        ([True], groups[1:] != groups[:-1])))
+    counts = numpy.diff(numpy.append(starts, len(groups)))
+    medians = (values[starts + (counts - 1) // 2] +
+               values[starts + counts // 2]) / 2
+    return (groups[starts], medians, values[starts],
+            values[starts + counts - 1])
+
+
+def get_percentiles(values, percents):
+    """
+    Return percentiles of the sorted `values` array with linear
+    interpolation as in `numpy.percentile`
+    """
+    ranks = numpy.asarray(percents, dtype=numpy.float64) / 100 * \
+        (len(values) - 1)
+    below = numpy.floor(ranks).astype(numpy.int64)
+    above = numpy.minimum(below + 1, len(values) - 1)
+    weights = ranks - below
+    return values[below] * (1 - weights) + values[above] * weights
+
+
+def get_statistics(values):
+    """
+    Return tuple of count, min, p10, p25, median, p75, p90, max and IQR of
+    the sorted `values` array (prices are rounded) or None if it's empty
+    """
+    if not len(values):
+        return None
+    p10, p25, median, p75, p90 = [
+        round(value, 2) for value
+        in get_percentiles(values, (10, 25, 50, 75, 90))]
+    return (len(values), float(values[0]), p10, p25, median, p75, p90,
+            float(values[-1]), round(p75 - p25, 2))
+
+
+class OrderStatistic(object):
+    """
+    Sorted multiset of values kept as a blocked sorted list: sorted blocks of
+    `load` to `2 * load` values with their maxima and a Fenwick tree of the
+    block sizes. Insertion and removal bisect the maxima and shift values of
+    one block only, selection by position (min, max, median, percentiles)
+    descends the tree, so both are O(log n) with at most `2 * load` values
+    moved. Blocks are split or merged once in `load` updates, the tree is
+    rebuilt lazily after that.
+    """
+
+    def __init__(self, values=(), load=ORDER_STATISTIC_LOAD):
+        self.load = load
+        values = sorted(values)
+        self._blocks = [values[start:start + load]
+                        for start in range(0, len(values), load)]
+        self._maxes = [block[-1] for block in self._blocks]
+        self._length = len(values)
+        self._index = None
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        """Return the value at the position in sorted order"""
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(u'OrderStatistic index out of range')
+        position, offset = self._locate(index)
+        return self._blocks[position][offset]
+
+    @property
+    def values(self):
+        """Sorted list of the values"""
+        return [value for block in self._blocks for value in block]
+
+    def _build_index(self):
+        """Build the Fenwick tree of the block sizes"""
+        index = [0] * (len(self._blocks) + 1)
+        for position, block in enumerate(self._blocks, 1):
+            index[position] += len(block)
+            parent = position + (position & -position)
+            if parent < len(index):
+                index[parent] += index[position]
+        self._index = index
+
+    def _update_index(self, position, delta):
+        """Account changed size of the block in the tree if it's built"""
+        if self._index is None:
+            return
+        position += 1
+        while position < len(self._index):
+            self._index[position] += delta
+            position += position & -position
+
+    def _locate(self, index):
+        """Return position of the block and offset in it of a value index"""
+        if self._index is None:
+            self._build_index()
+        position = 0
+        step = 1 << (len(self._index) - 1).bit_length()
+        while step:
+            if position + step < len(self._index) and \
+                    self._index[position + step] <= index:
+                position += step
+                index -= self._index[position]
+            step >>= 1
+        return position, index
+
+    def add(self, value):
+        """Add the value"""
+        self._length += 1
+        if not self._blocks:
+            self._blocks.append([value])
+            self._maxes.append(value)
+            self._index = None
+            return
+        position = bisect.bisect_left(self._maxes, value)
+        if position == len(self._maxes):
+            position -= 1
+            self._blocks[position].append(value)
+            self._maxes[position] = value
+        else:
+            bisect.insort(self._blocks[position], value)
+        block = self._blocks[position]
+        if len(block) > 2 * self.load:
+            self._blocks[position:position + 1] = [block[:self.load],
+                                                   block[self.load:]]
+            self._maxes[position:position + 1] = [block[self.load - 1],
+                                                  block[-1]]
+            self._index = None
+        else:
+            self._update_index(position, 1)
+
+    def remove(self, value):
+        """Remove an occurrence of the value, `ValueError` if there's none"""
+        position = bisect.bisect_left(self._maxes, value)
+        if position < len(self._maxes):
+            block = self._blocks[position]
+            offset = bisect.bisect_left(block, value)
+            if block[offset] == value:
+                del block[offset]
+                self._length -= 1
+                self._update_index(position, -1)
+                if len(block) < self.load // 2:
+                    self._merge(position)
+                else:
+                    self._maxes[position] = block[-1]
+                return
+        raise ValueError(u'{} is not in OrderStatistic'.format(value))
+
+    def _merge(self, position):
+        """Merge the small block with a neighbour splitting it if needed"""
+        block = self._blocks[position]
+        if len(self._blocks) == 1:
+            if block:
+                self._maxes[0] = block[-1]
+            else:
+                del self._blocks[:]
+                del self._maxes[:]
+                self._index = None
+            return
+        if position == len(self._blocks) - 1:
+            position -= 1
+        block = self._blocks[position] + self._blocks[position + 1]
+        blocks = [block]
+        if len(block) > 2 * self.load:
+            blocks = [block[:self.load], block[self.load:]]
+        self._blocks[position:position + 2] = blocks
+        self._maxes[position:position + 2] = [part[-1] for part in blocks]
+        self._index = None
+
+    def min(self):
+        return self[0]
+
+    def max(self):
+        return self[-1]
+
+    def median(self):
+        """Median computed the same way as `numpy.median`"""
+        count = self._length
+        return (self[(count - 1) // 2] + self[count // 2]) / 2
+
+    def percentile(self, percent):
+        """Percentile with linear interpolation as in `numpy.percentile`"""
+        rank = percent / 100.0 * (self._length - 1)
+        below = int(rank)
+        above = min(below + 1, self._length - 1)
+        weight = rank - below
+        return self[below] * (1 - weight) + self[above] * weight
+
+
+class CurrentPrices(object):
+    """
+    Current qualified product prices of a `PriceHistory` for a location kept
+    in an `OrderStatistic`. Holds the last report of each product and
+    merchant; the reports expiring after the history lifetime are dropped
+    lazily on read. Not persistent, lives in a volatile history attribute.
+    """
+
+    def __init__(self, history, location=None):
+        self.history = history
+        self.location = location
+        self.lifetime = to_microseconds(history.lifetime)
+        self.versions = history.get_current_versions()
+        self.pairs = dict()
+        self.prices = dict()
+        self.expiries = list()
+        self.statistic = OrderStatistic()
+        now = datetime.datetime.now()
+        columns, rows = history.get_current_rows(now, history.lifetime,
+                                                 location)
+        for row in rows:
+            merchants = self.pairs.setdefault(int(columns['product'][row]),
+                                              dict())
+            merchants[int(columns['merchant'][row])] = (
+                int(columns['time'][row]), float(columns['price'][row]))
+        now = to_timestamp(now)
+        for product_id in self.pairs.keys():
+            self.update_product(product_id, now)
+
+    def add_row(self, time, price, product_id, merchant_id):
+        """
+        Account a new row. Return False if the row can't be accounted
+        (reported for the future) and the prices should be rebuilt
+        """
+        if self.location and \
+                self.history.merchant_locations[merchant_id] != self.location:
+            return True
+        now = to_timestamp(datetime.datetime.now())
+        if time > now:
+            return False
+        if time <= now - self.lifetime:
+            return True
+        merchants = self.pairs.setdefault(product_id, dict())
+        current = merchants.get(merchant_id)
+        if current is None or current[0] <= time:
+            merchants[merchant_id] = (time, price)
+            self.update_product(product_id, now)
+        return True
+
+    def update_product(self, product_id, now=None):
+        """Recompute product price dropping the expired reports"""
+        now = now or to_timestamp(datetime.datetime.now())
+        merchants = self.pairs.get(product_id, dict())
+        for merchant_id, (time, price) in merchants.items():
+            if time <= now - self.lifetime:
+                del merchants[merchant_id]
+        price = None
+        if merchants:
+            price = numpy.median([merchant_price for time, merchant_price
+                                  in merchants.values()])
+            expiry = min(time for time, merchant_price in merchants.values())
+            heapq.heappush(self.expiries, (expiry + self.lifetime,
+                                           product_id))
+        else:
+            self.pairs.pop(product_id, None)
+        old_price = self.prices.pop(product_id, None)
+        if old_price is not None:
+            self.statistic.remove(old_price)
+        if price and self.history.is_qualified(product_id):
+            self.prices[product_id] = price
+            self.statistic.add(price)
+
+    def refresh(self):
+        """Drop the expired reports"""
+        now = to_timestamp(datetime.datetime.now())
+        while self.expiries and self.expiries[0][0] <= now:
+            expiry, product_id = heapq.heappop(self.expiries)
+            self.update_product(product_id, now)
+
+
+class HistoryChunk(Persistent):
+    """
+    Part of the price history columns of at most `CHUNK_SIZE` rows reported
+    within the same week. The `version` token is replaced on each change.
+    """
+
+    def __init__(self):
+        self.times = numpy.empty(0, dtype=numpy.int64)
+        self.prices = numpy.empty(0, dtype=numpy.float64)
+        self.products = numpy.empty(0, dtype=numpy.int32)
+        self.merchants = numpy.empty(0, dtype=numpy.int32)
+        self.version = new_version()
+
+    def __len__(self):
+        return len(self.times)
+
+    def append(self, time, price, product_id, merchant_id):
+        """Append a row"""
+        self.times = _append(self.times, time)
+        self.prices = _append(self.prices, price)
+        self.products = _append(self.products, product_id)
+        self.merchants = _append(self.merchants, merchant_id)
+        self.version = new_version()
+
+    def find(self, time, price, product_id, merchant_id):
+        """Return the row index or None"""
+        found = numpy.flatnonzero((self.times == time) &
+                                  (self.products == product_id) &
+                                  (self.merchants == merchant_id) &
+                                  (self.prices == price))
+        return found[0] if len(found) else None
+
+    def delete(self, index):
+        """Delete the row"""
+        self.times = numpy.delete(self.times, index)
+        self.prices = numpy.delete(self.prices, index)
+        self.products = numpy.delete(self.products, index)
+        self.merchants = numpy.delete(self.merchants, index)
+        self.version = new_version()
+
+    def _p_resolveConflict(self, old, committed, new):
+        """Merge the rows appended concurrently, deletions conflict"""
+        rows = len(old['times'])
+        for state in (committed, new):
+            for name in CHUNK_COLUMNS:
+                if not numpy.array_equal(state[name][:rows], old[name]):
+                    raise ConflictError
+        resolved = dict(committed)
+        for name in CHUNK_COLUMNS:
+            resolved[name] = numpy.concatenate((committed[name],
+                                                new[name][rows:]))
+        resolved['version'] = new_version()
+        return resolved
+
+
+class HistoryTables(Persistent):
+    """
+    Product and merchant tables of a `PriceHistory`: the products, their
+    package ratios, activity and first report times and the merchant
+    locations by id and the ids by key. The ids are derived from the keys, so the products and merchants
+    registered concurrently are merged as well as the changes of different
+    entries. The `version` token is replaced on each change.
+    """
+
+    def __init__(self):
+        for name in HISTORY_TABLES:
+            setattr(self, name, dict())
+        self.version = new_version()
+
+    @classmethod
+    def from_lists(cls, state):
+        """
+        Return tables of a history state stored before the tables were
+        split, its ids are the positions in the lists
+        """
+        tables = cls()
+        for name in HISTORY_TABLES:
+            table = state.get(name) or ()
+            if isinstance(table, dict):
+                setattr(tables, name, dict(table))
+            else:
+                setattr(tables, name, dict(enumerate(table)))
+        return tables
+
+    def changed(self):
+        """Mark the tables changed replacing the version"""
+        self._p_changed = True
+        self.version = new_version()
+        self._v_arrays = None
+
+    def _get_id(self, key, table):
+        """Return a free id for the key"""
+        entity_id = get_table_id(key)
+        while entity_id in table:
+            entity_id = (entity_id + 1) & MAX_ID
+        return entity_id
+
+    def add_product(self, product):
+        """Register the product, return its id"""
+        product_id = self._get_id(product.key, self.products)
+        self.product_ids[product.key] = product_id
+        self.products[product_id] = product
+        self.product_ratios[product_id] = None
+        self.product_active[product_id] = True
+        self.product_first[product_id] = None
+        self.changed()
+        return product_id
+
+    def move_first(self, product_id, time):
+        """Move the first report time of the product back to `time`"""
+        first = self.product_first.get(product_id)
+        if first is None or time < first:
+            self.product_first[product_id] = time
+            self.changed()
+
+    def add_merchant(self, key, location):
+        """Register the merchant by key, return its id"""
+        merchant_id = self._get_id(key, self.merchant_locations)
+        self.merchant_ids[key] = merchant_id
+        self.merchant_locations[merchant_id] = location
+        self.changed()
+        return merchant_id
+
+    def get_arrays(self):
+        """
+        Return dict of the sorted product ids and their package ratio and
+        activity arrays. The result is cached until the tables change.
+        """
+        arrays = getattr(self, '_v_arrays', None)
+        if arrays is None:
+            product_ids = sorted(self.product_active)
+            ratios = [self.product_ratios.get(product_id)
+                      for product_id in product_ids]
+            arrays = self._v_arrays = {
+                'product': numpy.array(product_ids, dtype=numpy.int32),
+                'ratio': numpy.array([numpy.nan if ratio is None else ratio
+                                      for ratio in ratios],
+                                     dtype=numpy.float64),
+                'active': numpy.array([self.product_active[product_id]
+                                       for product_id in product_ids],
+                                      dtype=bool),
+                'locations': dict(),
+            }
+        return arrays
+
+    def get_location_ids(self, location):
+        """Return sorted array of the ids of the merchants in `location`"""
+        locations = self.get_arrays()['locations']
+        ids = locations.get(location)
+        if ids is None:
+            ids = locations[location] = numpy.array(sorted(
+                merchant_id for merchant_id, merchant_location
+                in self.merchant_locations.items()
+                if merchant_location == location), dtype=numpy.int32)
+        return ids
+
+    def _p_resolveConflict(self, old, committed, new):
+        """Merge the changes of different entries of the tables"""
+        if set(old) != set(committed) or set(old) != set(new):
+            raise ConflictError
+        resolved = dict(committed)
+        for name in HISTORY_TABLES:
+            resolved[name] = merge_tables(old[name], committed[name],
+                                          new[name])
+        resolved['version'] = new_version()
+        return resolved
+
+
+class RollupYear(Persistent):
+    """
+    Persisted rollups of a location or a product for a year: dict of
+    `(resolution, period)` to the rollup tuples. The concurrent changes of
+    different periods are merged, the same period is computed from the same
+    rows by both writers, so the same result is accepted as well.
+    """
+
+    def __init__(self):
+        self.entries = dict()
+
+    def _p_resolveConflict(self, old, committed, new):
+        """Merge the changes of different entries"""
+        resolved = dict(committed)
+        resolved['entries'] = merge_tables(old['entries'],
+                                           committed['entries'],
+                                           new['entries'])
+        return resolved
+
+
+class RollupMark(Persistent):
+    """
+    The last day ordinal the rollups are persisted through (None if not
+    yet) and the min package ratio they were computed for
+    """
+
+    def __init__(self, min_package_ratio=None):
+        self.through = None
+        self.min_package_ratio = min_package_ratio
+
+    def _p_resolveConflict(self, old, committed, new):
+        """Keep the latest of the marks of the same ratio"""
+        if committed['min_package_ratio'] != new['min_package_ratio']:
+            raise ConflictError
+        resolved = dict(committed)
+        if committed['through'] is None or (
+                new['through'] is not None and
+                new['through'] > committed['through']):
+            resolved['through'] = new['through']
+        return resolved
+
+
+def _table(name):
+    """Return read-only property of a `HistoryTables` table"""
+    return property(lambda self: getattr(self.get_tables(), name),
+                    doc='`HistoryTables.{}`'.format(name))
+
+
+def lookup(keys, values):
+    """
+    Return indexes of the `values` in the sorted `keys` array and the
+    boolean array of the values found
+    """
+    if not len(keys):
+        return (numpy.zeros(len(values), dtype=numpy.intp),
+                numpy.zeros(len(values), dtype=bool))
+    indexes = numpy.minimum(numpy.searchsorted(keys, values), len(keys) - 1)
+    return indexes, keys[indexes] == values
+
+
+class PriceHistory(Persistent):
+    """
+    Columnar store of a product category price reports: parallel arrays of
+    timestamps, normalized prices, product ids and merchant ids. Products
+    and merchants are kept in id-indexed `HistoryTables` along with the
+    package ratios and the locations, so price queries are answered with
+    vectorized NumPy operations without loading reports from the storage.
+    The tables are a persistent object of their own merging the concurrent
+    changes, new reports don't rewrite the history itself.
+
+    The rows are partitioned into weekly chunks kept in a BTree by
+    `(week, part, token)`, so the current price queries load only the chunks
+    of the report lifetime window and the historical ones only the requested
+    range. The unique token lets the writers starting a part concurrently
+    add their chunks without a conflict, the chunks of a part are filled in
+    turn (`(week, part)` keys of the chunks stored before are kept).
+
+    The daily rollup gives for a location and day the median, min and max
+    price at the end of the day, the number of reports of the day and the
+    number of priced products. Weekly and monthly rollups aggregate the
+    daily ones, product rollups aggregate the end of day prices of a
+    product. The rollups of the completed days, weeks and months are
+    persisted by the writes in `RollupYear` entries of the locations and
+    the products: a write recomputes the days its rows change (the report
+    day and the lifetime after it) and catches up the days completed since
+    the last write. The reports of the current day change nothing
+    persisted, its rollup is taken from the current prices. The reads never
+    write, the days not persisted yet are computed by weeks and kept in
+    volatile caches along with the versions of the chunks they were
+    computed from.
+
+    The histories stored before the tables were split keep them in lists of
+    their own state, the tables are moved on the first write.
+    """
+
+    tables = None
+    # created on the first write of the histories stored before the
+    # rollups were persisted
+    location_years = None
+    product_years = None
+    rollup_mark = None
+
+    products = _table('products')
+    product_ids = _table('product_ids')
+    product_ratios = _table('product_ratios')
+    product_active = _table('product_active')
+    product_first = _table('product_first')
+    merchant_ids = _table('merchant_ids')
+    merchant_locations = _table('merchant_locations')
+
+    def __init__(self, lifetime, min_package_ratio=None):
+        self.lifetime = lifetime
+        self.min_package_ratio = min_package_ratio
+        self.buckets = OOBTree.BTree()
+        self.tables = HistoryTables()
+        self.report_count = Length()
+        self.location_years = OOBTree.BTree()
+        self.product_years = OOBTree.BTree()
+        self.rollup_mark = RollupMark(min_package_ratio)
+
+    def __len__(self):
+        return self.get_report_count()()
+
+    def get_report_count(self):
+        """
+        Return `Length` counter of the rows, counted on the first access for
+        the histories stored before it was introduced
+        """
+        if getattr(self, 'report_count', None) is None:
+            self.report_count = Length(
+                sum(len(chunk) for chunk in self.buckets.values()))
+        return self.report_count
+
+    def get_tables(self, write=False):
+        """
+        Return `HistoryTables`, the ones of a history stored before they
+        were split are built from its lists and moved on the first `write`
+        along with the first report times found in the columns
+        """
+        tables = self.tables
+        if tables is None:
+            tables = getattr(self, '_v_tables', None)
+            if tables is None:
+                tables = self._v_tables = HistoryTables.from_lists(
+                    self.__dict__)
+            if write:
+                columns = self.get_columns()
+                order = numpy.lexsort((columns['time'], columns['product']))
+                product_ids, first = numpy.unique(
+                    columns['product'][order], return_index=True)
+                tables.product_first.update(zip(
+                    product_ids.tolist(),
+                    columns['time'][order][first].tolist()))
+                for name in HISTORY_TABLES:
+                    self.__dict__.pop(name, None)
+                self.tables = tables
+                self._v_tables = None
+        return tables
+
+    def _changed(self):
+        self.get_tables(write=True).changed()
+
+    def _stale(self):
+        """Drop the current prices and the category rollups to be rebuilt"""
+        self._v_current = None
+        self._v_daily = None
+        self._v_product_rollups = None
+
+    def get_chunks(self, start=None, end=None):
+        """
+        Return list of `(key, chunk)` of the weeks overlapping the time range
+        (timestamps, open if None)
+        """
+        min_key = max_key = None
+        if start is not None:
+            min_key = (start // WEEK,)
+        if end is not None:
+            max_key = (end // WEEK + 1,)
+        return list(self.buckets.items(min=min_key, max=max_key,
+                                       excludemax=max_key is not None))
+
+    def get_versions(self, start=None, end=None):
+        """Return tuple of the chunk keys and versions of the time range"""
+        return tuple((key, chunk.version)
+                     for key, chunk in self.get_chunks(start, end))
+
+    def get_current_versions(self):
+        """
+        Return versions of the chunks that may contain current reports: the
+        ones of the lifetime window and the later ones
+        """
+        now = to_timestamp(datetime.datetime.now())
+        return (self.get_tables().version,) + self.get_versions(
+            now - to_microseconds(self.lifetime))
+
+    def get_chunk(self, time):
+        """
+        Return a chunk of the last part of the week with room for a new row,
+        start the next part if they are full
+        """
+        week = time // WEEK
+        try:
+            last = self.buckets.maxKey((week + 1,))
+        except ValueError:
+            last = None
+        part = 0
+        if last is not None and last[0] == week:
+            # the chunks of the part started concurrently are filled in turn
+            for key, chunk in self.buckets.items(min=(week, last[1]),
+                                                 max=last):
+                if len(chunk) < CHUNK_SIZE:
+                    return chunk
+            part = last[1] + 1
+        chunk = self.buckets[(week, part, new_version())] = HistoryChunk()
+        return chunk
+
+    def is_qualified(self, product_id):
+        """Check product to be in the category and fit the package ratio"""
+        if not self.product_active.get(product_id):
+            return False
+        if self.min_package_ratio:
+            ratio = self.product_ratios[product_id]
+            return ratio is not None and ratio >= float(self.min_package_ratio)
+        return True
+
+    def _get_product_id(self, product, time=None):
+        """
+        Return product id registering the product if needed, the `time` of
+        its report moves the first report time back
+        """
+        tables = self.get_tables(write=True)
+        product_id = tables.product_ids.get(product.key)
+        if product_id is None:
+            product_id = tables.add_product(product)
+        ratio = getattr(product, 'package_ratio', None)
+        if tables.product_ratios[product_id] != ratio:
+            tables.product_ratios[product_id] = ratio
+            tables.changed()
+            for current in (getattr(self, '_v_current', None) or
+                            dict()).values():
+                current.update_product(product_id)
+            self._update_product_rollups(product_id)
+        if time is not None:
+            tables.move_first(product_id, time)
+        return product_id
+
+    def _get_merchant_id(self, merchant):
+        """Return merchant id registering the merchant if needed"""
+        merchant_id = self.merchant_ids.get(merchant.key)
+        if merchant_id is None:
+            merchant_id = self.get_tables(write=True).add_merchant(
+                merchant.key, merchant.location)
+        return merchant_id
+
+    def _update_product_rollups(self, product_id):
+        """
+        Recompute the category rollups of the days since the first report of
+        the product which qualification changed
+        """
+        first = self.get_tables(write=True).product_first.get(product_id)
+        if first is not None:
+            self.update_rollups(first, to_timestamp(datetime.datetime.now()),
+                                product_ids=())
+
+    def add_product(self, product):
+        """Add product and its reports (if the product is new)"""
+        if product.key in self.product_ids:
+            product_id = self._get_product_id(product)
+            if not self.product_active[product_id]:
+                self.get_tables(write=True).product_active[product_id] = True
+                self._changed()
+                self._stale()
+                self._update_product_rollups(product_id)
+        else:
+            product_id = self._get_product_id(product)
+            reports = getattr(product, 'reports', list())
+            # the rollups are updated once for all the reports
+            deferred = getattr(self, '_v_deferred', False)
+            self._v_deferred = True
+            try:
+                for report in reports:
+                    self.add_report(report)
+            finally:
+                self._v_deferred = deferred
+            if len(reports):
+                self._stale()
+                times = [to_timestamp(report.date_time) for report in reports]
+                self.update_rollups(min(times), max(times), [product_id])
+
+    def remove_product(self, product):
+        """Exclude the product from the price calculations"""
+        product_id = self.product_ids.get(product.key)
+        if product_id is not None and self.product_active[product_id]:
+            self.get_tables(write=True).product_active[product_id] = False
+            self._stale()
+            self._changed()
+            self._update_product_rollups(product_id)
+
+    def update_merchant(self, merchant, old_key=None):
+        """Update merchant key and location"""
+        merchant_id = self.merchant_ids.get(old_key or merchant.key)
+        if merchant_id is None:
+            return
+        if old_key and old_key != merchant.key:
+            tables = self.get_tables(write=True)
+            del tables.merchant_ids[old_key]
+            tables.merchant_ids[merchant.key] = merchant_id
+            self._changed()
+        old_location = self.merchant_locations[merchant_id]
+        if old_location != merchant.location:
+            self.get_tables(write=True).merchant_locations[merchant_id] = \
+                merchant.location
+            self._stale()
+            self._changed()
+            try:
+                first = self.buckets.minKey()[0] * WEEK
+            except ValueError:
+                return
+            self.update_rollups(first, to_timestamp(datetime.datetime.now()),
+                                product_ids=(),
+                                locations=[old_location or None])
+
+    def add_report(self, report):
+        """Append report row"""
+        # the current prices look the new product or merchant up themselves
+        versions = self.get_current_versions()
+        time = to_timestamp(report.date_time)
+        product_id = self._get_product_id(report.product, time)
+        merchant_id = self._get_merchant_id(report.merchant)
+        self.update_merchant(report.merchant)
+        row = (time, report.normalized_price_value, product_id, merchant_id)
+        self.get_chunk(row[0]).append(*row)
+        self.get_report_count().change(1)
+        current_prices = getattr(self, '_v_current', None) or dict()
+        for location, current in current_prices.items():
+            if current.versions == versions and current.add_row(*row):
+                current.versions = self.get_current_versions()
+            else:
+                del current_prices[location]
+        self.update_rollups(time, product_ids=[product_id])
+
+    def remove_report(self, report):
+        """Delete report row"""
+        product_id = self.product_ids.get(report.product.key)
+        merchant_id = self.merchant_ids.get(report.merchant.key)
+        if product_id is None or merchant_id is None:
+            return
+        time = to_timestamp(report.date_time)
+        for key, chunk in self.get_chunks(time, time):
+            index = chunk.find(time, report.normalized_price_value,
+                               product_id, merchant_id)
+            if index is not None:
+                chunk.delete(index)
+                self.get_report_count().change(-1)
+                self._v_current = None
+                self.update_rollups(time, product_ids=[product_id])
+                return
+
+    def rebuild(self, products):
+        """
+        Rebuild the store from products and their reports along with all
+        the persisted rollups
+        """
+        self.__init__(self.lifetime, self.min_package_ratio)
+        # flat chunk list of the histories stored before partitioning, the
+        # rollups stored before they were cached and the tables stored
+        # before they were split
+        for name in ('chunks', 'daily', 'rollups', 'product_rollups',
+                     'day_marks') + HISTORY_TABLES:
+            self.__dict__.pop(name, None)
+        self._changed()
+        self._v_deferred = True
+        try:
+            for product in products:
+                self.add_product(product)
+        finally:
+            self._v_deferred = False
+        self._stale()
+        self.update_rollups(catch_up=None)
+
+    def add_archived(self, columns, merchants=None):
+        """
+        Append rows of the archived reports (`ReportArchive.read` columns)
+        of the registered products. The merchants not registered yet are
+        looked up in `merchants` dict by key for their locations.
+        """
+        merchants = merchants or dict()
+        product_ids = set()
+        for time, price, product_key, merchant_key in zip(
+                columns['time'], columns['normalized_price'],
+                columns['product'], columns['merchant']):
+            product_id = self.product_ids.get(unicode(product_key))
+            if product_id is None:
+                continue
+            merchant_key = unicode(merchant_key)
+            merchant_id = self.merchant_ids.get(merchant_key)
+            if merchant_id is None:
+                merchant_id = self.get_tables(write=True).add_merchant(
+                    merchant_key,
+                    getattr(merchants.get(merchant_key), 'location', None))
+            self.get_chunk(int(time)).append(int(time), float(price),
+                                             product_id, merchant_id)
+            self.get_tables(write=True).move_first(product_id, int(time))
+            self.get_report_count().change(1)
+            product_ids.add(product_id)
+        if product_ids:
+            self._changed()
+            self._stale()
+            self.update_rollups(int(min(columns['time'])),
+                                int(max(columns['time'])), product_ids)
+
+    def get_current_prices(self, location=None):
+        """
+        Return up to date `CurrentPrices` for the location. It is rebuilt
+        from the columns if the history was changed by another connection.
+        """
+        current_prices = getattr(self, '_v_current', None)
+        if current_prices is None:
+            current_prices = self._v_current = dict()
+        current = current_prices.get(location or u'')
+        if current is None or \
+                current.versions != self.get_current_versions():
+            current = CurrentPrices(self, location)
+            current_prices[location or u''] = current
+        current.refresh()
+        return current
+
+    def get_rollups_through(self):
+        """
+        Return the last day ordinal the rollups are persisted through or
+        None if they are not or were computed for another package ratio
+        """
+        mark = self.rollup_mark
+        if mark is None or mark.min_package_ratio != self.min_package_ratio:
+            return None
+        return mark.through
+
+    def get_persisted(self, years, key, resolution, periods):
+        """
+        Return dict of the periods to the rollup tuples persisted in the
+        `years` tree for the location or product `key` (None if nothing is
+        known)
+        """
+        entries = dict()
+        persisted = dict()
+        for period in periods:
+            year = datetime.date.fromordinal(period).year
+            if year not in entries:
+                rollup_year = None
+                if years is not None:
+                    rollup_year = years.get((key, year))
+                entries[year] = getattr(rollup_year, 'entries', dict())
+            persisted[period] = entries[year].get((resolution, period))
+        return persisted
+
+    def _store(self, years, key, resolution, period, entry):
+        """Persist the rollup tuple of the period, drop it if None"""
+        year_key = (key, datetime.date.fromordinal(period).year)
+        rollup_year = years.get(year_key)
+        if rollup_year is None:
+            if entry is None:
+                return
+            rollup_year = years[year_key] = RollupYear()
+        if rollup_year.entries.get((resolution, period)) != entry:
+            if entry is None:
+                del rollup_year.entries[(resolution, period)]
+            else:
+                rollup_year.entries[(resolution, period)] = entry
+            rollup_year._p_changed = True
+
+    def update_rollups(self, since=None, until=None, product_ids=None,
+                       locations=(), catch_up=CATCH_UP_DAYS):
+        """
+        Persist the rollups of the days completed since the last update (at
+        most `catch_up` days, all if None) and recompute the ones of the
+        days changed by the rows from `since` to `until` (timestamps,
+        `until` is `since` if not given) along with the product rollups of
+        the `product_ids` (all if None) and the category ones of the extra
+        `locations`. The weeks and months are persisted once they complete.
+        """
+        if getattr(self, '_v_deferred', False):
+            return
+        try:
+            first_day = get_day(self.buckets.minKey()[0] * WEEK)
+        except ValueError:
+            return
+        if self.location_years is None:
+            self.location_years = OOBTree.BTree()
+            self.product_years = OOBTree.BTree()
+        mark = self.rollup_mark
+        if mark is None:
+            mark = self.rollup_mark = RollupMark(self.min_package_ratio)
+        elif mark.min_package_ratio != self.min_package_ratio:
+            mark.min_package_ratio = self.min_package_ratio
+            mark.through = None
+        yesterday = datetime.date.today().toordinal() - 1
+        through = first_day - 1 if mark.through is None else mark.through
+        last = yesterday
+        if catch_up is not None:
+            last = min(yesterday, through + catch_up)
+        days = set(range(through + 1, last + 1))
+        # product ids of the periods to persist, None for all of them
+        product_periods = dict()
+        for resolution, length in RESOLUTIONS[1:]:
+            for period in get_periods(through + 1, last, resolution):
+                if through < get_period_end(period, resolution) <= last:
+                    product_periods[(resolution, period)] = None
+        if since is not None:
+            if until is None:
+                until = since
+            changed = range(get_day(since), min(
+                get_day(until + to_microseconds(self.lifetime)),
+                yesterday) + 1)
+            days.update(changed)
+            for resolution, length in RESOLUTIONS[1:]:
+                if not changed or product_ids == ():
+                    break
+                for period in get_periods(changed[0], changed[-1],
+                                          resolution):
+                    key = (resolution, period)
+                    if get_period_end(period, resolution) > yesterday:
+                        continue
+                    if product_ids is None or (
+                            key in product_periods and
+                            product_periods[key] is None):
+                        product_periods[key] = None
+                    else:
+                        product_periods[key] = \
+                            set(product_periods.get(key, ())) | \
+                            set(product_ids)
+        if mark.through is None or last > mark.through:
+            mark.through = last
+        if not days and not product_periods:
+            return
+        swept = set(days)
+        for resolution, period in product_periods:
+            swept.update(range(period,
+                               get_period_end(period, resolution) + 1))
+        locations = [None] + sorted(set(
+            location for location
+            in list(self.merchant_locations.values()) + list(locations)
+            if location))
+        for run in get_runs(sorted(swept)):
+            results = self.sweep_locations(
+                [get_day_end(day) for day in run], self.lifetime, locations)
+            indexes = [index for index, day in enumerate(run) if day in days]
+            if indexes:
+                run_days = [run[index] for index in indexes]
+                self._store_daily(self._compute_daily(
+                    run_days, locations, dict(
+                        (location, [results[location][index]
+                                    for index in indexes])
+                        for location in locations)), run_days, yesterday)
+            prices = dict(zip(run, results[None]))
+            for (resolution, period), ids in product_periods.items():
+                if period not in prices:
+                    continue
+                period_prices = [
+                    prices[day] for day
+                    in range(period, get_period_end(period, resolution) + 1)]
+                groups, medians, mins, maxs = group_rollups(
+                    numpy.concatenate([entry[0] for entry in period_prices]),
+                    numpy.concatenate([entry[1] for entry in period_prices]))
+                rollups = dict(
+                    (product_id, (round(median, 2), float(low), float(high)))
+                    for product_id, median, low, high
+                    in zip(groups.tolist(), medians, mins, maxs))
+                for product_id in (rollups if ids is None else ids):
+                    self._store(self.product_years, int(product_id),
+                                resolution, period, rollups.get(product_id))
+
+    def _store_daily(self, daily, days, yesterday):
+        """
+        Persist the location rollups of the sorted day ordinals computed by
+        `_compute_daily` and of the completed weeks and months overlapping
+        them
+        """
+        for location, entries in daily.items():
+            key = location or u''
+            for day in days:
+                self._store(self.location_years, key, 'day', day,
+                            entries.get(day))
+            for resolution, length in RESOLUTIONS[1:]:
+                for period in get_periods(days[0], days[-1], resolution):
+                    end = get_period_end(period, resolution)
+                    if end > yesterday:
+                        continue
+                    persisted = self.get_persisted(
+                        self.location_years, key, 'day',
+                        range(period, end + 1))
+                    self._store(self.location_years, key, resolution, period,
+                                aggregate_daily([
+                                    entry for entry in persisted.values()
+                                    if entry is not None]))
+
+    def _get_rollup_versions(self, first_day, last_day):
+        """
+        Return versions of the chunks the end of day prices and the report
+        counts of the day ordinals range are computed from
+        """
+        return (self.get_tables().version,) + self.get_versions(
+            to_timestamp(get_day_end(first_day - 1)) -
+            to_microseconds(self.lifetime),
+            to_timestamp(get_day_end(last_day)))
+
+    def get_rollup(self, resolution, period, location=None):
+        """
+        Return rollup tuple (as the daily one) of the period given by its
+        first day ordinal or None
+        """
+        return self.get_rollups(resolution, [period], location)[0]
+
+    def get_rollups(self, resolution, periods, location=None):
+        """
+        Return list of rollup tuples (as the daily one, None if nothing is
+        known) of the periods given by their first day ordinals
+        """
+        return self.get_location_rollups(resolution, periods,
+                                         [location])[location]
+
+    def get_location_rollups(self, resolution, periods, locations=(None,)):
+        """
+        Return dict of the locations to the lists of rollup tuples of the
+        periods (as `get_rollups`). The persisted ones are read, the rest
+        are aggregated from the daily ones up to the current day.
+        """
+        if not periods:
+            return dict((location, list()) for location in locations)
+        through = self.get_rollups_through()
+        done = list()
+        if through is not None:
+            done = [period for period in periods
+                    if get_period_end(period, resolution) <= through]
+        persisted = dict(
+            (location, self.get_persisted(self.location_years,
+                                          location or u'', resolution, done))
+            for location in locations)
+        missing = [period for period in periods if period not in done]
+        ranges = dict((location, dict()) for location in locations)
+        if missing:
+            ranges = self.get_daily_ranges(
+                min(missing), min(get_period_end(max(missing), resolution),
+                                  datetime.date.today().toordinal()),
+                locations)
+        return dict((location, [
+            persisted[location][period] if period in persisted[location]
+            else aggregate_daily([
+                ranges[location][day] for day
+                in range(period, get_period_end(period, resolution) + 1)
+                if day in ranges[location]]) for period in periods])
+            for location in locations)
+
+    def get_product_rollups(self, product_id, resolution, periods):
+        """
+        Return list of tuples of median, min and max of the product end of
+        day prices within each of the periods given by their first day
+        ordinals (None if unknown) up to the current day. The persisted
+        weeks and months are read, the missing ones are computed in one
+        sweep; daily ones are not cached.
+        """
+        cache = getattr(self, '_v_product_rollups', None)
+        if cache is None:
+            cache = self._v_product_rollups = dict()
+        rollups = dict()
+        through = self.get_rollups_through()
+        if through is not None and resolution != 'day':
+            for period, rollup in self.get_persisted(
+                    self.product_years, product_id, resolution,
+                    [period for period in periods
+                     if get_period_end(period, resolution) <= through]
+                    ).items():
+                rollups[period] = rollup or ()
+        versions = dict()
+        for period in periods:
+            if period in rollups:
+                continue
+            versions[period] = self._get_rollup_versions(
+                period, get_period_end(period, resolution))
+            if resolution != 'day':
+                cached = cache.get((resolution, product_id, period))
+                if cached is not None and cached[0] == versions[period]:
+                    rollups[period] = cached[1]
+        missing = [period for period in periods if period not in rollups]
+        if missing:
+            today = datetime.date.today().toordinal()
+            days = [day for period in missing for day in range(
+                period, min(get_period_end(period, resolution), today) + 1)]
+            prices = dict(zip(days, self.get_product_series(
+                product_id, [get_day_end(day) for day in days])))
+            for period in missing:
+                period_prices = [
+                    prices[day] for day in range(
+                        period, min(get_period_end(period, resolution),
+                                    today) + 1)
+                    if prices[day] is not None]
+                rollup = ()
+                if period_prices:
+                    rollup = (round(numpy.median(period_prices), 2),
+                              min(period_prices), max(period_prices))
+                rollups[period] = rollup
+                if resolution != 'day':
+                    cache[(resolution, product_id, period)] = (
+                        versions[period], rollup)
+        return [rollups[period] or None for period in periods]
+
+    def get_daily_range(self, first_day, last_day, location=None):
+        """
+        Return dict of day ordinals to the daily rollup tuples within the
+        range for the location
+        """
+        return self.get_daily_ranges(first_day, last_day,
+                                     [location])[location]
+
+    def get_daily_ranges(self, first_day, last_day, locations=(None,)):
+        """
+        Return dict of the locations to the dicts of day ordinals to the
+        daily rollup tuples within the range. The persisted days are read
+        and the current one is taken from the current prices. The rest are
+        cached by weeks, the weeks which chunks changed since are recomputed
+        in one sweep for all the locations.
+        """
+        ranges = dict((location, dict()) for location in locations)
+        computed_first = first_day
+        through = self.get_rollups_through()
+        if through is not None and through >= first_day:
+            computed_first = min(through, last_day) + 1
+            for location in locations:
+                for day, entry in self.get_persisted(
+                        self.location_years, location or u'', 'day',
+                        range(first_day, computed_first)).items():
+                    if entry is not None:
+                        ranges[location][day] = entry
+        today = datetime.date.today().toordinal()
+        for first, last in ((computed_first, min(last_day, today - 1)),
+                            (max(computed_first, today + 1), last_day)):
+            if first <= last:
+                for location, daily in self._get_computed_daily(
+                        first, last, locations).items():
+                    ranges[location].update(daily)
+        if computed_first <= today <= last_day:
+            for location in locations:
+                entry = self.get_current_daily(location)
+                if entry is not None:
+                    ranges[location][today] = entry
+        return ranges
+
+    def _get_computed_daily(self, first_day, last_day, locations):
+        """
+        Return dict of the locations to the dicts of day ordinals to the
+        daily rollup tuples computed within the range
+        """
+        cache = getattr(self, '_v_daily', None)
+        if cache is None:
+            cache = self._v_daily = dict()
+        weeks = dict()
+        missing = set()
+        for week in get_periods(first_day, last_day, 'week'):
+            versions = self._get_rollup_versions(week, week + 6)
+            for location in locations:
+                cached = cache.get((location or u'', week))
+                if cached is None or cached[0] != versions:
+                    weeks[week] = versions
+                    missing.add(location or None)
+        if weeks:
+            computed = self._compute_daily(
+                [week + day for week in sorted(weeks) for day in range(7)],
+                sorted(missing))
+            for location, entries in computed.items():
+                for week, versions in weeks.items():
+                    cache[(location or u'', week)] = (versions, dict(
+                        (day, entries[day]) for day in range(week, week + 7)
+                        if day in entries))
+        ranges = dict()
+        for location in locations:
+            daily = ranges[location] = dict()
+            for week in get_periods(first_day, last_day, 'week'):
+                for day, entry in cache[(location or u'', week)][1].items():
+                    if first_day <= day <= last_day:
+                        daily[day] = entry
+        return ranges
+
+    def get_current_daily(self, location=None):
+        """
+        Return rollup tuple (as the daily one) of the current day: the
+        statistic of the current prices and the number of the reports of the
+        day so far (None if neither)
+        """
+        statistic = self.get_current_prices(location).statistic
+        today = datetime.date.today().toordinal()
+        start = to_timestamp(get_day_end(today - 1))
+        columns = self.get_columns(start, to_timestamp(get_day_end(today)))
+        mask = columns['time'] > start
+        if location:
+            mask &= self.get_merchant_mask(columns['merchant'], location)
+        count = int(numpy.count_nonzero(mask))
+        if not len(statistic) and not count:
+            return None
+        aggregates = (None, None, None)
+        if len(statistic):
+            aggregates = (round(statistic.median(), 2),
+                          float(statistic.min()), float(statistic.max()))
+        return aggregates + (count, len(statistic))
+
+    def get_daily(self, day, location=None):
+        """
+        Return daily rollup tuple `(median, min, max, report count, product
+        count)` for the day ordinal or None
+        """
+        return self.get_daily_range(day, day, location).get(day)
+
+    def _compute_daily(self, days, locations=(None,), results=None):
+        """
+        Return dict of the locations to the dicts of the rollup entries of
+        the sorted day ordinals, the `sweep_locations` results of the day
+        ends are swept here if not given
+        """
+        entries = dict((location, dict()) for location in locations)
+        if not len(days):
+            return entries
+        if results is None:
+            results = self.sweep_locations(
+                [get_day_end(day) for day in days], self.lifetime, locations)
+        columns = self.get_columns(
+            to_timestamp(get_day_end(min(days) - 1)),
+            to_timestamp(get_day_end(max(days))))
+        for location in locations:
+            times = columns['time']
+            if location:
+                times = times[self.get_merchant_mask(columns['merchant'],
+                                                     location)]
+            report_days = numpy.sort(EPOCH.toordinal() + times // DAY)
+            starts = numpy.searchsorted(report_days, days, side='left')
+            ends = numpy.searchsorted(report_days, days, side='right')
+            for day, (product_ids, prices), count in zip(
+                    days, results[location], ends - starts):
+                prices = prices[self.qualify(product_ids, prices,
+                                             self.min_package_ratio)]
+                if len(prices) or count:
+                    if len(prices):
+                        aggregates = (round(numpy.median(prices), 2),
+                                      float(prices.min()),
+                                      float(prices.max()))
+                    else:
+                        aggregates = (None, None, None)
+                    entries[location][day] = aggregates + (int(count),
+                                                           len(prices))
+        return entries
+
+    def get_columns(self, start=None, end=None):
+        """
+        Return dict of the concatenated columns of the weeks overlapping the
+        time range (timestamps, open if None). The result is cached until
+        any of its chunks changes.
+        """
+        chunks = self.get_chunks(start, end)
+        versions = tuple((key, chunk.version) for key, chunk in chunks)
+        cache = getattr(self, '_v_columns', None)
+        if cache is None or len(cache) > COLUMNS_CACHE_SIZE:
+            cache = self._v_columns = dict()
+        weeks = (None if start is None else start // WEEK,
+                 None if end is None else end // WEEK)
+        columns = cache.get(weeks)
+        if columns is not None and columns['versions'] == versions:
+            return columns
+
+        def concatenate(name, dtype):
+            arrays = [getattr(chunk, name) for key, chunk in chunks]
+            if not arrays:
+                return numpy.empty(0, dtype=dtype)
+            return numpy.concatenate(arrays)
+
+        columns = {
+            'versions': versions,
+            'time': concatenate('times', numpy.int64),
+            'price': concatenate('prices', numpy.float64),
+            'product': concatenate('products', numpy.int32),
+            'merchant': concatenate('merchants', numpy.int32),
+        }
+        cache[weeks] = columns
+        return columns
+
+    def get_merchant_mask(self, merchant_ids, location=None):
+        """Return boolean array of the merchant ids being in `location`"""
+        if not location:
+            return numpy.ones(len(merchant_ids), dtype=bool)
+        return numpy.in1d(merchant_ids,
+                          self.get_tables().get_location_ids(location))
+
+    def get_current_rows(self, date_time, lifetime, location=None):
+        """
+        Return columns of the lifetime window and row indexes of the last
+        reports of each product and merchant known to `date_time` and not
+        older than `lifetime`
+        """
+        time = to_timestamp(date_time)
+        lifetime = to_microseconds(lifetime)
+        columns = self.get_columns(time - lifetime, time)
+        mask = columns['time'] <= time
+        if location:
+            mask &= self.get_merchant_mask(columns['merchant'], location)
+        rows = numpy.flatnonzero(mask)
+        pairs = (columns['product'][rows].astype(numpy.int64) *
+                 PAIR_FACTOR + columns['merchant'][rows])
+        order = numpy.lexsort((columns['time'][rows], pairs))
+        rows = rows[order]
+        pairs = pairs[order]
+        last = numpy.concatenate((pairs[1:] != pairs[:-1], [True]))
+        rows = rows[last[:len(rows)]]
+        return columns, rows[columns['time'][rows] > time - lifetime]
+
+    def get_last_prices(self, date_time, location=None, product_ids=None,
+                        lookback=None):
+        """
+        Return arrays of sorted product ids and the prices of their last
+        reports known to `date_time` regardless of the report lifetime, of
+        the `product_ids` only if given and within the `lookback` if given.
+        The lifetime window is read first, the products missing there are
+        looked up in the preceding spans doubled each time but no further
+        back than their first reports, so the rows read depend on the
+        products and not on the length of the history.
+        """
+        time = to_timestamp(date_time)
+        tables = self.get_tables()
+        wanted = dict()
+        for product_id in (tables.products if product_ids is None
+                           else product_ids):
+            # the first reports of the tables moved from the lists of the
+            # histories stored before they were split are unknown until a
+            # write
+            first = tables.product_first.get(int(product_id), 0)
+            if first is not None and first <= time:
+                wanted[int(product_id)] = first
+        limit = None
+        if lookback is not None:
+            limit = time - to_microseconds(lookback)
+        span = to_microseconds(self.lifetime)
+        end = time
+        found_ids = [numpy.empty(0, dtype=numpy.int32)]
+        found_prices = [numpy.empty(0, dtype=numpy.float64)]
+        while wanted:
+            start = max(end - span, min(wanted.values()) - 1)
+            if limit is not None:
+                start = max(start, limit)
+            columns = self.get_columns(start, end)
+            mask = (columns['time'] > start) & (columns['time'] <= end)
+            mask &= numpy.in1d(columns['product'], list(wanted))
+            if location:
+                mask &= self.get_merchant_mask(columns['merchant'], location)
+            rows = numpy.flatnonzero(mask)
+            products = columns['product'][rows]
+            rows = rows[numpy.lexsort((columns['time'][rows], products))]
+            products = columns['product'][rows]
+            last = numpy.concatenate((products[1:] != products[:-1], [True]))
+            rows = rows[last[:len(rows)]]
+            found_ids.append(columns['product'][rows])
+            found_prices.append(columns['price'][rows])
+            for product_id in columns['product'][rows].tolist():
+                del wanted[product_id]
+            if start == limit or (wanted and start < min(wanted.values())):
+                break
+            end = start
+            span *= 2
+        product_ids = numpy.concatenate(found_ids)
+        order = numpy.argsort(product_ids)
+        return product_ids[order], numpy.concatenate(found_prices)[order]
+
+    def get_price_deltas(self, since, date_time, location=None):
+        """
+        Return arrays of ids of the products reported within the lifetime to
+        `date_time` with their last prices, their last prices known to
+        `since` (NaN if none) and the relative deltas (zero if not
+        comparable)
+        """
+        product_ids, prices = self.get_last_prices(date_time, location,
+                                                   lookback=self.lifetime)
+        base_ids, base_prices = self.get_last_prices(since, location,
+                                                     product_ids)
+        indexes, found = lookup(base_ids, product_ids)
+        base = numpy.full(len(product_ids), numpy.nan)
+        base[found] = base_prices[indexes[found]]
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            deltas = (prices - base) / base
+        deltas[~numpy.isfinite(deltas)] = 0
+        return product_ids, prices, base, deltas
+
+    def get_product_prices(self, date_time, lifetime, location=None,
+                           min_package_ratio=None):
+        """
+        Return arrays of product ids and their prices (median over the
+        merchants) known to `date_time` for the qualified products
+        """
+        columns, rows = self.get_current_rows(date_time, lifetime, location)
+        product_ids, prices = group_medians(columns['product'][rows],
+                                            columns['price'][rows])
+        qualified = self.qualify(product_ids, prices, min_package_ratio)
+        return product_ids[qualified], prices[qualified]
+
+    def qualify(self, product_ids, prices, min_package_ratio=None):
+        """
+        Return boolean array of the products in the category with non-zero
+        prices and package ratio not less than `min_package_ratio`
+        """
+        arrays = self.get_tables().get_arrays()
+        indexes, found = lookup(arrays['product'], product_ids)
+        indexes = indexes[found]
+        qualified = found & (prices != 0)
+        qualified[found] &= arrays['active'][indexes]
+        if min_package_ratio:
+            with numpy.errstate(invalid='ignore'):
+                qualified[found] &= (arrays['ratio'][indexes] >=
+                                     float(min_package_ratio))
+        return qualified
+
+    def get_price_series(self, dates, lifetime, location=None,
+                         min_package_ratio=None):
+        """Return list of qualified product price arrays for the `dates`"""
+        return [prices[self.qualify(product_ids, prices, min_package_ratio)]
+                for product_ids, prices in self.sweep(dates, lifetime,
+                                                      location)]
+
+    def get_product_series(self, product_id, dates):
+        """Return list of the product prices (or None) for the `dates`"""
+        return [float(prices[0]) if len(prices) else None
+                for product_ids, prices in self.sweep(
+                    dates, self.lifetime, product_id=product_id)]
+
+    def sweep(self, dates, lifetime, location=None, product_id=None):
+        """
+        Return list of arrays of product ids and their prices (median over
+        the merchants) for each of the `dates`
+        """
+        return self.sweep_locations(dates, lifetime, [location],
+                                    product_id)[location]
+
+    def sweep_locations(self, dates, lifetime, locations, product_id=None):
+        """
+        Return dict of the `locations` (None for all of them) to lists of
+        arrays of product ids and their prices (median over the merchants
+        there) for each of the `dates`, sweeping the rows once in date order
+        for all the locations and keeping the last report of each product
+        and merchant
+        """
+        result = dict((location, [None] * len(dates))
+                      for location in locations)
+        if not len(dates):
+            return result
+        lifetime = to_microseconds(lifetime)
+        columns = self.get_columns(to_timestamp(min(dates)) - lifetime,
+                                   to_timestamp(max(dates)))
+        rows = numpy.argsort(columns['time'], kind='mergesort')
+        if all(locations):
+            rows = rows[numpy.in1d(columns['merchant'][rows], [
+                merchant_id for location in locations for merchant_id
+                in self.get_tables().get_location_ids(location)])]
+        if product_id is not None:
+            rows = rows[columns['product'][rows] == product_id]
+        times = columns['time'][rows]
+        pairs = (columns['product'][rows].astype(numpy.int64) *
+                 PAIR_FACTOR + columns['merchant'][rows])
+        pair_keys, pairs = numpy.unique(pairs, return_inverse=True)
+        pair_products = (pair_keys // PAIR_FACTOR).astype(numpy.int32)
+        pair_masks = dict(
+            (location, self.get_merchant_mask(pair_keys % PAIR_FACTOR,
+                                              location))
+            for location in locations)
+        current = numpy.empty(len(pair_keys), dtype=numpy.int64)
+        current.fill(-1)
+        position = 0
+        for index in sorted(range(len(dates)), key=lambda i: dates[i]):
+            time = to_timestamp(dates[index])
+            end = numpy.searchsorted(times, time, side='right')
+            if end > position:
+                # the last row of each pair within the swept segment
+                segment = numpy.arange(end - 1, position - 1, -1)
+                segment_pairs, first = numpy.unique(pairs[segment],
+                                                    return_index=True)
+                current[segment_pairs] = segment[first]
+                position = end
+            known = numpy.flatnonzero(current >= 0)
+            known = known[times[current[known]] > time - lifetime]
+            for location in locations:
+                selected = known[pair_masks[location][known]]
+                result[location][index] = group_medians(
+                    pair_products[selected],
+                    columns['price'][rows[current[selected]]])
+        return result
@@ -1,20 +1,30 @@
 # -*- coding: utf-8 -*-
 
-import os
 import datetime
-import yaml
 import json
 import numpy
 import urllib
 import re
+import transaction
 
-from uuid import uuid4
+from string import Formatter
+from uuid import uuid4, UUID
 from ZODB import DB
 from ZODB.FileStorage import FileStorage
 from ZODB.MappingStorage import MappingStorage
 from persistent import Persistent
-from operator import attrgetter
 from BTrees import OOBTree
+from BTrees.Length import Length
+
+from price_watch.data_map import (get_data_map, get_classification_cache,
+                                  traverse, LOOK_BEHIND_PATTERNS)
+from price_watch.exceptions import PackageRatioError
+from price_watch.history import (PriceHistory, DAILY_FIELDS,
+                                 PRODUCT_ROLLUP_FIELDS, STATISTICS_FIELDS,
+                                 get_periods, get_statistics, to_timestamp,
+                                 EPOCH)
+from price_watch.archive import get_archive, get_report_row
+from price_watch.reports import ReportBook, get_record_key
 
 
 HOUR_AGO = datetime.datetime.now() - datetime.timedelta(hours=1)
@@ -25,6 +35,27 @@ MONTH_AGO = datetime.datetime.now() - datetime.timedelta(days=30)
 
 # time, during which report's price matters
 REPORT_LIFETIME = datetime.timedelta(weeks=1)
+# report keys are kept in the registry shards by this many first hex digits
+REGISTRY_SHARD_DIGITS = 2
+
+
+def get_pattern_fields(pattern, _cache=dict()):
+    """Return the set of field names of the format pattern"""
+    try:
+        return _cache[pattern]
+    except KeyError:
+        fields = frozenset(field for _, field, _, _
+                           in Formatter().parse(pattern) if field)
+        _cache[pattern] = fields
+        return fields
+
+
+def get_address(address):
+    """Return ZEO server address tuple of `host:port` or socket path"""
+    host, separator, port = address.rpartition(':')
+    if separator and port.isdigit():
+        return host, int(port)
+    return address
 
 
 def get_delta(base_price, current_price, relative=True):
@@ -39,13 +70,23 @@ def get_delta(base_price, current_price, relative=True):
         return 0
 
 
-def load_data_map(node):
-    """Return parsed `data_map.yaml`"""
+def aggregate_prices(prices, cheap=False):
+    """Return rounded median or minimum of the prices or None if empty"""
+    if len(prices):
+        if cheap:
+            return min(prices)
+        else:
+            prices = numpy.array(prices)
+            return round(numpy.median(prices), 2)
+    return None
+
 
-    dir_ = os.path.dirname(__file__)
-    filename = os.path.join(dir_, 'data_map.yaml')
-    with open(filename) as map_file:
-        return yaml.safe_load(map_file)[node]
+def load_data_map(node):
+    """
+    Return parsed `data_map.yaml` node. The map is shared by the process and
+    must not be modified.
+    """
+    return get_data_map()[node]
 
 
 def mixed_keys(list_):
@@ -60,28 +101,6 @@ def mixed_keys(list_):
     return result
 
 
-def traverse(target, category_node, return_parent=False):
-    """
-    Recursively look for appropriate category from the tree in
-    `data_map.yaml`
-    """
-    try:
-        subcategories = category_node['sub']
-        if target in subcategories:
-            if return_parent:
-                return category_node
-            else:
-                return subcategories[target]
-        for key in subcategories:
-            match = traverse(target, subcategories[key],
-                             return_parent=return_parent)
-            if match:
-                return match
-    except (KeyError, TypeError):
-        pass
-    return None
-
-
 def keyword_lookup(string_, data_map):
     """
     Recursively look for appropriate category from the tree in
@@ -122,6 +141,24 @@ def keyword_lookup(string_, data_map):
                     return match
 
 
+def package_lookup(string_, package_data):
+    """
+    Look for appropriate package key by trying every package synonym in the
+    string
+    """
+    for pack_key in package_data:
+        for synonym in package_data[pack_key].synonyms:
+            for pattern in LOOK_BEHIND_PATTERNS:
+                pattern = pattern + re.escape(synonym)
+                match = re.search(pattern, string_)
+                if match:
+                    for unlike in package_data[pack_key].unlike:
+                        if unlike in string_:
+                            match = None
+                if match:
+                    return pack_key
+
+
 class PackageLookupError(Exception):
     """Exception for package not found in `data_map.yaml`"""
     def __init__(self, product):
@@ -142,15 +179,23 @@ class CategoryLookupError(Exception):
 
 
 class StorageManager(object):
-    """Persistence tool for entity instances."""
+    """
+    Persistence tool for entity instances. The storage is a local
+    `FileStorage` at `path`, a ZEO server at `address` (`host:port` or a
+    socket path) shared by several processes or an in-memory one.
+    """
 
     __name__ = None
 
-    def __init__(self, path=None, zodb_storage=None, connection=None):
+    def __init__(self, path=None, zodb_storage=None, connection=None,
+                 address=None):
         if all([path, zodb_storage, connection]) is False:
             zodb_storage = MappingStorage('test')
         if path is not None:
             zodb_storage = FileStorage(path)
+        if address is not None:
+            from ZEO.ClientStorage import ClientStorage
+            zodb_storage = ClientStorage(get_address(address))
         if zodb_storage is not None:
             self._db = DB(zodb_storage)
             self._zodb_storage = zodb_storage
@@ -173,7 +218,7 @@ class StorageManager(object):
         for instance in instances:
             namespace = instance.namespace
             if namespace not in self._root:
-                self._root[namespace] = OOBTree.BTree()
+                self._root[namespace] = instance._namespace_class()
             if instance.key not in self._root[namespace]:
                 self._root[namespace][instance.key] = instance
 
@@ -212,6 +257,20 @@ class StorageManager(object):
         self.connection.close()
         self._zodb_storage.close()
 
+    def open_reader(self):
+        """
+        Return `StorageManager` reading the storage through a connection of
+        its own with a separate transaction manager, e.g. after the
+        connection of a request is closed. Close it with `release`.
+        """
+        return StorageManager(connection=self._db.open(
+            transaction.TransactionManager()))
+
+    def release(self):
+        """Abort the connection transaction and return it to the pool"""
+        self.connection.transaction_manager.abort()
+        self.connection.close()
+
     def load_fixtures(self, path):
         """Load fixtures from JSON file in path. Mostly for testing"""
         result = dict()
@@ -233,16 +292,199 @@ class StorageManager(object):
         """Perform ZODB pack"""
         self._db.pack()
 
+    def get_counter(self, name):
+        """Return `Length` counter stored in the root, create if missing"""
+        if name not in self._root:
+            self._root[name] = Length()
+        return self._root[name]
+
+    def get_counter_value(self, name):
+        """Return value of the root counter, 0 if it's not created yet"""
+        counter = self._root.get(name)
+        return counter() if counter is not None else 0
+
+
+class EntityContainer(OOBTree.BTree):
+    """
+    Persistent container of entities keyed by their keys. Adding an entity
+    writes only the affected bucket, not the whole container along with its
+    owner as a list does. Iterates over the entities, `in` accepts an entity
+    or a key.
+    """
+
+    def __iter__(self):
+        # a snapshot, so the entities may be removed while iterating
+        return iter(list(self.values()))
+
+    def __contains__(self, instance):
+        return bool(self.has_key(getattr(instance, 'key', instance)))
+
+    def append(self, instance):
+        """Add the entity, replacing the one with the same key"""
+        self[instance.key] = instance
+
+    def remove(self, instance):
+        """Remove the entity, raise `ValueError` if it is not contained"""
+        try:
+            del self[getattr(instance, 'key', instance)]
+        except KeyError:
+            raise ValueError(u'{} is not in container'.format(instance))
+
+    def rekey(self, old_key, instance):
+        """Move the entity stored under `old_key` to its current key"""
+        if old_key in self:
+            del self[old_key]
+            self.append(instance)
+
+
+class ReportRegistry(OOBTree.BTree):
+    """
+    Namespace of the price reports. Maps report keys to `(product, time)`
+    of the records in the product's `ReportBook` and serves the reports as
+    `PriceReport` views of them. The keys are kept in shard BTrees by their
+    first hex digits created along with the registry, so the reports
+    registered concurrently rarely meet in a bucket and never split the
+    nodes of a common tree. The entries registered before the sharding and
+    the report objects stored before the book was introduced are kept in
+    the registry tree itself until `migrate`, the latter are served from
+    the book of their product too.
+    """
+
+    def __init__(self, *args):
+        super(ReportRegistry, self).__init__(*args)
+        for shard in range(16 ** REGISTRY_SHARD_DIGITS):
+            OOBTree.BTree.__setitem__(
+                self, '{:0{}x}'.format(shard, REGISTRY_SHARD_DIGITS),
+                OOBTree.BTree())
+
+    def _get_shard(self, key, create=False):
+        """Return shard BTree of the key or None if there is none"""
+        shard_key = key[:REGISTRY_SHARD_DIGITS]
+        shard = OOBTree.BTree.get(self, shard_key)
+        if shard is None and create:
+            shard = OOBTree.BTree()
+            OOBTree.BTree.__setitem__(self, shard_key, shard)
+        return shard
+
+    def _get_value(self, key):
+        """Return the stored value of the key or None"""
+        shard = self._get_shard(key)
+        value = shard.get(key) if shard is not None else None
+        if value is None:
+            value = OOBTree.BTree.get(self, key)
+            if isinstance(value, OOBTree.BTree):
+                value = None
+        return value
+
+    def _get_report(self, key, value):
+        """Return report of the stored value or None if it is missing"""
+        if type(value) is tuple:
+            product, time = value
+            index_key = time, UUID(key).bytes
+        else:
+            product, index_key = value.product, value.index_key
+        return product.get_report(index_key)
+
+    def __getitem__(self, key):
+        value = self._get_value(key)
+        report = None if value is None else self._get_report(key, value)
+        if report is None:
+            raise KeyError(key)
+        return report
+
+    def __setitem__(self, key, report):
+        if OOBTree.BTree.has_key(self, key):
+            OOBTree.BTree.__delitem__(self, key)
+        self._get_shard(key, create=True)[key] = (
+            report.product, to_timestamp(report.date_time))
+
+    def __delitem__(self, key):
+        shard = self._get_shard(key)
+        if shard is not None and shard.has_key(key):
+            del shard[key]
+        elif self._get_value(key) is not None:
+            OOBTree.BTree.__delitem__(self, key)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return self._get_value(key) is not None
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.items())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        """Return list of the report keys and the stored values"""
+        items = list()
+        for key, value in OOBTree.BTree.items(self):
+            if isinstance(value, OOBTree.BTree):
+                items.extend(value.items())
+            else:
+                items.append((key, value))
+        return items
+
+    def keys(self):
+        """Return list of the report keys"""
+        return [key for key, value in self.items()]
+
+    def values(self):
+        """Return list of the reports"""
+        reports = list()
+        for key, value in self.items():
+            report = self._get_report(key, value)
+            if report is not None:
+                reports.append(report)
+        return reports
+
+    def migrate(self):
+        """
+        Move the entries stored before the sharding to the shards, return
+        their number
+        """
+        legacy = [(key, value) for key, value in OOBTree.BTree.items(self)
+                  if not isinstance(value, OOBTree.BTree)]
+        for key, value in legacy:
+            OOBTree.BTree.__delitem__(self, key)
+            if type(value) is not tuple:
+                value = value.product, to_timestamp(value.date_time)
+            self._get_shard(key, create=True)[key] = value
+        return len(legacy)
+
 
 class Entity(Persistent):
     """Master class to inherit from"""
     _representation = u'{title}'
     _key_pattern = u'{title}'
+    # container of the namespace instances in the storage root
+    _namespace_class = OOBTree.BTree
+    # containers stored as `EntityContainer`, the legacy lists are
+    # migrated on the first write
+    _tree_containers = ()
     namespace = None
 
     def __eq__(self, other):
         return self.key == other.key
 
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __setattr__(self, name, value):
+        super(Entity, self).__setattr__(name, value)
+        if name in get_pattern_fields(self._key_pattern):
+            self.reset_key()
+
     def __str__(self):
         return str(self.__repr__().encode('utf-8'))
 
@@ -258,34 +500,63 @@ class Entity(Persistent):
         """For compatibility with pyramid traversal"""
         return self.key
 
-    def _get_inner_container(self):
+    def _get_inner_container(self, migrate=False):
         """
         Return the inner container if the instance has it
         """
         if hasattr(self, '_container_attr'):
             container_name = getattr(self, '_container_attr')
-            container = getattr(self, container_name)
-            return container
+            return self._get_container(container_name, migrate)
         else:
             raise NotImplementedError
 
+    def _get_container(self, name, migrate=True):
+        """
+        Return the named container. A legacy list of a tree container is
+        replaced with `EntityContainer` if `migrate` is set.
+        """
+        container = getattr(self, name)
+        if migrate and name in self._tree_containers and \
+                type(container) is list:
+            container = EntityContainer(
+                [(instance.key, instance) for instance in container])
+            setattr(self, name, container)
+        return container
+
+    def migrate_containers(self):
+        """
+        Migrate legacy lists and store the key if missing, return `True` if
+        anything was migrated
+        """
+        migrated = False
+        if getattr(self, '_key', None) is None:
+            self.reset_key()
+            migrated = True
+        for name in self._tree_containers:
+            if type(getattr(self, name, None)) is list:
+                self._get_container(name)
+                migrated = True
+        return migrated
+
     def add(self, *instances):
         """Add child instances to the instance container"""
-        container = self._get_inner_container()
+        container = self._get_inner_container(migrate=True)
         for instance in instances:
             if instance not in container:
                 container.append(instance)
-                self._p_changed = True
+                if type(container) is list:
+                    self._p_changed = True
 
     def remove(self, *instances):
         """
         Remove child instances from the instance container
         """
-        container = self._get_inner_container()
+        container = self._get_inner_container(migrate=True)
         for instance in instances:
             if instance in container:
                 container.remove(instance)
-                self._p_changed = True
+                if type(container) is list:
+                    self._p_changed = True
 
     def __contains__(self, key):
         """Container behaviour"""
@@ -303,10 +574,29 @@ class Entity(Persistent):
 
     @property
     def key(self):
-        """Return unique key based on `_key_pattern`"""
+        """
+        Return unique key based on `_key_pattern`. The key is stored when a
+        key attribute is set, the one of an instance stored before that is
+        formatted on each access until the instance is migrated.
+        """
+        key = getattr(self, '_key', None)
+        if key is None:
+            key = self._format_key()
+        return key
+
+    def _format_key(self):
+        """Format the key from the instance attributes"""
         raw_key = self._key_pattern.format(**self.__dict__)
         return raw_key.replace('/', '-')
 
+    def reset_key(self):
+        """Store the key formatted from the current attributes"""
+        try:
+            self._key = self._format_key()
+        except KeyError:
+            # not all of the key attributes are set yet
+            self._key = None
+
     @classmethod
     def fetch(cls, key, storage_manager):
         """Fetch instance from storage"""
@@ -354,10 +644,13 @@ class PriceReport(Entity):
     """Price report model, the working horse"""
     _representation = u'{price_value}-{product}-{merchant}-{reporter}'
     _key_pattern = '{uuid}'
+    _namespace_class = ReportRegistry
     namespace = 'reports'
 
     def __init__(self, price_value, product, reporter, merchant,
                  url=None, date_time=None, uuid=None, sku=None):
+        if uuid is not None and not isinstance(uuid, UUID):
+            uuid = UUID(str(uuid))
         self.uuid = uuid or uuid4()
         # The Stock Keeping Unit (SKU) http://schema.org/sku
         if sku:
@@ -378,10 +671,35 @@ class PriceReport(Entity):
 
         return price_value / ratio
 
+    @classmethod
+    def from_record(cls, product, index_key, record, entities):
+        """
+        Return report of the `ReportBook` record of the product, `entities`
+        are the interned merchants and reporters of the book
+        """
+        report = cls.__new__(cls)
+        time, uuid_bytes = index_key
+        price, normalized_price, merchant_id, reporter_id, url, sku = record
+        uuid = UUID(bytes=uuid_bytes)
+        report.__dict__.update(
+            uuid=uuid, _key=str(uuid),
+            date_time=EPOCH + datetime.timedelta(microseconds=time),
+            merchant=entities[merchant_id], product=product,
+            price_value=price, normalized_price_value=normalized_price,
+            reporter=entities[reporter_id], url=url)
+        if sku:
+            report.sku = sku
+        return report
+
+    @property
+    def index_key(self):
+        """Key of the report record in the product's `ReportBook`"""
+        return get_record_key(self)
+
     def delete_from(self, storage_manager):
         """Delete the report from product and storage"""
         try:
-            self.product.reports.remove(self)
+            self.product.remove_report(self)
         except (KeyError, AttributeError):
             pass
         storage_manager.delete_key(self.namespace, self.key)
@@ -395,7 +713,7 @@ class PriceReport(Entity):
     @classmethod
     def assemble(cls, storage_manager, price_value, product_title,
                  merchant_title, reporter_name, url, date_time=None,
-                 uuid=None, sku=None):
+                 uuid=None, sku=None, classification=None):
         """
         The only encouraged factory method for price reports and all the
         referenced instances:
@@ -405,7 +723,8 @@ class PriceReport(Entity):
           - merchant
           - reporter
         `date_time` is expected to be str in `%Y-%m-%d %H:%M:%S` format or
-        datetime object.
+        datetime object. `classification` of the product title resolved in
+        a batch (`Product.get_classifications`) is used for a new product.
         New report is registered in storage.
         """
 
@@ -423,7 +742,8 @@ class PriceReport(Entity):
         product = Product.fetch(product_key, storage_manager)
         if not product:
             prod_is_new = True
-            product, stats = Product.assemble(storage_manager, product_title)
+            product, stats = Product.assemble(storage_manager, product_title,
+                                              classification=classification)
 
         # merchant
         merchant_key = Merchant(merchant_title).key
@@ -450,11 +770,12 @@ class Merchant(Entity):
     _representation = u'{title}-{location}'
     namespace = 'merchants'
     _container_attr = 'products'
+    _tree_containers = ('products',)
 
     def __init__(self, title, location=None):
         self.title = title
         self.location = location
-        self.products = list()
+        self.products = EntityContainer()
 
     def patch(self, data, storage_manager):
         """Update merchant from dict. Return `True` if new key created"""
@@ -463,6 +784,7 @@ class Merchant(Entity):
             self.title = data['title']
         if 'location' in data:
             self.location = data['location']
+        self.update_products(old_key)
         if old_key != self.key:
             storage_manager.register(self)
             try:
@@ -478,11 +800,18 @@ class Merchant(Entity):
         """Remove product from list"""
         self.remove(product)
 
+    def update_products(self, old_key=None):
+        """Propagate changed key or location to the products' indexes"""
+        for product in self.products:
+            product.update_merchant(self, old_key)
+
     @classmethod
     def assemble(cls, storage_manager, title, location=None):
         """The merchant instance factory"""
         merchant = cls.acquire(title, storage_manager)
-        merchant.location = location
+        if merchant.location != location:
+            merchant.location = location
+            merchant.update_products()
         storage_manager.register(merchant)
         return merchant, None
 
@@ -496,13 +825,11 @@ class ProductPackage(Entity):
         self.categories = OOBTree.BTree()
 
     def get_data(self, attribute, default=None):
-        """Get category data from `data_map.yaml`"""
-        data_map = load_data_map(self.__class__.__name__)
-        try:
-            data = data_map[self.title][attribute]
-            return data
-        except KeyError:
+        """Get package data from `data_map.yaml`"""
+        record = get_data_map().package(self.title)
+        if record is None:
             return default
+        return record.get(attribute, default)
 
     def is_normal(self, category):
         """Check if the package is `normal` for a product's category"""
@@ -524,6 +851,9 @@ class ProductPackage(Entity):
 
     def get_ratio(self, category):
         """Get ratio to the normal package"""
+        ratio = get_data_map().package_ratio(self.title, category.title)
+        if ratio is not None:
+            return ratio
         norm_package = category.get_data('normal_package')
         norm_amount, norm_unit = norm_package.split(' ')
         pack_amount, pack_unit = self.title.split(' ')
@@ -549,15 +879,15 @@ class Category(Entity):
         """Add child categories to the category"""
         self.add(*categories)
 
-    def get_data(self, attribute):
-        """Get category data from `data_map.yaml`"""
-        data_map = load_data_map(ProductCategory.__name__)
-        category = traverse(self.title, data_map)
-        try:
-            data = category[attribute]
-            return data
-        except KeyError:
-            return None
+    def get_data(self, attribute, default=None, inherit=False):
+        """
+        Get category data from `data_map.yaml`, optionally inheriting it from
+        the parent categories
+        """
+        record = get_data_map().category(self.title)
+        if record is None:
+            return default
+        return record.get(attribute, default, inherit)
 
 
 class ProductCategory(Entity):
@@ -566,35 +896,38 @@ class ProductCategory(Entity):
     not other categories
     """
     _container_attr = 'products'
+    _tree_containers = ('products',)
     namespace = 'categories'
 
     def __init__(self, title, category=None):
         self.title = title
-        self.products = list()
+        self.products = EntityContainer()
         self.category = category
+        self.history = PriceHistory(REPORT_LIFETIME,
+                                    self.get_data('min_package_ratio'))
+        self.location_index = OOBTree.BTree()
+        self.product_locations = OOBTree.BTree()
 
-    def get_data(self, attribute, default=None):
-        """Get category data from `data_map.yaml`"""
-        data_map = load_data_map(self.__class__.__name__)
-        category = traverse(self.title, data_map)
-        try:
-            data = category[attribute]
-            return data
-        except KeyError:
+    def get_data(self, attribute, default=None, inherit=False):
+        """
+        Get category data from `data_map.yaml`, optionally inheriting it from
+        the parent categories
+        """
+        record = get_data_map().category(self.title)
+        if record is None:
             return default
+        return record.get(attribute, default, inherit)
 
     def get_category_key(self):
         """
-        Get parent category key using `traverse`. Only `self.title` required
+        Get parent category key from `data_map.yaml`. Only `self.title`
+        required
         """
         # TODO decide if this should be taken from storage by default
-        data_map = load_data_map(self.__class__.__name__)
-        parent_category_dict = traverse(self.title, data_map,
-                                        return_parent=True)
-        try:
-            return parent_category_dict['title']
-        except TypeError:
+        record = get_data_map().category(self.title)
+        if record is None:
             return None
+        return record.parent_title
 
     def add_product(self, *products):
         """Add product(s) to the category and set category to the products"""
@@ -602,6 +935,8 @@ class ProductCategory(Entity):
         for product in products:
             product.category = self
             self.add(product)
+            self.get_history().add_product(product)
+            self.index_product_locations(product)
 
     def remove_product(self, product):
         """
@@ -610,6 +945,151 @@ class ProductCategory(Entity):
         """
         product.category = None
         self.remove(product)
+        self.get_history().remove_product(product)
+        self.index_product_locations(product)
+
+    def get_location_index(self):
+        """
+        Return BTree of merchant locations to BTrees of the category
+        products (by key) sold there. It is built on the first access for
+        the categories stored before it was introduced.
+        """
+        if getattr(self, 'location_index', None) is None:
+            self.index_locations()
+        return self.location_index
+
+    def index_locations(self):
+        """Rebuild the location index from the products merchants"""
+        self.location_index = OOBTree.BTree()
+        self.product_locations = OOBTree.BTree()
+        for product in self.products:
+            self.index_product_locations(product)
+
+    def index_product_locations(self, product):
+        """Update the location index with the product merchant locations"""
+        index = self.get_location_index()
+        locations = set()
+        if product.category is self:
+            locations = set(merchant.location for merchant
+                            in getattr(product, 'merchants', list())
+                            if merchant.location is not None)
+        old_locations = set(self.product_locations.get(product.key, ()))
+        if locations == old_locations:
+            return
+        for location in old_locations - locations:
+            products = index[location]
+            del products[product.key]
+            if not len(products):
+                del index[location]
+        for location in locations - old_locations:
+            if location not in index:
+                index[location] = OOBTree.BTree()
+            index[location][product.key] = product
+        if locations:
+            self.product_locations[product.key] = tuple(sorted(locations))
+        else:
+            del self.product_locations[product.key]
+
+    def get_products(self, location=None):
+        """Get the category products, only the ones sold at the location"""
+        if not location:
+            return list(self.products)
+        products = self.get_location_index().get(location)
+        return list(products.values()) if products is not None else list()
+
+    def get_history(self):
+        """
+        Return the category `PriceHistory`. It is built from the stored
+        reports on the first access for the categories stored before it was
+        introduced or before it was partitioned by weeks.
+        """
+        min_package_ratio = self.get_data('min_package_ratio')
+        history = getattr(self, 'history', None)
+        if history is None or getattr(history, 'buckets', None) is None:
+            self.rebuild_history()
+        elif self.history.min_package_ratio != min_package_ratio:
+            self.history.min_package_ratio = min_package_ratio
+            self.history._stale()
+        return self.history
+
+    def rebuild_history(self):
+        """
+        Rebuild the category `PriceHistory` from the stored reports and the
+        archived ones
+        """
+        if getattr(self, 'history', None) is None:
+            self.history = PriceHistory(REPORT_LIFETIME,
+                                        self.get_data('min_package_ratio'))
+        self.history.rebuild(self.products)
+        archive = get_archive()
+        if archive is not None:
+            merchants = dict()
+            for product in self.products:
+                for merchant in product.merchants:
+                    merchants[merchant.key] = merchant
+            self.history.add_archived(
+                archive.read(product_keys=[product.key
+                                           for product in self.products]),
+                merchants)
+
+    def get_daily(self, day=None, location=None):
+        """
+        Get daily rollup dict (`median`, `min`, `max` prices at the end of
+        the day, `reports` and `products` counts) for the day (today by
+        default) and location or None if nothing is known
+        """
+        day = day or datetime.date.today()
+        entry = self.get_history().get_daily(day.toordinal(), location)
+        if entry is None:
+            return None
+        return dict(zip(DAILY_FIELDS, entry))
+
+    def get_rollups(self, resolution, start, end=None, location=None):
+        """
+        Get list of `(first date, rollup dict)` (dict as the daily one or
+        None) of the days, weeks or months covering the dates range (up to
+        today by default)
+        """
+        return self.get_location_rollups(resolution, start, end,
+                                         [location])[location]
+
+    def get_location_rollups(self, resolution, start, end=None,
+                             locations=(None,)):
+        """
+        Get dict of the locations to the rollup lists (as `get_rollups`),
+        the rollups not persisted yet are computed for all the locations in
+        one pass
+        """
+        end = end or datetime.date.today()
+        history = self.get_history()
+        periods = get_periods(start.toordinal(), end.toordinal(), resolution)
+        if resolution == 'day':
+            ranges = history.get_daily_ranges(start.toordinal(),
+                                              end.toordinal(), locations)
+            entries = dict((location, [ranges[location].get(day)
+                                       for day in periods])
+                           for location in locations)
+        else:
+            entries = history.get_location_rollups(resolution, periods,
+                                                   locations)
+        return dict((location, [
+            (datetime.date.fromordinal(period),
+             dict(zip(DAILY_FIELDS, entry)) if entry else None)
+            for period, entry in zip(periods, entries[location])])
+            for location in locations)
+
+    def get_daily_price(self, day=None, location=None, cheap=False):
+        """Get median or minimum price from the daily rollup"""
+        entry = self.get_daily(day, location)
+        if entry is None:
+            return None
+        return entry['min'] if cheap else entry['median']
+
+    def get_daily_price_delta(self, day, relative=True, location=None):
+        """Get price delta between the day and today from the daily rollup"""
+        base_price = self.get_daily_price(day, location)
+        current_price = self.get_daily_price(location=location)
+        return get_delta(base_price, current_price, relative)
 
     def get_reports(self, date_time=None):
         """Get price reports for the category by datetime"""
@@ -625,29 +1105,27 @@ class ProductCategory(Entity):
         qualification conditions
         """
 
-        min_package_ratio = self.get_data('min_package_ratio')
-        products = self.products
-        filtered_products = list()
-        for product in products:
+        history = self.get_history()
+        product_ids, prices = self.get_product_prices(date_time, location)
+        return [(history.products[product_id], price)
+                for product_id, price in zip(product_ids, prices)]
 
-            package_fit = True
-            if min_package_ratio:
-                package_fit = product.package_ratio >= float(min_package_ratio)
-
-            # Actual qualification
-            product_price = product.get_price(date_time, location=location)
-            if package_fit and product_price:
-                filtered_products.append((product, product_price))
-
-        return filtered_products
+    def get_product_prices(self, date_time=None, location=None):
+        """
+        Return arrays of qualified product ids (in the category history) and
+        their prices
+        """
+        date_time = date_time or datetime.datetime.now()
+        return self.get_history().get_product_prices(
+            date_time, REPORT_LIFETIME, location,
+            self.get_data('min_package_ratio'))
 
     def get_prices(self, date_time=None, location=None):
         """
         Fetch last known to `date_time` prices filtering by `min_package_ratio`
         and location
         """
-        product_tuples = self.get_qualified_products(date_time, location)
-        return [t[1] for t in product_tuples]
+        return list(self.get_product_prices(date_time, location)[1])
 
     def get_price(self, date_time=None, prices=None, cheap=False,
                   location=None):
@@ -655,17 +1133,50 @@ class ProductCategory(Entity):
         Get median or minimum price for the date and optionally location
         """
 
-        prices = prices or self.get_prices(date_time, location)
-        if len(prices):
-            if cheap:
-                try:
-                    return min(prices)
-                except ValueError:
+        if prices is None or not len(prices):
+            if date_time is None:
+                statistic = self.get_price_statistic(location)
+                if not len(statistic):
                     return None
-            else:
-                prices = numpy.array(prices)
-                return round(numpy.median(prices), 2)
-        return None
+                if cheap:
+                    return statistic.min()
+                return round(statistic.median(), 2)
+            prices = self.get_product_prices(date_time, location)[1]
+        return aggregate_prices(prices, cheap)
+
+    def get_price_statistic(self, location=None):
+        """
+        Get `OrderStatistic` of the current qualified product prices for the
+        location
+        """
+        return self.get_history().get_current_prices(location).statistic
+
+    def get_price_statistics(self, date_time=None, location=None):
+        """
+        Get dict of the qualified product prices count, min, p10, p25,
+        median, p75, p90, max and IQR for the date (current ones by
+        default) and location, or None if there are no prices. All of them
+        are read from a single sorted array.
+        """
+        if date_time is None:
+            prices = numpy.array(self.get_price_statistic(location).values)
+        else:
+            prices = numpy.sort(self.get_product_prices(date_time,
+                                                        location)[1])
+        statistics = get_statistics(prices)
+        if statistics is None:
+            return None
+        return dict(zip(STATISTICS_FIELDS, statistics))
+
+    def get_price_series(self, dates, location=None, cheap=False):
+        """
+        Get median or minimum prices for each of the `dates` in one pass over
+        the category history
+        """
+        series = self.get_history().get_price_series(
+            dates, REPORT_LIFETIME, location,
+            self.get_data('min_package_ratio'))
+        return [aggregate_prices(prices, cheap) for prices in series]
 
     def get_price_delta(self, date_time, relative=True, location=None):
 
@@ -673,28 +1184,56 @@ class ProductCategory(Entity):
         current_price = self.get_price(location=location)
         return get_delta(base_price, current_price, relative)
 
-    def get_locations(self):
+    def get_product_deltas(self, since, location=None):
         """
-        Get category's merchant locations. Load merchants from root if
-        provided. The root trick is needed for threaded cache as lazy-loading
-        of `product.merchants.values()` needs new connection.
+        Return dict of product keys to tuples of the current price, the price
+        last known to `since` and the relative delta for the category
+        products reported within the report lifetime. Prices are the ones of
+        the last reports as in `Product.get_price_delta`.
         """
-        locations = list()
-        merchants = list()
-        for product in self.products:
-            for merchant in product.merchants:
-                merchants.append(merchant)
-        for merchant in merchants:
-            if (merchant.location is not None) and \
-                    (merchant.location not in locations):
-                locations.append(merchant.location)
-        return locations
+        history = self.get_history()
+        product_ids, prices, base_prices, deltas = history.get_price_deltas(
+            since, datetime.datetime.now(), location)
+        result = dict()
+        for product_id, price, base_price, delta in zip(
+                product_ids, prices, base_prices, deltas):
+            result[history.products[product_id].key] = (
+                None if numpy.isnan(price) else float(price),
+                None if numpy.isnan(base_price) else float(base_price),
+                float(delta))
+        return result
+
+    def get_top_movers(self, since, location=None, limit=5, deltas=None,
+                       products=None):
+        """
+        Return list of `(product, current price, base price, delta)` tuples
+        for the qualified products with the largest relative price changes
+        since the date. `get_product_deltas` and `get_qualified_products`
+        results the caller already has may be passed as `deltas` and
+        `products`.
+        """
+        if deltas is None:
+            deltas = self.get_product_deltas(since, location)
+        if products is None:
+            products = self.get_qualified_products(location=location)
+        movers = list()
+        for product, price in products:
+            current_price, base_price, delta = deltas.get(product.key,
+                                                          (None, None, 0))
+            if delta:
+                movers.append((product, current_price, base_price, delta))
+        movers.sort(key=lambda mover: abs(mover[3]), reverse=True)
+        return movers[:limit]
+
+    def get_locations(self):
+        """Get category's merchant locations from the location index"""
+        return list(self.get_location_index().keys())
 
 
 class Product(Entity):
     """Product model"""
 
-    _container_attr = 'reports'
+    _tree_containers = ('merchants',)
     namespace = 'products'
 
     def __init__(self, title, category=None, manufacturer=None, package=None,
@@ -706,17 +1245,30 @@ class Product(Entity):
             self.category.add_product(self)
         self.package = package
         self.package_ratio = package_ratio
-        self.reports = list()
-        self.merchants = list()
+        self.report_book = ReportBook()
+        self.merchants = EntityContainer()
+
+    @property
+    def reports(self):
+        """List of the reports ordered by date"""
+        return self.get_reports()
 
     @classmethod
-    def assemble(cls, storage_manager, title, sku=None):
-        """The product instance factory"""
+    def assemble(cls, storage_manager, title, sku=None, classification=None):
+        """
+        The product instance factory. The title `classification` may be
+        given if it was resolved in a batch with `get_classifications`.
+        """
         product = cls(title=title)
 
         # early get critical info or raise exceptions
-        product_category_key = product.get_category_key()
-        package_key = product.get_package_key()
+        if classification is None:
+            classification = product.get_classification()
+        product_category_key, package_key, package_ratio = classification
+        if not product_category_key:
+            raise CategoryLookupError(product)
+        if not package_key:
+            raise PackageLookupError(product)
 
         # product category
         product_category, cat_is_new = ProductCategory.acquire(
@@ -729,13 +1281,16 @@ class Product(Entity):
                                                       storage_manager,
                                                       True)
         product.package = package
-        product.package_ratio = package.get_ratio(product_category)
+        if package_ratio is None:
+            package_ratio = package.get_ratio(product_category)
+        product.package_ratio = package_ratio
 
         # category
         category_key = product_category.get_category_key()
         category = Category.acquire(category_key, storage_manager)
         category.add(product_category)
-        product_category.category = category
+        if product_category.category is not category:
+            product_category.category = category
 
         storage_manager.register(product, product_category, category)
         stats = cat_is_new, pack_is_new
@@ -743,13 +1298,104 @@ class Product(Entity):
 
     def add_report(self, report):
         """Add report"""
-        self.add(report)
+        self.get_report_book().add_report(report)
+        if getattr(self, 'category', None) is not None:
+            self.category.get_history().add_report(report)
+
+    def remove_report(self, report, archived=False):
+        """
+        Remove report from the report book. The category price history keeps
+        the rows of the `archived` reports.
+        """
+        self.get_report_book().remove_report(report.index_key,
+                                             report.merchant)
+        if getattr(self, 'category', None) is not None and not archived:
+            self.category.get_history().remove_report(report)
+
+    def add(self, *reports):
+        """Add reports to the report book and the category history"""
+        for report in reports:
+            if report not in self:
+                self.add_report(report)
+
+    def remove(self, *reports):
+        """Remove reports from the report book and the category history"""
+        for report in reports:
+            if report in self:
+                self.remove_report(report)
+
+    def __contains__(self, report):
+        """Check the report to be in the report book"""
+        return self.get_report_book().get(report.index_key,
+                                          report.merchant) is not None
+
+    def update_report(self, report):
+        """Store the changed report values"""
+        self.get_report_book().add_report(report)
+
+    def get_report_book(self):
+        """
+        Return the `ReportBook` of the product. The report objects stored
+        before the book was introduced are moved to it on the first access.
+        """
+        report_book = getattr(self, 'report_book', None)
+        if report_book is None:
+            report_book = self.report_book = ReportBook()
+            for report in self.__dict__.get('reports', ()):
+                report_book.add_report(report)
+            for name in ('reports', 'report_index', 'merchant_report_index'):
+                self.__dict__.pop(name, None)
+        return report_book
+
+    def migrate_containers(self):
+        """
+        Migrate legacy lists, report objects and the report book not grouped
+        by merchants, `True` if any migrated
+        """
+        migrated = super(Product, self).migrate_containers()
+        if getattr(self, 'report_book', None) is None:
+            self.get_report_book()
+            migrated = True
+        elif self.report_book.records is not None:
+            self.index_reports()
+            migrated = True
+        return migrated
+
+    def index_reports(self):
+        """Regroup the report book records by merchants"""
+        self.get_report_book().reindex()
+
+    def _get_reports(self, items):
+        """Return reports of the report book `(key, record)` items"""
+        entities = self.get_report_book().entities
+        return [PriceReport.from_record(self, key, record, entities)
+                for key, record in items]
+
+    def get_report(self, index_key):
+        """Get report by its `index_key` or None"""
+        record = self.get_report_book().get(index_key)
+        if record is None:
+            return None
+        return self._get_reports([(index_key, record)])[0]
+
+    def update_merchant(self, merchant, old_key=None):
+        """Update indexes with the merchant's new key or location"""
+        if old_key and old_key != merchant.key:
+            self.get_report_book().rekey_entity(merchant, old_key)
+            self._get_container('merchants').rekey(old_key, merchant)
+        if getattr(self, 'category', None) is not None:
+            self.category.get_history().update_merchant(merchant, old_key)
+            self.category.index_product_locations(self)
 
     def add_merchant(self, merchant):
         """Add merchant if it's not in list"""
         if merchant not in self.merchants:
-            self.merchants.append(merchant)
-            self._p_changed = True
+            merchants = self._get_container('merchants')
+            merchants.append(merchant)
+            if type(merchants) is list:
+                self._p_changed = True
+            if getattr(self, 'category', None) is not None:
+                self.category.index_product_locations(self)
 
     def get_price(self, date_time=None, normalized=True, location=None):
         """Get price for the product"""
@@ -757,7 +1403,7 @@ class Product(Entity):
         known_prices = list()
         for merchant in self.merchants:
             if location and merchant.location != location:
-                break
+                continue
             report = self.get_last_report(date_time=date_time,
                                           merchant=merchant)
             if report and report.date_time > date_time - REPORT_LIFETIME:
@@ -772,51 +1418,150 @@ class Product(Entity):
         else:
             return None
 
+    def get_price_series(self, dates, normalized=True):
+        """
+        Get prices for each of the `dates` sweeping the reports once in date
+        order and keeping the current report of each merchant
+        """
+        result = [None] * len(dates)
+        if not dates:
+            return result
+        reports = iter(self.get_reports(
+            to_date_time=max(dates),
+            archived=self.reaches_archive(min(dates) - REPORT_LIFETIME)))
+        report = next(reports, None)
+        current_reports = dict()
+        for index in sorted(range(len(dates)), key=lambda i: dates[i]):
+            date_time = dates[index]
+            while report is not None and report.date_time <= date_time:
+                current_reports[report.merchant.key] = report
+                report = next(reports, None)
+            known_prices = list()
+            for current_report in current_reports.values():
+                if current_report.date_time > date_time - REPORT_LIFETIME:
+                    if normalized:
+                        known_prices.append(
+                            current_report.normalized_price_value)
+                    else:
+                        known_prices.append(current_report.price_value)
+            if len(known_prices):
+                result[index] = numpy.median(known_prices)
+        return result
+
+    def get_rollups(self, resolution, start, end=None):
+        """
+        Get list of `(first date, rollup dict)` (`median`, `min` and `max`
+        of the end of day prices or None) of the days, weeks or months
+        covering the dates range (up to today by default)
+        """
+        end = end or datetime.date.today()
+        periods = get_periods(start.toordinal(), end.toordinal(), resolution)
+        rollups = [None] * len(periods)
+        if getattr(self, 'category', None) is not None:
+            history = self.category.get_history()
+            product_id = history.product_ids.get(self.key)
+            if product_id is not None:
+                rollups = history.get_product_rollups(product_id, resolution,
+                                                      periods)
+        return [(datetime.date.fromordinal(period),
+                 dict(zip(PRODUCT_ROLLUP_FIELDS, rollup)) if rollup else None)
+                for period, rollup in zip(periods, rollups)]
+
     def get_price_delta(self, date_time, relative=True):
 
         base_price = self.get_last_reported_price(date_time)
         current_price = self.get_last_reported_price()
         return get_delta(base_price, current_price, relative)
 
-    def get_reports(self, to_date_time=None, from_date_time=None):
-        """Get reports to the given date/time"""
+    def get_reports(self, to_date_time=None, from_date_time=None,
+                    archived=False):
+        """
+        Get reports to the given date/time ordered by date, including the
+        `ArchivedReport` ones if `archived`
+        """
 
-        result = list()
-        for report in self.reports:
-            qualifies = True
-            if to_date_time and report.date_time > to_date_time:
-                qualifies = False
-            if from_date_time and report.date_time < from_date_time:
-                qualifies = False
-            if qualifies:
-                result.append(report)
+        start = end = None
+        if from_date_time:
+            start = to_timestamp(from_date_time)
+        if to_date_time:
+            end = to_timestamp(to_date_time)
+        reports = self._get_reports(self.get_report_book().items(start, end))
+        archive = get_archive()
+        if archived and archive is not None:
+            merchants = dict((merchant.key, merchant)
+                             for merchant in self.merchants)
+            archived_reports = archive.get_reports(from_date_time,
+                                                   to_date_time, [self.key])
+            for report in archived_reports:
+                report.merchant = (merchants.get(report.merchant_key) or
+                                   Merchant(report.merchant_key))
+            reports = sorted(archived_reports + reports,
+                             key=lambda report_: report_.date_time)
+        return reports
+
+    def reaches_archive(self, date_time):
+        """Check if the reports known to the date may be archived"""
+        first_time = self.get_report_book().first_time()
+        return get_archive() is not None and \
+            (first_time is None or first_time > to_timestamp(date_time))
+
+    def archive_reports(self, storage_manager, before):
+        """
+        Remove the reports older than `before` from the product and the
+        storage keeping their rows in the category price history. Return
+        archive rows of the removed reports.
+        """
+        rows = list()
+        for report in self.get_reports(to_date_time=before):
+            if report.date_time < before:
+                rows.append(get_report_row(report))
+                self.remove_report(report, archived=True)
+                storage_manager.delete_key(report.namespace, report.key)
+        return rows
+
+    def get_classification(self):
+        """
+        Return category key, package key and package ratio resolved from the
+        title (None for the ones that could not be resolved). Results are
+        memoized in the process-wide `ClassificationCache`.
+        """
+        return self.get_classifications([self.title])[self.title]
+
+    @classmethod
+    def get_classifications(cls, titles):
+        """
+        Return dict of the product titles to their classifications (as
+        `get_classification` does), the titles missing in the cache are
+        classified in one batch
+        """
+        data_map = get_data_map()
+        cache = get_classification_cache()
+        result = dict()
+        for title in titles:
+            if title not in result:
+                result[title] = cache.get(title, data_map.version)
+        missing = [title for title, classification in result.items()
+                   if classification is None]
+        for title, category_key in zip(
+                missing, data_map.classifier.classify_many(missing)):
+            package_key = data_map.package_matcher.resolve(title)
+            package_ratio = None
+            if category_key and package_key:
+                try:
+                    package_ratio = data_map.package_ratio(package_key,
+                                                           category_key)
+                except PackageRatioError:
+                    pass
+            result[title] = category_key, package_key, package_ratio
+            cache.set(title, data_map.version, result[title])
         return result
 
     def get_package_key(self):
         """Resolve product's package key from known ones"""
 
-        package_data = load_data_map('ProductPackage')
-        for pack_key in package_data:
-            for synonym in package_data[pack_key]['synonyms']:
-                look_behind_patterns = [
-                    u'(?<!(\d(\.|,|х|x|\*|\-))|'
-                    u'(\d{2})|(\+\s)|(\s\+)|(\d\+)|'
-                    u'(\.|,|х|x|\*|\s)\d)',
-                    u'(?<=фасов(\.))',
-                    u'(?<=№\d(\.|,))',
-                    u'(?<=№\d{2}(\.|,))',
-                    u'(?<=№\d{3}(\.|,))',
-                ]
-                for pattern in look_behind_patterns:
-                    pattern = pattern + re.escape(synonym)
-                    match = re.search(pattern, self.title)
-                    if match:
-                        if 'unlike' in package_data[pack_key]:
-                            for unlike in package_data[pack_key]['unlike']:
-                                if unlike in self.title:
-                                    match = None
-                    if match:
-                        return pack_key
+        package_key = self.get_classification()[1]
+        if package_key:
+            return package_key
         raise PackageLookupError(self)
 
     def get_package(self):
@@ -832,37 +1577,19 @@ class Product(Entity):
         Get category key from the product's title by looking up keywords
         in `data_map.yaml`
         """
-        data_map = load_data_map(ProductCategory.__name__)
-        category_data = keyword_lookup(self.title.lower(), data_map)
-        if category_data:
-            return category_data['title']
+        category_key = self.get_classification()[0]
+        if category_key:
+            return category_key
         raise CategoryLookupError(self)
 
     def get_last_report(self, date_time=None, merchant=None):
         """Get last (to `date_time`) report of the product"""
 
         date_time = date_time or datetime.datetime.now()
-
-        def qualify(report):
-            qualified = True
-            if report.date_time > date_time:
-                qualified = False
-            if merchant and report.merchant is not merchant:
-                qualified = False
-            return qualified
-
-        reports = self.reports
-        # TODO decide which one to do first sorting or filtering
-        if len(reports) > 0:
-            sorted_reports = sorted(reports,
-                                    key=attrgetter('date_time'))
-            filtered_reports = filter(qualify, sorted_reports)
-            try:
-                return filtered_reports[-1]
-            except IndexError:
-                return None
-        else:
+        item = self.get_report_book().last(to_timestamp(date_time), merchant)
+        if item is None:
             return None
+        return self._get_reports([item])[0]
 
     def get_last_reported_price(self, date_time=None, normalized=True):
         """Get product price last known to the date"""
@@ -877,14 +1604,15 @@ class Product(Entity):
     def delete_from(self, storage_manager):
         """Delete the product from all referenced objects"""
         key = self.key
+        # the reports go first, so their rows leave the category history
+        for report in self.reports:
+            report.delete_from(storage_manager)
         try:
-            self.category.products.remove(self)
+            self.category.remove_product(self)
             for merchant in self.merchants:
-                merchant.products.remove(self)
+                merchant.remove_product(self)
         except AttributeError:
             pass
-        for report in self.reports:
-            report.delete_from(storage_manager)
         storage_manager.delete_key(self.namespace, key)
 
 
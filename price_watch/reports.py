@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+import heapq
+import zlib
+
+from persistent import Persistent
+from BTrees import OOBTree
+from ZODB.POSException import ConflictError
+
+from price_watch.history import to_timestamp
+
+# fields of a report record, the record is keyed by `(time, uuid bytes)`
+RECORD_FIELDS = ('price', 'normalized_price', 'merchant', 'reporter', 'url',
+                 'sku')
+
+
+def get_record_key(report):
+    """Return `(timestamp, uuid bytes)` record key of the report"""
+    return to_timestamp(report.date_time), report.uuid.bytes
+
+
+def get_entity_id(key):
+    """Return the preferred id of an entity by its `(namespace, key)`"""
+    return zlib.crc32(u'{}/{}'.format(*key).encode('utf-8')) & 0xffff
+
+
+class ReportBook(Persistent):
+    """
+    Compact price reports of a product. A report is a tuple of
+    `RECORD_FIELDS` with the merchant and the reporter interned as ids of
+    the `entities` dict. The ids are derived from the entity keys, so the
+    entities interned concurrently are merged. The records are kept in a
+    BTree by time per merchant in `merchant_records`, so the reports are
+    stored in its buckets instead of a persistent object each and the
+    reports of different merchants are added concurrently without conflicts.
+
+    The books stored before the records were grouped by merchants keep them
+    in a single `records` BTree along with the merchant sets of the record
+    keys, they are regrouped on the first write. Their `entities` lists are
+    turned to dicts on the first interning.
+    """
+
+    records = None
+
+    def __init__(self):
+        self.merchant_records = OOBTree.BTree()
+        self.entities = dict()
+        self.entity_ids = dict()
+
+    def __len__(self):
+        return sum(len(records) for records in self._get_trees())
+
+    def _get_trees(self, merchant=None):
+        """
+        Return list of the record BTrees, only the one of the `merchant` if
+        provided (the whole legacy one for the ungrouped book)
+        """
+        if self.records is not None:
+            return [self.records]
+        if merchant is None:
+            return list(self.merchant_records.values())
+        records = self.merchant_records.get(self.get_merchant_id(merchant))
+        return [] if records is None else [records]
+
+    def _get_entity_id(self, entity):
+        """Return id of the merchant or reporter registering it if needed"""
+        key = entity.namespace, entity.key
+        entity_id = self.entity_ids.get(key)
+        if entity_id is None:
+            if type(self.entities) is list:
+                self.entities = dict(enumerate(self.entities))
+            entity_id = get_entity_id(key)
+            while entity_id in self.entities:
+                entity_id += 1
+            self.entity_ids[key] = entity_id
+            self.entities[entity_id] = entity
+            self._p_changed = True
+        return entity_id
+
+    def get_merchant_id(self, merchant):
+        """Return merchant id or None if the merchant has no reports"""
+        return self.entity_ids.get((merchant.namespace, merchant.key))
+
+    def rekey_entity(self, entity, old_key):
+        """Keep the entity id after the entity key change"""
+        entity_id = self.entity_ids.pop((entity.namespace, old_key), None)
+        if entity_id is not None:
+            self.entity_ids[entity.namespace, entity.key] = entity_id
+            self._p_changed = True
+
+    def _p_resolveConflict(self, old, committed, new):
+        """Merge the entities interned concurrently, other changes conflict"""
+        if set(old) != set(committed) or set(old) != set(new) or \
+                old.get('merchant_records') != new['merchant_records'] or \
+                old.get('merchant_records') != committed['merchant_records']:
+            raise ConflictError
+        resolved = dict(committed)
+        for name in ('entities', 'entity_ids'):
+            if any(type(state[name]) is not dict
+                   for state in (old, committed, new)):
+                raise ConflictError
+            merged = dict(committed[name])
+            for key, value in new[name].items():
+                if key in old[name]:
+                    if old[name][key] != value:
+                        raise ConflictError
+                elif merged.setdefault(key, value) != value:
+                    raise ConflictError
+            for key, value in old[name].items():
+                if committed[name].get(key) != value or key not in new[name]:
+                    raise ConflictError
+            resolved[name] = merged
+        return resolved
+
+    def add_report(self, report):
+        """Add report record, return its key"""
+        if self.records is not None:
+            self.reindex()
+        key = get_record_key(report)
+        merchant_id = self._get_entity_id(report.merchant)
+        records = self.merchant_records.get(merchant_id)
+        if records is None:
+            records = self.merchant_records[merchant_id] = OOBTree.BTree()
+        records[key] = (report.price_value,
+                        report.normalized_price_value,
+                        merchant_id,
+                        self._get_entity_id(report.reporter),
+                        report.url or None,
+                        getattr(report, 'sku', None) or None)
+        return key
+
+    def remove_report(self, key, merchant=None):
+        """
+        Remove report record by key (looked up in the records of the
+        `merchant` if provided), return it or None if not found
+        """
+        if self.records is not None:
+            self.reindex()
+        for records in self._get_trees(merchant):
+            record = records.pop(key, None)
+            if record is not None:
+                return record
+        return None
+
+    def reindex(self):
+        """Regroup the records by merchants"""
+        items = [item for records in self._get_trees()
+                 for item in records.items()]
+        self.merchant_records = OOBTree.BTree()
+        for key, record in items:
+            records = self.merchant_records.get(record[2])
+            if records is None:
+                records = self.merchant_records[record[2]] = OOBTree.BTree()
+            records[key] = record
+        if self.records is not None:
+            del self.records
+
+    def get(self, key, merchant=None):
+        """
+        Return record by key or None, the `merchant` narrows the lookup to
+        its records
+        """
+        for records in self._get_trees(merchant):
+            record = records.get(key)
+            if record is not None:
+                return record
+        return None
+
+    def items(self, start=None, end=None):
+        """
+        Return list of `(key, record)` within the time range (timestamps,
+        inclusive, open if None) ordered by time
+        """
+        min_key = max_key = None
+        if start is not None:
+            min_key = (start,)
+        if end is not None:
+            # `(time,)` precedes all the keys with the same time
+            max_key = (end + 1,)
+        return list(heapq.merge(*[
+            records.items(min=min_key, max=max_key,
+                          excludemax=max_key is not None)
+            for records in self._get_trees()]))
+
+    def last(self, end=None, merchant=None):
+        """
+        Return the last `(key, record)` to the time (timestamp, inclusive),
+        only of the `merchant` if provided, or None
+        """
+        trees = self._get_trees(merchant)
+        if self.records is not None and merchant is not None:
+            trees = [self.merchant_records.get(
+                self.get_merchant_id(merchant))]
+            if trees[0] is None:
+                return None
+        last = last_records = None
+        for records in trees:
+            try:
+                if end is None:
+                    key = records.maxKey()
+                else:
+                    # `(time,)` precedes all the keys with the same time
+                    key = records.maxKey((end + 1,))
+            except ValueError:
+                continue
+            if last is None or key > last:
+                last, last_records = key, records
+        if last is None:
+            return None
+        if self.records is not None:
+            # the legacy merchant sets hold the keys only
+            last_records = self.records
+        return last, last_records[last]
+
+    def first_time(self):
+        """Return time of the earliest record or None"""
+        keys = [records.minKey() for records in self._get_trees()
+                if len(records)]
+        if not keys:
+            return None
+        return min(keys)[0]
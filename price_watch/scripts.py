@@ -4,6 +4,8 @@ import textwrap
 
 from pyramid.paster import bootstrap
 
+from price_watch.data_map import DATA_MAP_PATH, build_snapshot
+
 
 def pack_storage():
 
@@ -26,4 +28,20 @@ def pack_storage():
     try:
         keeper.pack()
     finally:
-        closer()
\ No newline at end of file
+        closer()
+
+
+def build_data_map():
+
+    description = """
+    Compile the data map and save its snapshot next to it.
+    Example: build_data_map [path/to/data_map.yaml]
+    """
+    usage = "usage: %prog [data_map_path]"
+    parser = optparse.OptionParser(
+        usage=usage,
+        description=textwrap.dedent(description)
+        )
+    options, args = parser.parse_args(sys.argv[1:])
+    path = args[0] if args else DATA_MAP_PATH
+    print('Snapshot saved to {}'.format(build_snapshot(path)))
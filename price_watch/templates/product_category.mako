@@ -72,6 +72,26 @@
                 % endfor
             </tbody>
         </table>
+        % if len(movers):
+        <h4>Заметнее всего изменились цены</h4>
+        <table id="top_movers" class="table">
+            <tbody>
+                % for product, url, price, delta in movers:
+                    <tr>
+                        <td>
+                            <a href="${url}">
+                                ${product.title}
+                            </a>
+                        </td>
+                        <td align="center">
+                        <%include file="partials/price.mako"
+                                  args="price=price, delta=delta" />
+                        </td>
+                    </tr>
+                % endfor
+            </tbody>
+        </table>
+        % endif
         % else:
         <div class="alert alert-info">Нет данных в этой категории :(</div>
         % endif
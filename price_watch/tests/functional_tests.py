@@ -329,6 +329,65 @@ class ViewTest(unittest.TestCase):
         res = self.testapp.get('/', status=200)
         self.assertIn('50,75', res.body.decode('utf-8'))
 
+    def test_chart_resolution(self):
+        res = self.testapp.get('/categories/milk/chart', status=200)
+        self.assertEqual('day', res.json_body['resolution'])
+        self.assertEqual(30, len(res.json_body['data']))
+        self.assertEqual(50.75, res.json_body['data'][-1][1])
+        res = self.testapp.get('/categories/milk/chart?days=365&'
+                               'location=Санкт-Петербург', status=200)
+        self.assertEqual('week', res.json_body['resolution'])
+        self.assertEqual(45.9, res.json_body['data'][-1][1])
+        res = self.testapp.get(u'/products/Молоко Deli Milk 1L/chart'
+                               u'?days=1825'.encode('utf-8'), status=200)
+        self.assertEqual('month', res.json_body['resolution'])
+        self.assertIn(len(res.json_body['data']), (60, 61))
+        self.testapp.get('/categories/milk/chart?days=year', status=400)
+        self.testapp.get('/categories/milk/chart?days=100000', status=400)
+
+    def test_category_statistics(self):
+        res = self.testapp.get('/categories/milk/statistics', status=200)
+        statistics = res.json_body['statistics']
+        self.assertEqual(4, statistics['count'])
+        self.assertEqual(50.75, statistics['median'])
+        self.assertEqual(41.7, statistics['min'])
+        self.assertEqual(64.3, statistics['max'])
+        res = self.testapp.get('/categories/milk/statistics?'
+                               'location=Санкт-Петербург', status=200)
+        self.assertEqual(45.9, res.json_body['statistics']['p90'])
+        self.assertEqual(0, res.json_body['statistics']['iqr'])
+        res = self.testapp.get('/categories/milk/statistics?date=2014-01-01',
+                               status=200)
+        self.assertIsNone(res.json_body['statistics'])
+        self.testapp.get('/categories/milk/statistics?date=today',
+                         status=400)
+
+    def test_batch_series(self):
+        res = self.testapp.get('/categories/series?category=milk&'
+                               'category=unknown&location=*&days=365',
+                               status=200)
+        self.assertEqual('application/json', res.content_type)
+        self.assertEqual('week', res.json_body['resolution'])
+        self.assertIsNone(res.json_body['categories']['unknown'])
+        milk = res.json_body['categories']['milk']
+        self.assertEqual(u'молоко', milk['title'])
+        self.assertEqual(
+            [u'', u'Москва', u'Санкт-Петербург'], sorted(milk['locations']))
+        self.assertEqual(50.75, milk['locations'][u'']['price'])
+        self.assertEqual(45.9,
+                         milk['locations'][u'Санкт-Петербург']['price'])
+        self.assertEqual(45.9, milk['locations'][u'Санкт-Петербург'][
+            'series'][-1][1])
+
+        res = self.testapp.get('/categories/series?start=2014-01-01&'
+                               'end=2014-01-10', status=200)
+        self.assertEqual('day', res.json_body['resolution'])
+        self.assertEqual(10, len(
+            res.json_body['categories']['milk']['locations']['']['series']))
+        self.testapp.get('/categories/series?start=2014-01-10&'
+                         'end=2014-01-01', status=400)
+        self.testapp.get('/categories/series?resolution=year', status=400)
+
     def test_location_at_category_view(self):
         res = self.testapp.get('/categories/milk?location=Санкт-Петербург',
                                status=200)
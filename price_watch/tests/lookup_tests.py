@@ -3,7 +3,70 @@
 import unittest
 
 from price_watch.models import (Product, ProductCategory, PackageLookupError,
-                                CategoryLookupError)
+                                CategoryLookupError, keyword_lookup,
+                                package_lookup)
+from price_watch.data_map import get_data_map
+
+# product titles used to check compiled lookups against the original ones
+TITLES = (
+    u'Яйцо Окское куриное С0 белое десяток',
+    u'Яйцо динозавриное столовое, 20шт',
+    u'Молоко Веселый молочник 1л',
+    u'Молоко Веселый молочник 950г',
+    u'Молоко Веселый молочник 950 г',
+    u'Молоко Веселый молочник 999,4599 г',
+    u'Молоко Веселый молочник 0,5л',
+    u'Сметана Углече Поле органическая 15%, 250г',
+    u'Спагетти PASTA ZARA №4,500г',
+    u'Молоко Пармалат 3.5% стерил.1л',
+    u'Молоко Углече Поле органическое пастеризованное отборное 3,6%-5,2%, '
+    u'1л + 0,5л подарок',
+    u'Сметана Рузская 20%, 175г',
+    u'Рис АГРОАЛЬЯНС краснодарский 1,5кг',
+    u'Хлеб Геркулес зерновой половин.нар.0.25кг ХД',
+    u'МОЛОКО 3,2% п/п 0,85л КИРЗА',
+    u'Гречка Maltagliati ядрица 900г',
+    u'Сметана 15% 0.2кг стакан Пискаревский',
+    u'Булочка Щелковохлеб для хот-дога 0,3кг (4*0,075г)',
+    u'Молоко Parmalat ультрапастеризованное 3,5%, 12*1л',
+    u'Глазурь Др.Откер сахарн.вкус марципана 100г',
+    u'Глазурь Др.Откер сахарн.вкус марципана 5*100г',
+    u'Глазурь Др.Откер сахарн.вкус марципана 5х100г',
+    u'Сахар рафинад МОН КАФЕ фигурный 0,5 кг',
+    u'Хлеб Мультисид Английск.диетич.нар.0.4кг Каравай',
+    u'Макароны ШЕБЕКИНСКИЕ, ракушка №393,450г',
+    u'Томаты сливка, 1,0-1,2кг',
+    u'Картофель Деревенский фасов.4.5кг Агроторг',
+    u'Яблоки Ред Делишес (55+) 1,3-1,5кг',
+    u'Сыр Rokiskio Гоюс твердый фасованный 40%, 200-450г',
+    u'Сыр эдам виола 40% 1,2кг финляндия',
+    u'Смесь мучная ХлебБург хлеб ржано-пшеничный Скандинавский, 500г',
+    u'Молоко Тема питьевое ультрапастеризованное для детей с 8 месяцев '
+    u'3,2%, 200г',
+    u'Молоко козье МОЖАЙСКОЕ стерилизованное, 1,5% 0,45л',
+    u'Картофель батат, 1,9-2,1кг',
+    u'"Сахар Мистраль Демерара тростниковый нерафинированный, 1кг"',
+    u'Крупа Мистраль гречневая "Зеленая", 450г',
+    u'Греча Ярмарка Ядрица, 800г',
+    u'Спагетти Макфа 950г',
+    u'Напиток Актуаль Яблоко сыворотка с соком, 930г',
+    u'Мука Сокольническая пшеничная хлебопекарная высший сорт 800г банка',
+    u'Хлеб Хлебный дом Кефирный в нарезке 450г',
+    u'Груша конференция лоток КЛ 65+ 1кг',
+    u'Молоко Красная Цена у/паст. 3.2% 1л',
+    u'Молоко Балтика ультрапас. 3.2% 1л',
+    u'Молоко Farmers Milk 1L',
+    u'Масло подсолнечное Sunny Oil 1л',
+    u'Тыква 1кг',
+    u'Молоко Веселый молочник 3950г',
+    u'Элексир Веселый молочник 950г',
+    u'Молоко топленое Простоквашино 3,2% 950г',
+    u'Сыр плавленый Viola 400г',
+    u'Соль морская йодированная 1кг',
+    u'Сливки Петмол 10% 0,5л',
+    u'Кефир Домик в деревне 1% 930г',
+    u'Рис Мистраль черный 500г',
+)
 
 
 class TestPackageLookup(unittest.TestCase):
@@ -218,3 +281,72 @@ class TestCategoryLookup(unittest.TestCase):
     # def test_1_5kg(self):
     #     product = Product(u'Деревенский фасов.1.5кг Агроторг')
     #     self.assertEqual('1.5 kg', product.get_package_key())
+
+
+class TestKeywordClassifier(unittest.TestCase):
+
+    def setUp(self):
+        self.data_map = get_data_map()
+
+    def test_equivalence(self):
+        classifier = self.data_map.classifier
+        for title in TITLES:
+            category_data = keyword_lookup(title.lower(), self.data_map.tree)
+            expected = category_data['title'] if category_data else None
+            self.assertEqual(expected, classifier.classify(title), title)
+
+    def test_classify_many(self):
+        classifier = self.data_map.classifier
+        titles = [u'Молоко Веселый молочник 1л', u'Яйцо динозавриное, 20шт',
+                  u'Сметана Рузская 20%, 175г', u'Молоко Веселый молочник 1л']
+        self.assertEqual(['milk', None, 'sour cream', 'milk'],
+                         classifier.classify_many(titles))
+
+    def test_automaton(self):
+        from price_watch.data_map import Automaton
+        automaton = Automaton([u'he', u'she', u'his', u'hers'])
+        self.assertEqual(set([0, 1, 3]), automaton.find(u'ushers'))
+        self.assertEqual(set(), automaton.find(u'xyz'))
+
+
+class TestPackageMatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.data_map = get_data_map()
+
+    def test_equivalence(self):
+        matcher = self.data_map.package_matcher
+        for title in TITLES:
+            self.assertEqual(package_lookup(title, self.data_map.packages),
+                             matcher.resolve(title), title)
+
+    def test_resolve_packages(self):
+        matcher = self.data_map.package_matcher
+        titles = [u'Молоко Веселый молочник 1л',
+                  u'Молоко Веселый молочник 999,4599 г',
+                  u'Молоко Углече Поле 3,6%-5,2%, 1л + 0,5л подарок',
+                  u'Молоко Веселый молочник 1л']
+        self.assertEqual(['1 l', None, '1.5 l', '1 l'],
+                         matcher.resolve_packages(titles))
+
+
+class TestPackageRatio(unittest.TestCase):
+
+    def setUp(self):
+        self.data_map = get_data_map()
+
+    def test_table(self):
+        self.assertEqual(0.93, round(
+            self.data_map.package_ratio('0.95 kg', 'milk'), 2))
+        self.assertEqual(0.625,
+                         self.data_map.package_ratio('0.25 kg', 'sour cream'))
+        self.assertIsNone(self.data_map.package_ratio('0.25 kg', 'diary'))
+
+    def test_unconvertible(self):
+        from price_watch.exceptions import PackageRatioError
+        self.assertIn('l', self.data_map.unconvertible['sour cream'])
+        self.assertRaises(PackageRatioError, self.data_map.package_ratio,
+                          '1 l', 'sour cream')
+        product = Product(u'Сметана Рузская 20% 1л')
+        self.assertRaises(TypeError, product.get_package().get_ratio,
+                          ProductCategory('sour cream'))
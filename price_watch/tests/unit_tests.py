@@ -8,8 +8,11 @@ import transaction
 
 from price_watch.models import (PriceReport, Merchant, Product, Category,
                                 ProductCategory, Reporter,
-                                PackageLookupError, StorageManager, HOUR_AGO,
-                                MONTH_AGO, DAY_AGO, WEEK_AGO)
+                                PackageLookupError, CategoryLookupError,
+                                StorageManager, EntityContainer,
+                                ReportRegistry, HOUR_AGO, MONTH_AGO, DAY_AGO,
+                                WEEK_AGO)
+from price_watch.data_map import get_data_map
 
 STORAGE_DIR = 'storage'
 STORAGE_PATH = '{dir}/test.fs'.format(dir=STORAGE_DIR)
@@ -232,11 +235,363 @@ class TestBasicLogic(unittest.TestCase):
         root = ProductCategory('product_categories')
         self.assertIsNone(root.get_category_key())
 
+    def test_order_statistic(self):
+        import random
+        import numpy
+        from price_watch.history import OrderStatistic
+        random.seed(3)
+        values = [round(random.uniform(30, 70), 1) for count in range(200)]
+        statistic = OrderStatistic(values[:50], load=4)
+        for value in values[50:]:
+            statistic.add(value)
+        removed = random.sample(values, 190)
+        for count, value in enumerate(removed):
+            values.remove(value)
+            statistic.remove(value)
+            if count % 20 == 0 or len(values) < 5:
+                self.assertEqual(sorted(values), statistic.values)
+                self.assertEqual(len(values), len(statistic))
+                self.assertEqual(min(values), statistic.min())
+                self.assertEqual(max(values), statistic.max())
+                self.assertEqual(numpy.median(values), statistic.median())
+                for percent in (10, 25, 75, 90):
+                    self.assertAlmostEqual(numpy.percentile(values, percent),
+                                           statistic.percentile(percent))
+        self.assertRaises(ValueError, statistic.remove, 100)
+        for value in list(values):
+            statistic.remove(value)
+        self.assertEqual(0, len(statistic))
+        statistic.add(42)
+        self.assertEqual(42, statistic.median())
+
+    def test_concurrent_ingestion(self):
+        title = u'Молоко Great Milk FOUR 1L'
+        for merchant_title in ('Shop one', 'Shop two'):
+            PriceReport.assemble(self.keeper, price_value=50,
+                                 product_title=title,
+                                 merchant_title=merchant_title,
+                                 reporter_name='Jill', url=None)
+        ProductCategory.fetch('milk', self.keeper).get_daily()
+        transaction.commit()
+
+        # reports of the same product from two connections are merged
+        manager = transaction.TransactionManager()
+        other = StorageManager(connection=self.keeper._db.open(manager))
+        for keeper, merchant_title, price_value in (
+                (self.keeper, 'Shop one', 52), (other, 'Shop two', 54)):
+            PriceReport.assemble(keeper, price_value=price_value,
+                                 product_title=title,
+                                 merchant_title=merchant_title,
+                                 reporter_name='Jill', url=None)
+        transaction.commit()
+        manager.commit()
+        other.connection.close()
+
+        transaction.begin()
+        product = Product.fetch(title, self.keeper)
+        self.assertEqual([50, 50, 52, 54], sorted(
+            report.price_value for report in product.reports))
+        milk = ProductCategory.fetch('milk', self.keeper)
+        self.assertEqual(4, len(milk.get_history()))
+        self.assertEqual(4, milk.get_daily()['reports'])
+        self.assertEqual(53, milk.get_daily()['median'])
+        transaction.commit()
+
+        # new products of the same category from two connections are merged
+        other = StorageManager(connection=self.keeper._db.open(manager))
+        for keeper, product_title in (
+                (self.keeper, u'Молоко Great Milk SIX 1L'),
+                (other, u'Молоко Great Milk SEVEN 1L')):
+            PriceReport.assemble(keeper, price_value=60,
+                                 product_title=product_title,
+                                 merchant_title='Shop one',
+                                 reporter_name='Jill', url=None)
+        transaction.commit()
+        manager.commit()
+        other.connection.close()
+
+        transaction.begin()
+        milk = ProductCategory.fetch('milk', self.keeper)
+        history = milk.get_history()
+        self.assertEqual(6, len(history))
+        for product_title in (u'Молоко Great Milk SIX 1L',
+                              u'Молоко Great Milk SEVEN 1L'):
+            product = Product.fetch(product_title, self.keeper)
+            self.assertIs(product, history.products[
+                history.product_ids[product.key]])
+            self.assertEqual(60, product.get_price())
+        self.assertEqual(6, milk.get_daily()['reports'])
+        self.assertEqual(60, milk.get_daily()['median'])
+        transaction.commit()
+
+    def test_concurrent_interning(self):
+        title = u'Молоко Great Milk FIVE 1L'
+        for product_title, merchant_title in (
+                (u'Молоко Great Milk FOUR 1L', 'Shop one'),
+                (u'Молоко Great Milk FOUR 1L', 'Shop two'),
+                (title, 'Shop three')):
+            PriceReport.assemble(self.keeper, price_value=50,
+                                 product_title=product_title,
+                                 merchant_title=merchant_title,
+                                 reporter_name='Jill', url=None)
+        transaction.commit()
+
+        # merchants new to the book are interned from two connections
+        manager = transaction.TransactionManager()
+        other = StorageManager(connection=self.keeper._db.open(manager))
+        for keeper, merchant_title in ((self.keeper, 'Shop one'),
+                                       (other, 'Shop two')):
+            PriceReport.assemble(keeper, price_value=52,
+                                 product_title=title,
+                                 merchant_title=merchant_title,
+                                 reporter_name='Jill', url=None)
+        transaction.commit()
+        manager.commit()
+        other.connection.close()
+
+        transaction.begin()
+        product = Product.fetch(title, self.keeper)
+        book = product.get_report_book()
+        self.assertEqual(3, len(book))
+        self.assertEqual(['Shop one', 'Shop three', 'Shop two'], sorted(
+            book.entities[record[2]].title for key, record in book.items()))
+        self.assertEqual([50, 52, 52], sorted(
+            report.price_value for report in product.reports))
+        transaction.commit()
+
+    def test_concurrent_reads(self):
+        for merchant_title, price_value in (('Shop one', 50),
+                                            ('Shop two', 54)):
+            PriceReport.assemble(self.keeper, price_value=price_value,
+                                 product_title=u'Молоко Great Milk FOUR 1L',
+                                 merchant_title=merchant_title,
+                                 reporter_name='Jill', url=None)
+        transaction.commit()
+
+        # two processes reading the same category commit without conflicts
+        last_transaction = self.keeper._db.lastTransaction()
+        manager = transaction.TransactionManager()
+        other = StorageManager(connection=self.keeper._db.open(manager))
+        for keeper in (self.keeper, other):
+            milk = ProductCategory.fetch('milk', keeper)
+            self.assertEqual(52, milk.get_daily_price())
+            self.assertEqual(2, milk.get_daily()['reports'])
+        transaction.commit()
+        manager.commit()
+        other.connection.close()
+        self.assertEqual(last_transaction, self.keeper._db.lastTransaction())
+
+    def test_region_invalidation(self):
+        from dogpile.cache import make_region
+        from price_watch.dogpile import invalidate_region, sync_region
+
+        # two processes sharing the storage, each with its own cache
+        regions = [make_region().configure('dogpile.cache.memory',
+                                           expiration_time=3600)
+                   for count in range(2)]
+        # syncing never writes, the counter is created on invalidation
+        last_transaction = self.keeper._db.lastTransaction()
+        sync_region(regions[0], self.keeper)
+        transaction.commit()
+        self.assertEqual(last_transaction, self.keeper._db.lastTransaction())
+        manager = transaction.TransactionManager()
+        other = StorageManager(connection=self.keeper._db.open(manager))
+        values = [1]
+        for region, keeper in zip(regions, (self.keeper, other)):
+            sync_region(region, keeper)
+            region.get_or_create('key', lambda: values[0])
+        transaction.abort()
+        manager.abort()
+
+        values[0] = 2
+        invalidate_region(regions[0], self.keeper)
+        transaction.commit()
+        self.assertEqual(2, regions[0].get_or_create('key',
+                                                     lambda: values[0]))
+        self.assertEqual(1, regions[1].get_or_create('key',
+                                                     lambda: values[0]))
+        manager.begin()
+        sync_region(regions[1], other)
+        self.assertEqual(2, regions[1].get_or_create('key',
+                                                     lambda: values[0]))
+        manager.abort()
+        other.connection.close()
+
     def tearDown(self):
         self.keeper.close()
         shutil.rmtree('storage')
 
 
+class TestDataMap(unittest.TestCase):
+
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'data_map.yaml')
+        self.write_map(u'молоко')
+
+    def write_map(self, keyword):
+        with open(self.path, 'w') as map_file:
+            map_file.write(u"""
+ProductPackage:
+  1 l:
+    synonyms:
+      - 1л
+ProductCategory:
+  title: product_categories
+  sub:
+    milk:
+      title: milk
+      keyword: {}
+      normal_package: 1 l
+""".format(keyword).encode('utf-8'))
+
+    def test_shared(self):
+        from price_watch.data_map import get_data_map
+        data_map = get_data_map(self.path)
+        self.assertIs(data_map, get_data_map(self.path))
+        milk = data_map.category('milk')
+        self.assertEqual('product_categories', milk.parent_title)
+        self.assertEqual([u'молоко'], milk.keywords)
+        self.assertEqual(1, data_map.package('1 l').amount)
+        self.assertIsNone(data_map.category('kefir'))
+
+    def test_reload(self):
+        from price_watch.data_map import get_data_map
+        data_map = get_data_map(self.path)
+        self.write_map(u'молоко, milk')
+        os.utime(self.path, (0, 0))
+        data_map.checked = 0
+        reloaded = get_data_map(self.path)
+        self.assertIsNot(data_map, reloaded)
+        self.assertNotEqual(data_map.version, reloaded.version)
+        self.assertEqual([u'молоко', u'milk'],
+                         reloaded.category('milk').keywords)
+
+        # touched but unchanged file is not recompiled
+        os.utime(self.path, (1, 1))
+        reloaded.checked = 0
+        self.assertIs(reloaded, get_data_map(self.path))
+
+    def test_snapshot(self):
+        from price_watch.data_map import (get_data_map, build_snapshot,
+                                          DataMap)
+        snapshot_path = build_snapshot(self.path)
+        self.assertEqual(os.path.join(self.dir, 'data_map.snapshot'),
+                         snapshot_path)
+        data_map = get_data_map(self.path)
+        self.assertEqual(u'1 l', data_map.package_matcher.resolve(u'молоко 1л'))
+        self.assertEqual('milk', data_map.classifier.classify(u'Молоко 1л'))
+        self.assertEqual(1, data_map.package_ratio('1 l', 'milk'))
+
+        # stale snapshot is ignored
+        self.write_map(u'кефир')
+        with open(self.path, 'rb') as map_file:
+            content = map_file.read()
+        import hashlib
+        version = hashlib.md5(content).hexdigest()
+        self.assertIsNone(DataMap.load_snapshot(snapshot_path, version))
+        os.utime(self.path, (0, 0))
+        data_map.checked = 0
+        reloaded = get_data_map(self.path)
+        self.assertEqual(version, reloaded.version)
+        self.assertEqual('milk', reloaded.classifier.classify(u'кефир'))
+
+    def test_category_index(self):
+        from price_watch.data_map import get_data_map, traverse
+        data_map = get_data_map()
+        for title in data_map.nodes:
+            self.assertIs(traverse(title, data_map.tree),
+                          data_map.category(title).node)
+            self.assertIs(data_map.category(title),
+                          data_map.categories[title])
+            self.assertIs(traverse(title, data_map.tree, return_parent=True),
+                          data_map.parent(title).node)
+        self.assertEqual(['cheese', 'diary', 'food', 'product_categories'],
+                         [r.title for r in data_map.ancestors('soft cheese')])
+
+    def test_inherited_data(self):
+        milk = ProductCategory('milk')
+        self.assertIsNone(milk.get_data('primary_color'))
+        self.assertEqual('066699', milk.get_data('primary_color',
+                                                 inherit=True))
+        soft_cheese = ProductCategory('soft cheese')
+        self.assertEqual('FAE89B', soft_cheese.get_data('background_color',
+                                                        inherit=True))
+        self.assertIsNone(ProductCategory('tuna').get_data('primary_color',
+                                                           inherit=True))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+
+class TestClassificationCache(unittest.TestCase):
+
+    def test_lru(self):
+        from price_watch.data_map import ClassificationCache
+        cache = ClassificationCache(size=2)
+        cache.set(u'Молоко 1л', 'v1', ('milk', '1 l', 1.0))
+        cache.set(u'Кефир 1л', 'v1', ('kefir', '1 l', 1.0))
+        self.assertEqual(('milk', '1 l', 1.0), cache.get(u'Молоко 1л', 'v1'))
+        self.assertIsNone(cache.get(u'Молоко 1л', 'v2'))
+        cache.set(u'Сметана 400г', 'v1', ('sour cream', '0.4 kg', 1.0))
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get(u'Кефир 1л', 'v1'))
+        self.assertIsNotNone(cache.get(u'Молоко 1л', 'v1'))
+
+    def test_persistence(self):
+        import tempfile
+        from price_watch.data_map import ClassificationCache
+        dir_ = tempfile.mkdtemp()
+        path = os.path.join(dir_, 'classification.cache')
+        cache = ClassificationCache(path=path)
+        cache.set(u'Молоко 1л', 'v1', ('milk', '1 l', 1.0))
+        cache.set(u'Молоко 2л', 'v2', ('milk', '2 l', 2.0))
+        cache.save(version='v2')
+        loaded = ClassificationCache(path=path)
+        self.assertIsNone(loaded.get(u'Молоко 1л', 'v1'))
+        self.assertEqual(('milk', '2 l', 2.0), loaded.get(u'Молоко 2л', 'v2'))
+        shutil.rmtree(dir_)
+
+    def test_concurrent_persistence(self):
+        import tempfile
+        from price_watch.data_map import ClassificationCache
+        dir_ = tempfile.mkdtemp()
+        path = os.path.join(dir_, 'classification.cache')
+        # workers saving on exit one after another
+        for title in (u'Молоко 1л', u'Кефир 1л'):
+            cache = ClassificationCache(path=path)
+            cache.set(title, 'v1', ('milk', '1 l', 1.0))
+            cache.save()
+        self.assertEqual(['classification.cache'], os.listdir(dir_))
+        self.assertEqual(2, len(ClassificationCache(path=path)))
+
+        # a corrupt file is ignored
+        with open(path, 'wb') as cache_file:
+            cache_file.write('\x80\x02}q\x01')
+        self.assertEqual(0, len(ClassificationCache(path=path)))
+        with open(path, 'wb') as cache_file:
+            cache_file.write('garbage')
+        self.assertEqual(0, len(ClassificationCache(path=path)))
+        shutil.rmtree(dir_)
+
+    def test_product_classification(self):
+        from price_watch.data_map import get_classification_cache
+        product = Product(u'Сметана Рузская 20%, 175г')
+        category_key, package_key, package_ratio = \
+            product.get_classification()
+        self.assertEqual('sour cream', category_key)
+        self.assertEqual('0.175 kg', package_key)
+        self.assertAlmostEqual(0.4375, package_ratio)
+        self.assertEqual(product.get_classification(),
+                         get_classification_cache().get(
+                             product.title, get_data_map().version))
+        unknown = Product(u'Элексир Веселый молочник 3950г')
+        self.assertEqual((None, None, None), unknown.get_classification())
+        self.assertRaises(CategoryLookupError, unknown.get_category_key)
+        self.assertRaises(PackageLookupError, unknown.get_package_key)
+
+
 class TestFixtures(unittest.TestCase):
 
     def setUp(self):
@@ -368,7 +723,7 @@ class TestFixtures(unittest.TestCase):
         # check references
         potato = ProductCategory.fetch('potato', self.keeper)
         self.assertIn(report5, PriceReport.fetch_all(self.keeper))
-        self.assertIn(report5, potato.products[0].reports)
+        self.assertIn(report5, list(potato.products)[0].reports)
         self.assertIn(report5,
                       Product.fetch(u'Картофель Вегетория для варки 3кг',
                                     self.keeper).reports)
@@ -399,6 +754,35 @@ class TestFixtures(unittest.TestCase):
                                       self.keeper)
         self.assertIsNone(false_product)
 
+    def test_batch_classification(self):
+        titles = [u'Молоко Great Milk 1L', u'Сметана Great Sour Cream 450g',
+                  u'Сметана Great Sour Cream 987987g', u'Something']
+        classifications = Product.get_classifications(titles + titles[:2])
+        self.assertEqual(set(titles), set(classifications))
+        for title in titles:
+            self.assertEqual(Product(title).get_classification(),
+                             classifications[title])
+        self.assertEqual(('milk', '1 l', 1.0),
+                         classifications[u'Молоко Great Milk 1L'])
+
+        # a new product takes the given classification of its title
+        report, stats = PriceReport.assemble(
+            storage_manager=self.keeper, price_value=60.4,
+            product_title=u'Молоко Great Milk 1L',
+            merchant_title="Scotty's grocery", reporter_name='Jill',
+            url='http://scottys.com/products/milk/1',
+            classification=classifications[
+                u'Сметана Great Sour Cream 450g'])
+        self.assertEqual('sour cream', report.product.category.title)
+        self.assertRaises(PackageLookupError, PriceReport.assemble,
+                          storage_manager=self.keeper, price_value=60.4,
+                          product_title=u'Сметана Great Sour Cream 987987g',
+                          merchant_title="Scotty's grocery",
+                          reporter_name='Jill', url=None,
+                          classification=classifications[
+                              u'Сметана Great Sour Cream 987987g'])
+        transaction.abort()
+
     def test_representation(self):
         milk = ProductCategory.fetch('milk', self.keeper)
         self.assertIn(u"55.6-Молоко Красная Цена у/паст. 3.2% 1л"
@@ -556,6 +940,876 @@ class TestFixtures(unittest.TestCase):
         transaction.commit()
         self.assertNotIn(victim, product)
         self.assertNotIn(victim, PriceReport.fetch_all(self.keeper))
+        self.assertIsNone(product.get_report(victim.index_key))
+
+    def test_report_index(self):
+        cheapest_milk_title = u'Молоко The Cheapest Milk!!! 1л'
+        for price_value, date_time in ((30.10, HOUR_AGO), (25.22, MONTH_AGO),
+                                       (29.10, WEEK_AGO)):
+            PriceReport.assemble(price_value=price_value,
+                                 product_title=cheapest_milk_title,
+                                 reporter_name='John',
+                                 merchant_title="Howie's grocery",
+                                 url='http://someshop.com/item/344',
+                                 date_time=date_time,
+                                 storage_manager=self.keeper)
+        transaction.commit()
+        product = Product.fetch(cheapest_milk_title, self.keeper)
+        self.assertEqual([25.22, 29.10, 30.10],
+                         [r.price_value for r in product.get_reports()])
+        self.assertEqual([29.10],
+                         [r.price_value for r in product.get_reports(
+                             to_date_time=WEEK_AGO,
+                             from_date_time=WEEK_AGO)])
+        self.assertEqual(29.10, product.get_last_report(WEEK_AGO).price_value)
+        self.assertIsNone(product.get_last_report(
+            MONTH_AGO - datetime.timedelta(days=1)))
+
+        # report objects stored before the book are moved to it
+        reports = product.reports
+        del product.report_book
+        product.__dict__['reports'] = reports
+        self.assertEqual(30.10, product.get_last_report().price_value)
+        self.assertEqual(3, len(product.report_book))
+        self.assertNotIn('reports', product.__dict__)
+        transaction.commit()
+
+        # the book not grouped by merchants is read as is and regrouped on
+        # the first write
+        from BTrees.OOBTree import BTree, OOTreeSet
+        PriceReport.assemble(price_value=31.0,
+                             product_title=cheapest_milk_title,
+                             reporter_name='John',
+                             merchant_title="Eddie's grocery", url=None,
+                             storage_manager=self.keeper)
+        report_book = product.get_report_book()
+        items = report_book.items()
+        report_book.records = BTree(items)
+        report_book.merchant_records = BTree()
+        for key, record in items:
+            report_book.merchant_records.setdefault(
+                record[2], OOTreeSet()).insert(key)
+        howie = Merchant.fetch("Howie's grocery", self.keeper)
+        self.assertEqual(items, report_book.items())
+        self.assertEqual(30.10, product.get_last_report(
+            merchant=howie).price_value)
+        self.assertEqual(31.0, product.get_last_report().price_value)
+        self.assertIn(product.reports[0], product)
+        report = product.get_last_report(merchant=howie)
+        product.remove_report(report)
+        self.assertIsNone(report_book.records)
+        self.assertEqual([item for item in items
+                          if item[0] != report.index_key],
+                         report_book.items())
+        self.assertEqual(29.10, product.get_last_report(
+            merchant=howie).price_value)
+        self.assertEqual(31.0, product.get_last_report().price_value)
+        transaction.commit()
+
+    def test_price_history(self):
+        milk = ProductCategory.fetch('milk', self.keeper)
+        for price_value, title, merchant, date_time in (
+                (30.10, u'Молоко The Cheapest Milk!!! 1л', "Howie's grocery",
+                 HOUR_AGO),
+                (29.10, u'Молоко The Cheapest Milk!!! 1л', "Eddie's grocery",
+                 WEEK_AGO),
+                (25.22, u'Молоко The Cheapest Milk!!! 1л', "Howie's grocery",
+                 MONTH_AGO),
+                (40, u'Молоко The Luxury Milk!!! 0,5л', "Howie's grocery",
+                 DAY_AGO)):
+            PriceReport.assemble(price_value=price_value, product_title=title,
+                                 reporter_name='John', merchant_title=merchant,
+                                 url='http://someshop.com/item/344',
+                                 date_time=date_time,
+                                 storage_manager=self.keeper)
+        transaction.commit()
+        min_package_ratio = float(milk.get_data('min_package_ratio'))
+
+        def object_prices(date_time):
+            prices = [product.get_price(date_time)
+                      for product in milk.products
+                      if product.package_ratio >= min_package_ratio]
+            return sorted(price for price in prices if price)
+
+        dates = [None, HOUR_AGO, DAY_AGO, WEEK_AGO + datetime.timedelta(1),
+                 MONTH_AGO]
+        for date_time in dates:
+            self.assertEqual(object_prices(date_time),
+                             sorted(milk.get_prices(date_time)))
+
+        # rebuilt store gives the same results
+        milk.rebuild_history()
+        for date_time in dates:
+            self.assertEqual(object_prices(date_time),
+                             sorted(milk.get_prices(date_time)))
+
+        # tables kept in lists of the history before they were split are
+        # read from them and moved on the first write
+        import numpy
+        from price_watch.history import new_version
+        history = milk.get_history()
+        tables = history.tables
+        product_ids = sorted(tables.products)
+        merchant_ids = sorted(tables.merchant_locations)
+        for chunk in history.buckets.values():
+            chunk.products = numpy.searchsorted(
+                product_ids, chunk.products).astype(numpy.int32)
+            chunk.merchants = numpy.searchsorted(
+                merchant_ids, chunk.merchants).astype(numpy.int32)
+            chunk.version = new_version()
+        history.__dict__.update(
+            products=[tables.products[id_] for id_ in product_ids],
+            product_ids=dict((key, product_ids.index(id_))
+                             for key, id_ in tables.product_ids.items()),
+            product_ratios=[tables.product_ratios[id_]
+                            for id_ in product_ids],
+            product_active=[tables.product_active[id_]
+                            for id_ in product_ids],
+            merchant_ids=dict((key, merchant_ids.index(id_))
+                              for key, id_ in tables.merchant_ids.items()),
+            merchant_locations=[tables.merchant_locations[id_]
+                                for id_ in merchant_ids])
+        del history.tables
+        history._stale()
+        transaction.commit()
+        for date_time in dates:
+            self.assertEqual(object_prices(date_time),
+                             sorted(milk.get_prices(date_time)))
+        self.assertIsNone(history.tables)
+        PriceReport.assemble(price_value=60, product_title=u'Молоко 1л',
+                             reporter_name='John', merchant_title='Shop',
+                             url=None, storage_manager=self.keeper)
+        transaction.commit()
+        self.assertIsNotNone(history.tables)
+        self.assertNotIn('products', history.__dict__)
+        self.assertEqual(sorted(history.products),
+                         sorted(history.product_first))
+        self.assertNotIn(None, history.product_first.values())
+        self.assertIn(60, milk.get_prices())
+        self.assertEqual(object_prices(None), sorted(milk.get_prices()))
+
+        # deleted report is deleted from the store
+        report = PriceReport.fetch(self.report1_key, self.keeper)
+        length = len(milk.history)
+        report.delete_from(self.keeper)
+        transaction.commit()
+        self.assertEqual(length - 1, len(milk.history))
+        self.assertEqual(object_prices(None), sorted(milk.get_prices()))
+
+    def test_history_partitions(self):
+        milk = ProductCategory.fetch('milk', self.keeper)
+        title = u'Молоко The Cheapest Milk!!! 1л'
+        years_ago = datetime.datetime.now() - datetime.timedelta(days=730)
+        for count in range(10):
+            PriceReport.assemble(price_value=20 + count, product_title=title,
+                                 reporter_name='John',
+                                 merchant_title="Howie's grocery",
+                                 url='http://someshop.com/item/344',
+                                 date_time=years_ago + datetime.timedelta(
+                                     days=count * 10),
+                                 storage_manager=self.keeper)
+        transaction.commit()
+        history = milk.get_history()
+        self.assertEqual(14, len(history))
+        self.assertTrue(len(history.buckets) > 10)
+
+        # current prices read only the weeks of the lifetime window
+        columns, rows = history.get_current_rows(
+            datetime.datetime.now(), history.lifetime)
+        self.assertEqual(4, len(columns['time']))
+        self.assertEqual([41.7, 45.9, 55.6, 64.3],
+                         sorted(milk.get_prices()))
+
+        # historical queries read only the requested range
+        date_time = years_ago + datetime.timedelta(days=45)
+        columns, rows = history.get_current_rows(date_time, history.lifetime)
+        self.assertTrue(len(columns['time']) <= 2)
+        product = Product.fetch(title, self.keeper)
+        self.assertEqual([product.get_price(date_time)],
+                         milk.get_prices(date_time))
+        self.assertEqual([[24]], [list(prices) for prices in
+                                  history.get_price_series(
+                                      [date_time], history.lifetime)])
+
+        # last prices look back past the lifetime window only for the
+        # products missing there and no further than their first reports
+        from price_watch.history import PriceHistory, to_timestamp
+        product_id = history.product_ids[product.key]
+        self.assertEqual(to_timestamp(years_ago),
+                         history.product_first[product_id])
+        get_columns = PriceHistory.__dict__['get_columns']
+        starts = list()
+
+        def spy(self, start=None, end=None):
+            starts.append(start)
+            return get_columns(self, start, end)
+        PriceHistory.get_columns = spy
+        try:
+            deltas = milk.get_product_deltas(MONTH_AGO)
+            self.assertNotIn(product.key, deltas)
+            self.assertTrue(min(starts) > to_timestamp(years_ago))
+            del starts[:]
+            product_ids, prices = history.get_last_prices(
+                datetime.datetime.now())
+            self.assertEqual(to_timestamp(years_ago) - 1, min(starts))
+            self.assertEqual(29, dict(zip(product_ids, prices))[product_id])
+            product_ids, prices = history.get_last_prices(
+                datetime.datetime.now(), lookback=history.lifetime)
+            self.assertNotIn(product_id, product_ids)
+        finally:
+            PriceHistory.get_columns = get_columns
+
+        # a full chunk is not appended to, a new part of the week is started
+        from price_watch.history import CHUNK_SIZE, to_timestamp
+        time = to_timestamp(years_ago)
+        rows = len(history)
+        for count in range(CHUNK_SIZE):
+            history.get_chunk(time).append(time, 20, 0, 0)
+            history.get_report_count().change(1)
+        chunks = history.get_chunks(time, time)
+        self.assertEqual(rows + CHUNK_SIZE, len(history))
+        self.assertEqual([(0, CHUNK_SIZE), (1, 1)],
+                         [(key[1], len(chunk)) for key, chunk in chunks])
+        transaction.abort()
+
+    def test_price_series(self):
+        milk = ProductCategory.fetch('milk', self.keeper)
+        title = u'Молоко The Cheapest Milk!!! 1л'
+        for price_value, merchant, date_time in (
+                (30.10, "Howie's grocery", HOUR_AGO),
+                (29.10, "Eddie's grocery", WEEK_AGO),
+                (25.22, "Howie's grocery", MONTH_AGO)):
+            PriceReport.assemble(price_value=price_value, product_title=title,
+                                 reporter_name='John', merchant_title=merchant,
+                                 url='http://someshop.com/item/344',
+                                 date_time=date_time,
+                                 storage_manager=self.keeper)
+        transaction.commit()
+        product = Product.fetch(title, self.keeper)
+        now = datetime.datetime.now()
+        dates = [now - datetime.timedelta(days=count)
+                 for count in (0, 40, 1, 7, 8, 29, 30, 31)]
+        self.assertEqual([product.get_price(date) for date in dates],
+                         product.get_price_series(dates))
+        for location in (None, u'Москва', u'Санкт-Петербург'):
+            self.assertEqual(
+                [milk.get_price(date, location=location) for date in dates],
+                milk.get_price_series(dates, location=location))
+        self.assertEqual([milk.get_price(date, cheap=True) for date in dates],
+                         milk.get_price_series(dates, cheap=True))
+
+    def test_archive(self):
+        import tempfile
+        from price_watch.archive import configure_archive
+        directory = tempfile.mkdtemp()
+        archive = configure_archive(os.path.join(directory, 'archive.npza'))
+        try:
+            milk = ProductCategory.fetch('milk', self.keeper)
+            title = u'Молоко The Cheapest Milk!!! 1л'
+            keys = list()
+            for price_value, merchant, date_time in (
+                    (30.10, "Howie's grocery", HOUR_AGO),
+                    (29.10, "Eddie's grocery", WEEK_AGO),
+                    (25.22, "Howie's grocery", MONTH_AGO)):
+                report, stats = PriceReport.assemble(
+                    price_value=price_value, product_title=title,
+                    reporter_name='John', merchant_title=merchant,
+                    url='http://someshop.com/item/344', date_time=date_time,
+                    storage_manager=self.keeper)
+                keys.append(report.key)
+            transaction.commit()
+            product = Product.fetch(title, self.keeper)
+            now = datetime.datetime.now()
+            dates = [now - datetime.timedelta(days=count)
+                     for count in range(0, 40, 3)]
+            product_series = product.get_price_series(dates)
+            category_series = milk.get_price_series(dates)
+
+            before = now - datetime.timedelta(days=2)
+            rows = list()
+            for product_ in milk.products:
+                rows.extend(product_.archive_reports(self.keeper, before))
+            archive.append(rows)
+            transaction.commit()
+            self.assertEqual(2, len(archive))
+            self.assertEqual(1, len(product.reports))
+            self.assertIsNone(PriceReport.fetch(keys[1], self.keeper))
+            self.assertEqual(keys[2], archive.get_reports(
+                end=WEEK_AGO - datetime.timedelta(days=1))[0].key)
+
+            # archived reports are still charted
+            self.assertEqual(product_series, product.get_price_series(dates))
+            self.assertEqual(category_series, milk.get_price_series(dates))
+            milk.rebuild_history()
+            self.assertEqual(category_series, milk.get_price_series(dates))
+
+            # interrupted append is ignored and overwritten
+            with open(archive.path, 'ab') as archive_file:
+                archive_file.write('PWA1 incomplete chunk')
+            self.assertEqual(2, len(archive))
+            archive.append(rows[:1])
+            self.assertEqual(3, len(archive))
+            self.assertEqual(2, len(archive.read()['uuid']))
+            transaction.commit()
+        finally:
+            configure_archive(None)
+            shutil.rmtree(directory)
+
+    def test_daily_rollup(self):
+        milk = ProductCategory.fetch('milk', self.keeper)
+        self.assertEqual({'median': 50.75, 'min': 41.7, 'max': 64.3,
+                          'reports': 4, 'products': 4}, milk.get_daily())
+        self.assertEqual(45.9, milk.get_daily_price(
+            location=u'Санкт-Петербург'))
+
+        # incremental updates
+        title = u'Молоко The Cheapest Milk!!! 1л'
+        for price_value, date_time in ((30.10, HOUR_AGO), (29.10, WEEK_AGO),
+                                       (25.22, MONTH_AGO)):
+            PriceReport.assemble(price_value=price_value, product_title=title,
+                                 reporter_name='John',
+                                 merchant_title="Howie's grocery",
+                                 url='http://someshop.com/item/344',
+                                 date_time=date_time,
+                                 storage_manager=self.keeper)
+        report = PriceReport.fetch(self.report2_key, self.keeper)
+        report.delete_from(self.keeper)
+        transaction.commit()
+        today = datetime.date.today()
+        days = [today - datetime.timedelta(days=count)
+                for count in range(-8, 35)]
+        updated = [milk.get_daily(day) for day in days]
+        for day, daily in zip(days, updated):
+            day_end = datetime.datetime.combine(
+                day, datetime.time(23, 59, 59, 999999))
+            self.assertEqual(milk.get_price(day_end),
+                             daily and daily['median'])
+            self.assertEqual(milk.get_price(day_end, cheap=True),
+                             daily and daily['min'])
+        base_price = milk.get_daily_price(WEEK_AGO)
+        self.assertEqual((milk.get_daily_price() - base_price) / base_price,
+                         milk.get_daily_price_delta(WEEK_AGO))
+
+        # rebuilt rollup is the same
+        milk.history._stale()
+        self.assertEqual(updated, [milk.get_daily(day) for day in days])
+        transaction.commit()
+
+    def test_rollup_reads(self):
+        milk = ProductCategory.fetch('milk', self.keeper)
+        product = Product.fetch(u'Молоко Deli Milk 1L', self.keeper)
+        transaction.commit()
+
+        # the rollups are computed on read without writing
+        last_transaction = self.keeper._db.lastTransaction()
+        daily = milk.get_daily()
+        rollups = milk.get_rollups('week', MONTH_AGO.date())
+        product_rollups = product.get_rollups('week', MONTH_AGO.date())
+        self.assertEqual(55.6, milk.get_daily_price(location=u'Москва'))
+        transaction.commit()
+        self.assertEqual(last_transaction, self.keeper._db.lastTransaction())
+        self.assertEqual(daily, milk.get_daily())
+        self.assertEqual(rollups, milk.get_rollups('week', MONTH_AGO.date()))
+        self.assertEqual(product_rollups,
+                         product.get_rollups('week', MONTH_AGO.date()))
+
+        # a chunk state of an aborted report never passes for the current
+        medians = list()
+        for price_value in (90, 10):
+            PriceReport.assemble(self.keeper, price_value=price_value,
+                                 product_title=u'Молоко Deli Milk 1L',
+                                 merchant_title=u'Московский магазин',
+                                 reporter_name='Jill', url=None)
+            self.assertEqual(5, milk.get_daily()['reports'])
+            medians.append(milk.get_daily()['median'])
+            transaction.abort()
+        self.assertNotEqual(medians[0], medians[1])
+        self.assertEqual(daily, milk.get_daily())
+
+        # cached rollups follow the reports of the other connections
+        manager = transaction.TransactionManager()
+        other = StorageManager(connection=self.keeper._db.open(manager))
+        PriceReport.assemble(other, price_value=70,
+                             product_title=u'Молоко Deli Milk 1L',
+                             merchant_title="Howie's grocery",
+                             reporter_name='Jill', url=None)
+        manager.commit()
+        other.connection.close()
+        transaction.begin()
+        self.assertEqual(5, milk.get_daily()['reports'])
+        self.assertNotEqual(product_rollups,
+                            product.get_rollups('week', MONTH_AGO.date()))
+        transaction.commit()
+
+    def test_rollups(self):
+        from price_watch.history import get_period_end
+        milk = ProductCategory.fetch('milk', self.keeper)
+        title = u'Молоко The Cheapest Milk!!! 1л'
+        for price_value, merchant, date_time in (
+                (30.10, "Howie's grocery", HOUR_AGO),
+                (29.10, "Eddie's grocery", WEEK_AGO),
+                (25.22, "Howie's grocery", MONTH_AGO)):
+            PriceReport.assemble(price_value=price_value, product_title=title,
+                                 reporter_name='John', merchant_title=merchant,
+                                 url='http://someshop.com/item/344',
+                                 date_time=date_time,
+                                 storage_manager=self.keeper)
+        transaction.commit()
+        product = Product.fetch(title, self.keeper)
+        start = (MONTH_AGO - datetime.timedelta(days=40)).date()
+        for resolution in ('week', 'month'):
+            rollups = milk.get_rollups(resolution, start)
+            self.assertTrue(rollups[0][0] <= start <= datetime.date.fromordinal(
+                get_period_end(rollups[0][0].toordinal(), resolution)))
+            for date, rollup in rollups:
+                days = milk.get_rollups('day', date, datetime.date.fromordinal(
+                    get_period_end(date.toordinal(), resolution)))
+                daily = [entry for day, entry in days if entry]
+                if not daily:
+                    self.assertIsNone(rollup)
+                    continue
+                self.assertEqual(min(entry['min'] for entry in daily),
+                                 rollup['min'])
+                self.assertEqual(sum(entry['reports'] for entry in daily),
+                                 rollup['reports'])
+
+            for date, rollup in product.get_rollups(resolution, start):
+                end = min(get_period_end(date.toordinal(), resolution),
+                          datetime.date.today().toordinal())
+                days = [datetime.datetime.combine(
+                    datetime.date.fromordinal(day),
+                    datetime.time(23, 59, 59, 999999))
+                    for day in range(date.toordinal(), end + 1)]
+                prices = [price for price in product.get_price_series(days)
+                          if price is not None]
+                if rollup is None:
+                    self.assertEqual([], prices)
+                else:
+                    self.assertEqual((min(prices), max(prices)),
+                                     (rollup['min'], rollup['max']))
+
+        # a new report drops the rollups of its periods
+        week = milk.get_rollups('week', datetime.date.today())[0][1]
+        product_week = product.get_rollups('week', datetime.date.today())
+        PriceReport.assemble(price_value=10, product_title=title,
+                             reporter_name='John',
+                             merchant_title="Eddie's grocery",
+                             url='http://someshop.com/item/344',
+                             storage_manager=self.keeper)
+        transaction.commit()
+        self.assertEqual(week['reports'] + 1, milk.get_rollups(
+            'week', datetime.date.today())[0][1]['reports'])
+        self.assertEqual(product.get_price(), product.get_rollups(
+            'week', datetime.date.today())[0][1]['min'])
+        self.assertNotEqual(product_week, product.get_rollups(
+            'week', datetime.date.today()))
+        transaction.commit()
+
+    def test_persisted_rollups(self):
+        from price_watch.history import PriceHistory
+        milk = ProductCategory.fetch('milk', self.keeper)
+        history = milk.get_history()
+        title = u'Молоко The Cheapest Milk!!! 1л'
+        today = datetime.date.today()
+        year_ago = today - datetime.timedelta(days=365)
+        month_ago = MONTH_AGO.date().toordinal()
+        month_ago_end = datetime.datetime.combine(
+            MONTH_AGO.date(), datetime.time(23, 59, 59, 999999))
+
+        # the writes persist the rollups of the completed days and periods
+        PriceReport.assemble(price_value=25.22, product_title=title,
+                             reporter_name='John',
+                             merchant_title="Eddie's grocery",
+                             url='http://someshop.com/item/344',
+                             date_time=MONTH_AGO, storage_manager=self.keeper)
+        transaction.commit()
+        self.assertEqual(today.toordinal() - 1, history.get_rollups_through())
+        day = history.get_persisted(history.location_years, u'', 'day',
+                                    [month_ago])[month_ago]
+        self.assertEqual(milk.get_price(month_ago_end), day[0])
+        history._stale()
+        self.assertEqual(
+            history._compute_daily([month_ago])[None][month_ago], day)
+
+        # the charts read them, only the current periods are computed
+        sweep_locations = PriceHistory.__dict__['sweep_locations']
+        swept = list()
+
+        def spy(self, dates, lifetime, locations, product_id=None):
+            swept.append(min(dates).date())
+            return sweep_locations(self, dates, lifetime, locations,
+                                   product_id)
+        PriceHistory.sweep_locations = spy
+        try:
+            for resolution in ('day', 'week', 'month'):
+                rollups = milk.get_rollups(resolution, year_ago)
+            self.assertEqual([], swept)
+            self.assertEqual(day[3], sum(
+                rollup['reports'] for date, rollup in
+                milk.get_rollups('day', MONTH_AGO.date(), MONTH_AGO.date())
+                if rollup))
+
+            product = Product.fetch(title, self.keeper)
+            product_rollups = product.get_rollups('month', year_ago)
+            self.assertTrue(min(swept) >= today.replace(day=1))
+
+            # a backdated report and its deletion update them
+            report, stats = PriceReport.assemble(
+                price_value=10, product_title=title, reporter_name='John',
+                merchant_title="Howie's grocery",
+                url='http://someshop.com/item/344', date_time=MONTH_AGO,
+                storage_manager=self.keeper)
+            transaction.commit()
+            del swept[:]
+            self.assertEqual(milk.get_price(month_ago_end, cheap=True),
+                             milk.get_rollups('day', MONTH_AGO.date(),
+                                              MONTH_AGO.date())[0][1]['min'])
+            # the median over the merchants
+            self.assertEqual(17.61, product.get_rollups(
+                'week', MONTH_AGO.date())[0][1]['min'])
+            self.assertTrue(min(swept) >= today - datetime.timedelta(
+                days=today.weekday()))
+            report.delete_from(self.keeper)
+            transaction.commit()
+            self.assertEqual(rollups, milk.get_rollups('month', year_ago))
+            self.assertEqual(product_rollups,
+                             product.get_rollups('month', year_ago))
+        finally:
+            PriceHistory.sweep_locations = sweep_locations
+
+    def test_location_rollups(self):
+        from price_watch.history import PriceHistory
+        milk = ProductCategory.fetch('milk', self.keeper)
+        locations = [None, u'Москва', u'Санкт-Петербург']
+        today = datetime.date.today()
+        start = today - datetime.timedelta(days=3)
+        end = today + datetime.timedelta(days=3)
+
+        # the days not persisted are computed for all the locations at once
+        sweep_locations = PriceHistory.__dict__['sweep_locations']
+        swept = list()
+
+        def spy(self, dates, lifetime, locations, product_id=None):
+            swept.append(list(locations))
+            return sweep_locations(self, dates, lifetime, locations,
+                                   product_id)
+        PriceHistory.sweep_locations = spy
+        try:
+            rollups = milk.get_location_rollups('day', start, end, locations)
+            self.assertEqual([locations], swept)
+        finally:
+            PriceHistory.sweep_locations = sweep_locations
+        for location in locations:
+            self.assertEqual(milk.get_rollups('day', start, end, location),
+                             rollups[location])
+        self.assertEqual(45.9, dict(rollups[u'Санкт-Петербург'])[today][
+            'median'])
+
+    def test_price_statistic(self):
+        import random
+        import numpy
+        from price_watch.models import aggregate_prices
+        milk = ProductCategory.fetch('milk', self.keeper)
+        random.seed(7)
+        merchants = [(u'Магазин {}'.format(num), location) for num, location
+                     in enumerate((u'Москва', u'Санкт-Петербург', None))]
+        for merchant_title, location in merchants:
+            Merchant.assemble(self.keeper, merchant_title, location)
+        titles = [product.title for product in milk.products] + \
+            [u'Молоко Новое {} 1л'.format(num) for num in range(5)]
+        locations = (None, u'Москва', u'Санкт-Петербург')
+        for statistic_location in locations:
+            milk.get_price_statistic(statistic_location)
+        for count in range(40):
+            PriceReport.assemble(
+                price_value=round(random.uniform(30, 70), 1),
+                product_title=random.choice(titles),
+                merchant_title=random.choice(merchants)[0],
+                reporter_name='John', url='http://someshop.com/item/1',
+                date_time=datetime.datetime.now() - datetime.timedelta(
+                    hours=random.randint(0, 24 * 10)),
+                storage_manager=self.keeper)
+            for location in locations:
+                prices = milk.get_product_prices(location=location)[1]
+                self.assertEqual(aggregate_prices(prices),
+                                 milk.get_price(location=location))
+                self.assertEqual(aggregate_prices(prices, cheap=True),
+                                 milk.get_price(location=location,
+                                                cheap=True))
+        statistic = milk.get_price_statistic()
+        prices = milk.get_product_prices()[1]
+        for percent in (10, 25, 50, 75, 90):
+            self.assertAlmostEqual(numpy.percentile(prices, percent),
+                                   statistic.percentile(percent))
+        for date_time in (None, DAY_AGO):
+            for location in locations:
+                prices = milk.get_product_prices(date_time, location)[1]
+                statistics = milk.get_price_statistics(date_time, location)
+                self.assertEqual(len(prices), statistics['count'])
+                self.assertEqual(prices.min(), statistics['min'])
+                self.assertEqual(prices.max(), statistics['max'])
+                self.assertEqual(milk.get_price(date_time, location=location),
+                                 statistics['median'])
+                for percent in (10, 25, 75, 90):
+                    self.assertEqual(
+                        round(numpy.percentile(prices, percent), 2),
+                        statistics['p{}'.format(percent)])
+                self.assertEqual(
+                    round(statistics['p75'] - statistics['p25'], 2),
+                    statistics['iqr'])
+        self.assertIsNone(milk.get_price_statistics(MONTH_AGO))
+        transaction.commit()
+
+        # expired reports are dropped on read
+        import time
+        PriceReport.assemble(
+            price_value=1000, product_title=u'Молоко Последнее 1л',
+            merchant_title=merchants[0][0], reporter_name='John',
+            url='http://someshop.com/item/1',
+            date_time=datetime.datetime.now() - datetime.timedelta(
+                days=7, seconds=-1),
+            storage_manager=self.keeper)
+        self.assertEqual(1000, milk.get_price_statistic().max())
+        time.sleep(1)
+        self.assertNotEqual(1000, milk.get_price_statistic().max())
+        self.assertEqual(aggregate_prices(milk.get_product_prices()[1]),
+                         milk.get_price())
+        transaction.commit()
+
+    def test_merchant_report_index(self):
+        product_title = u'Молоко Красная Цена у/паст. 3.2% 1л'
+        PriceReport.assemble(price_value=50.4, product_title=product_title,
+                             url='http://eddies.com/products/milk/1',
+                             merchant_title="Eddie's grocery",
+                             reporter_name='Jack', date_time=DAY_AGO,
+                             storage_manager=self.keeper)
+        transaction.commit()
+        product = Product.fetch(u'Молоко Красная Цена у-паст. 3.2% 1л',
+                                self.keeper)
+        eddies = Merchant.fetch("Eddie's grocery", self.keeper)
+        mosmag = Merchant.fetch(u'Московский магазин', self.keeper)
+        self.assertEqual(50.4, product.get_last_report(
+            merchant=eddies).price_value)
+        self.assertEqual(55.6, product.get_last_report(
+            merchant=mosmag).price_value)
+        self.assertIsNone(product.get_last_report(DAY_AGO,
+                                                  merchant=mosmag))
+
+        # renamed merchant keeps its reports
+        eddies.patch({'title': "Eddie's store"}, self.keeper)
+        transaction.commit()
+        self.assertEqual(50.4, product.get_last_report(
+            merchant=eddies).price_value)
+        self.assertEqual(53, product.get_price())
+
+    def test_location_index(self):
+        milk = ProductCategory.fetch('milk', self.keeper)
+        baltika_key = u'Молоко Балтика ультрапас. 3.2% 1л'
+        self.assertEqual([baltika_key],
+                         [product.key for product
+                          in milk.get_products(u'Санкт-Петербург')])
+        self.assertEqual(3, len(milk.get_products(u'Москва')))
+        self.assertEqual([], milk.get_products(u'Казань'))
+
+        PriceReport.assemble(price_value=60, product_title=baltika_key,
+                             url='http://mosmag.ru/products/milk/1',
+                             merchant_title=u'Московский магазин',
+                             reporter_name='Jack',
+                             storage_manager=self.keeper)
+        transaction.commit()
+        baltika = Product.fetch(baltika_key, self.keeper)
+        self.assertEqual(4, len(milk.get_products(u'Москва')))
+        self.assertEqual(60, baltika.get_price(location=u'Москва'))
+        self.assertEqual(45.9, baltika.get_price(location=u'Санкт-Петербург'))
+
+        mosmag = Merchant.fetch(u'Московский магазин', self.keeper)
+        mosmag.patch({'location': u'Казань'}, self.keeper)
+        transaction.commit()
+        self.assertEqual([u'Казань', u'Санкт-Петербург'],
+                         sorted(milk.get_locations()))
+        self.assertEqual(4, len(milk.get_products(u'Казань')))
+
+        milk.remove_product(baltika)
+        transaction.commit()
+        self.assertEqual([u'Казань'], milk.get_locations())
+
+    def test_entity_containers(self):
+        baltika_key = u'Молоко Балтика ультрапас. 3.2% 1л'
+        baltika = Product.fetch(baltika_key, self.keeper)
+        piter = Merchant.fetch(u'Питерские продукты', self.keeper)
+        milk = ProductCategory.fetch('milk', self.keeper)
+        self.assertIsInstance(baltika.merchants, EntityContainer)
+        self.assertIn(baltika, piter.products)
+        self.assertIn(baltika_key, milk.products)
+
+        # legacy lists are migrated on the first write
+        baltika.merchants = list(baltika.merchants)
+        transaction.commit()
+        self.assertIn(piter, baltika.merchants)
+        report, stats = PriceReport.assemble(
+            price_value=47, product_title=baltika_key,
+            url='http://piter.ru/products/milk/1',
+            merchant_title=u'Питерские продукты', reporter_name='Jack',
+            storage_manager=self.keeper)
+        transaction.commit()
+        self.assertIsInstance(baltika.merchants, list)
+        self.assertEqual(2, len(baltika.reports))
+        self.assertIn(report, baltika.reports)
+        self.assertTrue(baltika.migrate_containers())
+        self.assertFalse(baltika.migrate_containers())
+        self.assertIsInstance(baltika.merchants, EntityContainer)
+
+        # merchant key change
+        piter.patch({'title': u'Невские продукты'}, self.keeper)
+        transaction.commit()
+        self.assertEqual([u'Невские продукты'],
+                         [merchant.key for merchant in baltika.merchants])
+        baltika.remove_report(report)
+        transaction.commit()
+        self.assertIn(baltika_key, milk.get_product_deltas(MONTH_AGO))
+        rows = len(milk.get_history())
+        count = milk.get_price_statistics()['count']
+        baltika_reports = len(baltika.reports)
+        baltika.delete_from(self.keeper)
+        transaction.commit()
+        self.assertEqual(rows - baltika_reports, len(milk.get_history()))
+        self.assertNotIn(baltika_key, milk.get_product_deltas(MONTH_AGO))
+        self.assertEqual(count - 1, milk.get_price_statistics()['count'])
+        self.assertNotIn(baltika_key, milk.products)
+        self.assertNotIn(baltika_key, piter.products)
+        self.assertEqual([u'Тыква 1кг'],
+                         [product.key for product in piter.products])
+
+    def test_report_records(self):
+        reports = self.keeper[PriceReport.namespace]
+        self.assertIsInstance(reports, ReportRegistry)
+        report = PriceReport.fetch(self.report2_key, self.keeper)
+        product = report.product
+        book = product.get_report_book()
+        record = book.get(report.index_key)
+        self.assertEqual((41.7, 41.7,
+                          'http://mosmag.com/products/milk/2', 'ART97667'),
+                         record[:2] + record[4:])
+        self.assertIs(report.merchant, book.entities[record[2]])
+        self.assertIs(report.reporter, book.entities[record[3]])
+        self.assertIs(report.merchant,
+                      Merchant.fetch(u'Московский магазин', self.keeper))
+        self.assertEqual('Jack', report.reporter.name)
+        self.assertEqual('ART97667', report.sku)
+        self.assertIsNone(report._p_jar)
+        self.assertEqual(product, reports[report.key].product)
+
+        # the product is a container of its reports
+        self.assertIn(report, product)
+        product.remove(report)
+        self.assertNotIn(report, product)
+        self.assertNotIn(report, product.reports)
+        product.add(report, report)
+        self.assertIn(report, product)
+        self.assertEqual(1, [r.key for r in product.reports].count(
+            report.key))
+
+        # changed values are stored back
+        report.normalized_price_value = 40.0
+        product.update_report(report)
+        self.assertEqual(40.0, PriceReport.fetch(
+            self.report2_key, self.keeper).normalized_price_value)
+
+        # the keys are kept in the shards, the entries registered before
+        # them are served until moved
+        from BTrees.OOBTree import BTree
+        from price_watch.history import to_timestamp
+        self.assertIn(report.key, BTree.get(reports, report.key[:2]))
+        keys = sorted(reports.keys())
+        del reports[report.key]
+        BTree.__setitem__(reports, report.key,
+                          (product, to_timestamp(report.date_time)))
+        self.assertEqual(report, reports[report.key])
+        self.assertEqual(keys, sorted(reports.keys()))
+        self.assertEqual(1, reports.migrate())
+        self.assertEqual(report, reports[report.key])
+        self.assertEqual(keys, sorted(reports.keys()))
+        self.assertEqual(len(keys), len(reports))
+
+        # stale registry entry is not served
+        product.get_report_book().remove_report(report.index_key)
+        self.assertIsNone(PriceReport.fetch(self.report2_key, self.keeper))
+        self.assertNotIn(report, reports.values())
+        transaction.abort()
+
+    def test_entity_key(self):
+        piter = Merchant.fetch(u'Питерские продукты', self.keeper)
+        self.assertEqual(u'Питерские продукты', piter._key)
+        self.assertEqual(hash(piter),
+                         hash(Merchant(u'Питерские продукты')))
+        self.assertIn(piter, {Merchant(u'Питерские продукты')})
+        self.assertNotEqual(piter, Merchant(u'Невские продукты'))
+
+        # the key of an instance stored without it is formatted on read,
+        # the instance is not changed until it is migrated
+        del piter._key
+        transaction.commit()
+        self.assertEqual(u'Питерские продукты', piter.key)
+        self.assertFalse(piter._p_changed)
+        self.assertTrue(piter.migrate_containers())
+        self.assertEqual(u'Питерские продукты', piter._key)
+        self.assertFalse(piter.migrate_containers())
+
+        # the stored key follows the key attributes
+        piter.location = u'Санкт-Петербург'
+        self.assertEqual(u'Питерские продукты', piter._key)
+        piter.title = u'Невские/продукты'
+        self.assertEqual(u'Невские-продукты', piter._key)
+        self.assertEqual(u'Невские-продукты', piter.key)
+        transaction.abort()
+
+    def test_product_deltas(self):
+        milk = ProductCategory.fetch('milk', self.keeper)
+        baltika_key = u'Молоко Балтика ультрапас. 3.2% 1л'
+        deli_key = u'Молоко Deli Milk 1L'
+        PriceReport.assemble(price_value=40, product_title=baltika_key,
+                             url='http://piter.ru/products/milk/1',
+                             merchant_title=u'Питерские продукты',
+                             reporter_name='Jack', date_time=WEEK_AGO,
+                             storage_manager=self.keeper)
+        PriceReport.assemble(price_value=70, product_title=deli_key,
+                             url='http://mosmag.ru/products/milk/1',
+                             merchant_title=u'Московский магазин',
+                             reporter_name='Jack', date_time=MONTH_AGO,
+                             storage_manager=self.keeper)
+        transaction.commit()
+        deltas = milk.get_product_deltas(DAY_AGO)
+        self.assertEqual(4, len(deltas))
+        for product in milk.products:
+            current_price, base_price, delta = deltas[product.key]
+            self.assertEqual(product.get_last_reported_price(), current_price)
+            self.assertEqual(product.get_last_reported_price(DAY_AGO),
+                             base_price)
+            self.assertAlmostEqual(product.get_price_delta(DAY_AGO), delta)
+        self.assertEqual((45.9, 40, (45.9 - 40) / 40), deltas[baltika_key])
+        self.assertEqual((None, 0),
+                         milk.get_product_deltas(MONTH_AGO)[baltika_key][1:])
+
+        movers = milk.get_top_movers(DAY_AGO)
+        self.assertEqual(2, len(movers))
+        self.assertEqual(sorted(abs(mover[3]) for mover in movers)[::-1],
+                         [abs(mover[3]) for mover in movers])
+        self.assertEqual([baltika_key],
+                         [mover[0].key for mover in milk.get_top_movers(
+                             DAY_AGO, location=u'Санкт-Петербург')])
+        self.assertEqual([deli_key],
+                         [mover[0].key for mover in milk.get_top_movers(
+                             DAY_AGO, location=u'Москва', limit=1)])
+
+        # the computed deltas and products are reused
+        products = milk.get_qualified_products()
+        self.assertEqual(movers, milk.get_top_movers(
+            DAY_AGO, deltas=deltas, products=products))
+        self.assertEqual([], milk.get_top_movers(DAY_AGO, deltas=dict(),
+                                                 products=products))
+        self.assertEqual([], milk.get_top_movers(DAY_AGO, deltas=deltas,
+                                                 products=[]))
+        transaction.commit()
 
     def test_multidict_to_list(self):
         from price_watch.utilities import multidict_to_list
@@ -9,16 +9,21 @@ from babel.dates import format_datetime
 from mako.exceptions import TopLevelLookupException
 from pyramid.view import view_config, view_defaults, notfound_view_config
 from pyramid.renderers import render_to_response, render
+from pyramid.response import Response
 from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound
 from pyramid_dogpile_cache import get_region
 
 from price_watch.models import (Page, PriceReport, PackageLookupError,
                                 CategoryLookupError, ProductCategory, Product,
                                 ProductPackage, Merchant)
+from price_watch.history import get_resolution
 from price_watch.utilities import multidict_to_list
+from price_watch.dogpile import invalidate_region
 from price_watch.exceptions import MultidictError
 
 MULTIPLIER = 1
+# longest chart range in days
+MAX_CHART_DAYS = 5 * 366
 general_region = get_region('general')
 
 
@@ -46,6 +51,16 @@ def get_datetimes(days):
     return result
 
 
+def get_rollup_chart(rollups, fields=('median', 'min', 'max')):
+    """Return chart rows `[ISO date, median, min, max]` of the rollups"""
+    chart_data = list()
+    for date, rollup in rollups:
+        values = [rollup[field] for field in fields] if rollup \
+            else [None] * len(fields)
+        chart_data.append([date.isoformat()] + values)
+    return chart_data
+
+
 class EntityView(object):
     """View class for Milk Price Report entities"""
 
@@ -74,6 +89,38 @@ class EntityView(object):
             menu.append((title, path, self.request.path == path))
         return menu
 
+    def get_chart_days(self):
+        """Return chart range in days from the request, 400 if invalid"""
+        try:
+            days = int(self.request.params.get('days', self.display_days))
+        except ValueError:
+            raise HTTPBadRequest('`days` should be an integer')
+        if not 0 < days <= MAX_CHART_DAYS:
+            raise HTTPBadRequest('`days` should be within 1 and {}'.format(
+                MAX_CHART_DAYS))
+        return days
+
+    def get_chart_range(self):
+        """
+        Return chart `(start, end)` dates from the request `start` and `end`
+        ISO dates or the last `days`, 400 if invalid
+        """
+        if 'start' not in self.request.params:
+            days = self.get_chart_days()
+            end = datetime.date.today()
+            return end - datetime.timedelta(days=days - 1), end
+        try:
+            start, end = [
+                datetime.datetime.strptime(self.request.params.get(
+                    name, datetime.date.today().isoformat()), '%Y-%m-%d').date()
+                for name in ('start', 'end')]
+        except ValueError:
+            raise HTTPBadRequest('Dates should be in YYYY-MM-DD format')
+        if not 0 <= (end - start).days < MAX_CHART_DAYS:
+            raise HTTPBadRequest('`start` should be within {} days before '
+                                 '`end`'.format(MAX_CHART_DAYS))
+        return start, end
+
     def currency(self, value, symbol=''):
         """Format currency value with Babel"""
         return format_currency(value, symbol, locale=self.locale)
@@ -164,9 +211,9 @@ class ProductView(EntityView):
                 self.request.resource_url(last_report) if last_report else None
         datetimes = get_datetimes(self.display_days)
         chart_data = list()
-        for date in datetimes:
-            chart_data.append([date.strftime('%d.%m'),
-                               product.get_price(date)])
+        for date, price in zip(datetimes,
+                               product.get_price_series(datetimes)):
+            chart_data.append([date.strftime('%d.%m'), price])
         chart_data = json.dumps(chart_data)
         package_key = product.category.get_data('normal_package')
         product_category_title = product.category.get_data(
@@ -176,8 +223,10 @@ class ProductView(EntityView):
         type_ = product.category.category
         category_title = type_.title
         category_title_ru = type_.get_data('title_ru')
-        category_primary_color = type_.get_data('primary_color')
-        category_background_color = type_.get_data('background_color')
+        category_primary_color = type_.get_data('primary_color',
+                                                inherit=True)
+        category_background_color = type_.get_data('background_color',
+                                                   inherit=True)
         reports = list()
 
         for report in sorted(product.get_reports(
@@ -210,6 +259,23 @@ class ProductView(EntityView):
     def get(self):
         return self.serve_data(self.context)
 
+    @general_region.cache_on_arguments('product')
+    def serve_chart(self, product, days):
+        """
+        Return product chart data for the last `days` with the resolution
+        fitting the range
+        """
+        resolution = get_resolution(days)
+        start = datetime.date.today() - datetime.timedelta(days=days - 1)
+        return {
+            'resolution': resolution,
+            'data': get_rollup_chart(product.get_rollups(resolution, start))
+        }
+
+    @view_config(name='chart', request_method='GET', renderer='json')
+    def chart(self):
+        return self.serve_chart(self.context, self.get_chart_days())
+
 
 @view_defaults(custom_predicates=(namespace_predicate(PriceReport),))
 class PriceReportsView(EntityView):
@@ -227,10 +293,16 @@ class PriceReportsView(EntityView):
                   'package': 0}
         new_report_keys = list()
         error_msgs = list()
+        classifications = Product.get_classifications(
+            [dict_['product_title'] for dict_ in dict_list
+             if 'product_title' in dict_])
         for dict_ in dict_list:
             try:
                 report, new_items = PriceReport.assemble(
-                    storage_manager=self.root, **dict_)
+                    storage_manager=self.root,
+                    classification=classifications.get(
+                        dict_.get('product_title')),
+                    **dict_)
                 new_report_keys.append(report.key)
                 prod_is_new, cat_is_new, pack_is_new = new_items
                 counts['product'] += int(prod_is_new)
@@ -243,7 +315,7 @@ class PriceReportsView(EntityView):
         counts['report'] = len(new_report_keys)
         counts['error'] = len(error_msgs)
         if len(new_report_keys):
-            general_region.invalidate(hard=False)
+            invalidate_region(general_region, self.root)
             reporters = ', '.join(
                 set(self.request.params.getall('reporter_name')))
             # send email
@@ -282,7 +354,7 @@ class PriceReportView(EntityView):
     def delete(self):
 
         self.context.delete_from(self.root)
-        general_region.invalidate(hard=False)
+        invalidate_region(general_region, self.root)
         return {'deleted_report_key': self.context.key}
 
 
@@ -296,6 +368,85 @@ class ProductCategoriesView(EntityView):
             ingredients_text = self.request.params.getone('ingredients')
             return {}
 
+    @general_region.cache_on_arguments('category')
+    def serve_series(self, product_category, locations, start, end,
+                     resolution):
+        """
+        Return cached current prices, deltas and series of the locations
+        (tuple), the series are computed for all of them in one pass
+        """
+        rollups = product_category.get_location_rollups(
+            resolution, start, end, locations)
+        result = dict()
+        for location in locations:
+            median = product_category.get_daily_price(location=location)
+            category_delta = int(product_category.get_daily_price_delta(
+                self.delta_period, location=location)*100)
+            result[location or u''] = {
+                'price': median,
+                'delta_percent': category_delta if median else None,
+                'series': get_rollup_chart(rollups[location])
+            }
+        return result
+
+    def serve_category_series(self, product_category, locations, start, end,
+                              resolution):
+        """Return category data with the series of the locations"""
+        if '*' in locations:
+            locations = [None] + product_category.get_locations()
+        return {
+            'title': product_category.get_data('keyword').split(', ')[0],
+            'package': product_category.get_data('normal_package'),
+            'locations': self.serve_series(
+                product_category,
+                tuple(sorted(set(location or None
+                                 for location in locations))),
+                start, end, resolution)
+        }
+
+    @view_config(name='series', request_method='GET')
+    def series(self):
+        """
+        Stream JSON of current prices, deltas and rollup series of many
+        categories (`category` keys, all by default) and locations
+        (`location` names, `*` for all of them, nation-wide by default) for
+        the date range. The categories are computed one at a time while
+        streaming, through a connection of the response as the one of the
+        request is closed before.
+        """
+        params = self.request.params
+        start, end = self.get_chart_range()
+        resolution = params.get('resolution') or \
+            get_resolution((end - start).days + 1)
+        if resolution not in ('day', 'week', 'month'):
+            raise HTTPBadRequest('`resolution` should be day, week or month')
+        category_keys = params.getall('category') or \
+            list(self.context.keys())
+        locations = params.getall('location') or [None]
+        reader = self.root.open_reader()
+
+        def generate():
+            try:
+                yield '{{"resolution": {}, "start": {}, "end": {}, ' \
+                      '"categories": {{'.format(json.dumps(resolution),
+                                                json.dumps(start.isoformat()),
+                                                json.dumps(end.isoformat()))
+                for num, key in enumerate(category_keys):
+                    product_category = ProductCategory.fetch(key, reader)
+                    data = None
+                    if product_category is not None:
+                        data = self.serve_category_series(
+                            product_category, locations, start, end,
+                            resolution)
+                    yield '{}{}: {}'.format(', ' if num else '',
+                                            json.dumps(key), json.dumps(data))
+                yield '}}'
+            finally:
+                reader.release()
+
+        return Response(app_iter=generate(), content_type='application/json',
+                        charset='utf-8')
+
 
 @view_defaults(context=ProductCategory)
 class ProductCategoryView(EntityView):
@@ -306,11 +457,13 @@ class ProductCategoryView(EntityView):
         category = product_category.category
         category_title = category.title
         category_title_ru = category.get_data('title_ru')
-        category_primary_color = category.get_data('primary_color')
-        category_background_color = category.get_data('background_color')
+        category_primary_color = category.get_data('primary_color',
+                                                   inherit=True)
+        category_background_color = category.get_data('background_color',
+                                                      inherit=True)
         prod_cat_title = product_category.get_data('ru_accu_case')
-        median = product_category.get_price(location=location)
-        category_delta = int(product_category.get_price_delta(
+        median = product_category.get_daily_price(location=location)
+        category_delta = int(product_category.get_daily_price_delta(
             self.delta_period, location=location)*100)
         if not prod_cat_title:
             prod_cat_title = product_category.get_data(
@@ -320,15 +473,17 @@ class ProductCategoryView(EntityView):
 
         chart_data = list()
         datetimes = get_datetimes(self.display_days)
-        for date in datetimes:
-            chart_data.append([date.strftime('%d.%m'),
-                               product_category.get_price(date, location=location)])
+        prices = product_category.get_price_series(datetimes,
+                                                   location=location)
+        for date, price in zip(datetimes, prices):
+            chart_data.append([date.strftime('%d.%m'), price])
         products = list()
         locations = product_category.get_locations()
         current_path = self.request.resource_url(product_category)
-        sorted_products = sorted(
-            product_category.get_qualified_products(location=location),
-            key=lambda pr: pr[1])
+        qualified_products = product_category.get_qualified_products(
+            location=location)
+        sorted_products = sorted(qualified_products, key=lambda pr: pr[1])
+        deltas = product_category.get_product_deltas(self.delta_period)
         for num, product_tuple in enumerate(sorted_products):
             try:
                 product, price = product_tuple
@@ -343,14 +498,22 @@ class ProductCategoryView(EntityView):
                     product,
                     self.request.resource_url(product),
                     self.currency(price),
-                    int(product.get_price_delta(self.delta_period)*100),
+                    int(deltas.get(product.key, (None, None, 0))[2]*100),
                     is_median
                 ))
             except TypeError:
                 pass
+        movers = list()
+        for product, price, base_price, delta in \
+                product_category.get_top_movers(
+                    self.delta_period, location=location, deltas=deltas,
+                    products=qualified_products):
+            movers.append((product, self.request.resource_url(product),
+                           self.currency(price), int(delta*100)))
         return {
             'price_data': json.dumps(chart_data),
             'products': products,
+            'movers': movers,
             'cat_title': prod_cat_title,
             'current_location': location,
             'locations': locations,
@@ -376,8 +539,8 @@ class ProductCategoryView(EntityView):
     @general_region.cache_on_arguments('category')
     def serve_api_data(self, product_category, location):
         """Serve cached category data for API call"""
-        median = product_category.get_price(location=location)
-        category_delta = int(product_category.get_price_delta(
+        median = product_category.get_daily_price(location=location)
+        category_delta = int(product_category.get_daily_price_delta(
             self.delta_period, location=location)*100)
         title = product_category.get_data('keyword').split(', ')[0]
         package_key = product_category.get_data('normal_package')
@@ -396,6 +559,54 @@ class ProductCategoryView(EntityView):
             location = self.request.params.getone('location')
         return self.serve_api_data(category, location)
 
+    @general_region.cache_on_arguments('category')
+    def serve_statistics(self, product_category, date, location):
+        """Return price statistics for the end of the date (or current)"""
+        date_time = None
+        if date is not None:
+            date_time = datetime.datetime.combine(date, datetime.time.max)
+        return {
+            'date': date.isoformat() if date else None,
+            'location': location,
+            'statistics': product_category.get_price_statistics(
+                date_time, location)
+        }
+
+    @view_config(name='statistics', request_method='GET', renderer='json')
+    def statistics(self):
+        params = self.request.params
+        date = None
+        if params.get('date'):
+            try:
+                date = datetime.datetime.strptime(params.get('date'),
+                                                  '%Y-%m-%d').date()
+            except ValueError:
+                raise HTTPBadRequest('`date` should be in YYYY-MM-DD format')
+        return self.serve_statistics(self.context, date,
+                                     params.get('location') or None)
+
+    @general_region.cache_on_arguments('category')
+    def serve_chart(self, product_category, days, location):
+        """
+        Return category chart data for the last `days` with the resolution
+        fitting the range
+        """
+        resolution = get_resolution(days)
+        start = datetime.date.today() - datetime.timedelta(days=days - 1)
+        return {
+            'resolution': resolution,
+            'data': get_rollup_chart(product_category.get_rollups(
+                resolution, start, location=location))
+        }
+
+    @view_config(name='chart', request_method='GET', renderer='json')
+    def chart(self):
+        location = None
+        if 'location' in self.request.params:
+            location = self.request.params.getone('location')
+        return self.serve_chart(self.context, self.get_chart_days(),
+                                location)
+
 
 class RootView(EntityView):
     """General root views"""
@@ -412,20 +623,22 @@ class RootView(EntityView):
         for type_ in categories:
             category_tuples = list()
             type_title_ru = type_.get_data('title_ru')
-            type_primary_color = type_.get_data('primary_color')
-            type_background_color = type_.get_data('background_color')
+            type_primary_color = type_.get_data('primary_color',
+                                                inherit=True)
+            type_background_color = type_.get_data('background_color',
+                                                   inherit=True)
             type_.categories.sort(
                 key=lambda x: float(x.get_data('priority', default=0)),
                 reverse=True)
             for category in type_.categories:
-                price = category.get_price(location=location)
+                price = category.get_daily_price(location=location)
                 if price:
                     price = self.currency(price)
                     query = {'location': location} if location else None
                     url = self.request.resource_path(category, query=query)
                     title = category.get_data('keyword').split(', ')[0]
-                    delta = int(category.get_price_delta(self.delta_period,
-                                                         location=location)*100)
+                    delta = int(category.get_daily_price_delta(
+                        self.delta_period, location=location)*100)
                     package_key = category.get_data('normal_package')
                     package_title = ProductPackage(
                         package_key).get_data('synonyms')[0]
@@ -53,5 +53,6 @@ setup(name='price_watch',
       main = price_watch:main
       [console_scripts]
       pack_storage = price_watch.scripts:pack_storage
+      build_data_map = price_watch.scripts:build_data_map
       """,
       )